@@ -1,5 +1,7 @@
 from mesa import Agent
-from heapq import heappush, heappop
+
+# Waits in a row without a route after which a car is counted as stuck by the profiler
+STUCK_EPISODES = 3
 
 class Car(Agent):
     def get_dir(self, current_pos, next_pos):
@@ -24,137 +26,120 @@ class Car(Agent):
         self.path = []
         self.current_road = None
         self.episodes_waiting = 0
+        self.spawn_step = model.schedule.steps
+        # Steps spent without moving
+        self.wait_steps = 0
+        # Sleeping until an event of the model's Wakeups, and the number of the current nap (see wakeups)
+        self.asleep = False
+        self.nap = 0
 
     def manhattan_distance(self, pos1, pos2):
         """Calculate Manhattan distance between two points."""
         return abs(pos1[0] - pos2[0]) + abs(pos1[1] - pos2[1])
 
     def get_road(self, pos):
-        """Get the road agent at a given position."""
-        cell_contents = self.model.grid.get_cell_list_contents(pos)
-        for content in cell_contents:
-            if isinstance(content, Road):
-                return content
-        return None
+        """Get a view of the road at a given position, None if there is no road."""
+        return self.model.cell_index.road_view(pos)
 
     def is_valid_move(self, current_pos, next_pos, current_road=None, ignore_traffic_lights=False):
         """
         Check if moving from current_pos to next_pos follows traffic rules.
         """
-        if not current_road:
-            current_road = self.get_road(current_pos)
-            if not current_road:
+        cell_index = self.model.cell_index
+        if current_road:
+            current_direction = current_road.direction
+        else:
+            current_direction = cell_index.road_direction(current_pos)
+            if not current_direction:
                 return False
 
-        next_road = self.get_road(next_pos)
-        if not next_road:
+        next_direction = cell_index.road_direction(next_pos)
+        if not next_direction:
             return False
 
         # Check traffic light
-        cell_contents = self.model.grid.get_cell_list_contents(next_pos)
         if not ignore_traffic_lights:
-            for content in cell_contents:
-                if isinstance(content, Traffic_Light) and not content.state:
-                    return False
+            light = cell_index.light[next_pos]
+            if light >= 0 and not self.model.traffic_lights[light].state:
+                return False
 
         move_direction = self.get_dir(current_pos, next_pos)
         
         # Direct movement along road direction
-        if move_direction == next_road.direction:
+        if move_direction == next_direction:
             return True
             
         # Check if turn is valid
-        return self.can_turn(current_road, next_road)
+        return self.can_turn_direction(current_direction, next_direction, move_direction)
 
     def is_valid_cell(self, pos):
-        """Check if a cell is within the grid and not blocked by an obstacle."""
-        if (pos[0] < 0 or pos[0] >= self.model.grid.width or 
-            pos[1] < 0 or pos[1] >= self.model.grid.height):
-            return False
-        
-        cell_contents = self.model.grid.get_cell_list_contents(pos)
-        if any(isinstance(content, (Car,Obstacle)) for content in cell_contents):
-            return False
-        
-        return True
+        """Check if a cell is within the grid and not blocked by an obstacle or another car."""
+        return self.model.cell_index.is_free(pos)
     
     def find_path(self):
-        """A* pathfinding implementation that respects traffic rules."""
-        start = self.pos
-        goal = self.destination.pos
-        
-        # Priority queue for open set
-        open_set = []
-        heappush(open_set, (0, start))
-        
-        # Dictionary to store path
-        came_from = {}
-        
-        # Cost to reach each node
-        g_score = {start: 0}
-        
-        # Estimated total cost
-        f_score = {start: self.manhattan_distance(start, goal)}
-        
-        # Get initial road
-        current_road = self.get_road(start)
-        if not current_road:
+        """A* pathfinding over the model's precompiled road graph, respecting traffic rules.
+        Routes are shared between cars through the model's route cache, except with congestion
+        routing, where they depend on the cars and lights around this car."""
+        cache = self.model.route_cache
+        if self.model.congestion is None:
+            return cache.get(self.pos, self.destination.pos)
+        # One search with the live costs. The cache only remembers the destinations that cannot be
+        # reached (the costs never change that), so they are not searched again
+        if cache.unreachable(self.pos, self.destination.pos):
             return None
+        route = self.model.road_graph.find_path(self.pos, self.destination.pos, self.model.congestion)
+        if route is None:
+            cache.mark_unreachable(self.pos, self.destination.pos)
+        return route
 
-        while open_set:
-            current = heappop(open_set)[1]
-            
-            if current == goal:
-                # Reconstruct path
-                path = []
-                while current in came_from:
-                    path.append(current)
-                    current = came_from[current]
-                path.append(start)
-                path.reverse()
-                return path
-            
-            # Get neighbors (possible next positions)
-            neighbors = self.model.grid.get_neighborhood(
-                current,
-                moore=False,
-                include_center=False
-            )
-            
-            current_road = self.get_road(current)
-            if not current_road:
-                continue
-
-            for neighbor in neighbors:
-                # Skip if out of bounds
-                if (neighbor[0] < 0 or neighbor[0] >= self.model.grid.width or 
-                    neighbor[1] < 0 or neighbor[1] >= self.model.grid.height):
-                    continue
-
-                # Check if move follows traffic rules
-                if not self.is_valid_move(current, neighbor, current_road, True):
-                    continue
-
-                # Check for obstacles and other cars
-                cell_contents = self.model.grid.get_cell_list_contents(neighbor)
-                if any(isinstance(content, Obstacle) for content in cell_contents):
-                    continue
-
-                # Calculate scores
-                tentative_g_score = g_score[current] + 1
-                
-                if neighbor not in g_score or tentative_g_score < g_score[neighbor]:
-                    came_from[neighbor] = current
-                    g_score[neighbor] = tentative_g_score
-                    f_score[neighbor] = tentative_g_score + self.manhattan_distance(neighbor, goal)
-                    heappush(open_set, (f_score[neighbor], neighbor))
-        
-        return None
+    def repair_path(self):
+        """
+        Congestion routing, when the next cell of the path is taken by a car: replaces the blocked part
+        of the path by a detour that rejoins it further on, if the detour is cheaper than waiting, and
+        takes its first move. The detour is only searched when the car gets blocked, then it waits.
+        Returns False once the car has waited too long and should leave its path.
+        """
+        congestion = self.model.congestion
+        detour = None
+        if not self.episodes_waiting:
+            # Waiting costs the expected delay behind the car in the way plus the rest of the path
+            waiting_cost = congestion.occupancy_weight + len(self.path)
+            detour = self.model.road_graph.repair_path(self.pos, self.path, congestion, waiting_cost)
+        if detour is None:
+            self.episodes_waiting += 1
+            if self.episodes_waiting < congestion.patience:
+                return True
+            self.episodes_waiting = 0
+            return False
+
+        self.path = detour
+        self.next_pos = detour[0]
+        if self.is_valid_move(self.pos, self.next_pos) and self.is_valid_cell(self.next_pos):
+            self.current_direction = self.get_dir(self.pos, self.next_pos)
+            self.model.grid.move_agent(self, self.next_pos)
+            self.path.pop(0)
+        return True
+
+    def rejoin_path(self, old_path):
+        """
+        Path after the car left old_path for a neighbor cell. Congestion routing tries to rejoin old_path
+        past its blocked cell instead of planning again from scratch.
+        """
+        if self.model.congestion is None or not old_path:
+            return []
+        return self.model.road_graph.repair_path(self.pos, old_path, self.model.congestion) or []
 
     def can_turn(self, current_road, next_road):
         """
         Determine if a turn from current road to next road is valid.
         """
+        required_direction = self.get_dir(current_road.pos, next_road.pos)
+        return self.can_turn_direction(current_road.direction, next_road.direction, required_direction)
+
+    def can_turn_direction(self, current_direction, next_direction, required_direction):
+        """
+        Same as can_turn, from the road directions and the direction of the move.
+        """
         opposite_turns = {
             "Right": "Left",
             "Left": "Right",
@@ -162,97 +147,162 @@ class Car(Agent):
             "Down": "Up"
         }
 
-        if next_road.direction == "None":
+        if next_direction == "None":
             return True
-        
-        required_direction = self.get_dir(current_road.pos, next_road.pos)
-        direction_of_turned_road = next_road.direction
 
-        return (direction_of_turned_road != opposite_turns.get(required_direction) and 
-                required_direction != opposite_turns.get(current_road.direction))
+        return (next_direction != opposite_turns.get(required_direction) and 
+                required_direction != opposite_turns.get(current_direction))
     
-    def move(self):
-        if self.pos == self.destination.pos:
-            self.model.grid.remove_agent(self)
-            self.model.schedule.remove(self)
-            self.model.cars_completed += 1
-            return
-        
-        old_pos = self.pos
+    def arrive(self):
+        """Leaves the grid at the destination and records the trip."""
+        self.model.grid.remove_agent(self)
+        self.model.schedule.remove(self)
+        self.model.record_trip(int(self.unique_id[len("car_"):]), self.spawn_step, self.wait_steps)
+
+    def wait_without_route(self):
+        """
+        The car has no route from its cell. After STUCK_EPISODES of these waits in a row it is counted
+        as stuck by the profiler, once.
+        """
+        self.episodes_waiting += 1
+        if self.episodes_waiting == STUCK_EPISODES and self.model.profiler is not None:
+            self.model.profiler.count("stuck_cars")
+
+    def moved(self):
+        """The car left its cell, so it is no longer waiting."""
+        self.episodes_waiting = 0
+
+    def plan_next_position(self):
+        """
+        Next position of the car, from its route (computed if it has none) or from the next-hop field
+        of its destination. Returns None if there is no route.
+        """
+        if self.model.next_hops is not None:
+            # Constant time lookup in the precomputed field of the destination
+            next_pos = self.model.next_hops.next_position(self.pos, self.destination.pos)
+            if next_pos is None:
+                self.wait_without_route()
+            return next_pos
 
         # If we don't have a path or need to recalculate
         if not self.path:
             self.path = self.find_path()
             if not self.path:
-                if self.pos == old_pos:
-                    self.episodes_waiting += 1
-                    if self.episodes_waiting >= 3:
-                        print(f"Car {self.unique_id} is stuck at {self.pos}")
-                else:
-                    self.episodes_waiting = 0
-                return  # No path found
+                self.wait_without_route()
+                return None  # No path found
             # Remove current position from path
             if self.path[0] == self.pos:
                 self.path.pop(0)
-        
-        if self.path:
-            self.next_pos = self.path[0]
-
-            # Finally check if move is valid (including traffic lights)
-            if self.is_valid_move(self.pos, self.next_pos) and self.is_valid_cell(self.next_pos):
-                # Move if path is clear and traffic rules allow
-                self.current_direction = self.get_dir(self.pos, self.next_pos)
-                self.model.grid.move_agent(self, self.next_pos)
-                self.path.pop(0)
-            # If invalid due to traffic light, keep the same path and wait
-            # The car will try again next step when the light might be green
-            elif not self.is_valid_cell(self.next_pos):
-                # Get current road direction
-                current_road = self.get_road(self.pos)
-                if not current_road:
-                    return
-
-                # Get perpendicular neighbors based on road direction
-                if current_road.direction in ["Left", "Right"]:
-                    neighbors = [(self.pos[0], self.pos[1] + 1), (self.pos[0], self.pos[1] - 1)]
-                else:  # Up or Down
-                    neighbors = [(self.pos[0] + 1, self.pos[1]), (self.pos[0] - 1, self.pos[1])]
-
-                # Try each adjacent lane
-                lane_changed = False
-                for lane_pos in neighbors:
-                    # Check if lane position is valid and has a road
-                    if self.is_valid_cell(lane_pos) and self.get_road(lane_pos):
-                        # Move to adjacent lane
-                        self.model.grid.move_agent(self, lane_pos)
-                        # Reset path to recalculate from new position
-                        self.path = []
-                        lane_changed = True
-                        break
-
-                # If lane change failed, try moving to a random valid neighbor
-                if not lane_changed:
-                    # Get all possible neighbors
-                    all_neighbors = self.model.grid.get_neighborhood(
-                        self.pos,
-                        moore=True,
-                        include_center=False
-                    )
-                    # Filter valid moves
-                    valid_moves = [pos for pos in all_neighbors 
-                                 if self.is_valid_cell(pos) and self.get_road(pos)]
-                    
-                    if valid_moves:
-                        # Choose random valid position
-                        new_pos = self.random.choice(valid_moves)
-                        self.model.grid.move_agent(self, new_pos)
-                        # Reset path from new position
-                        self.path = []
 
+        if not self.path:
+            return None
+        return self.path[0]
+
+    def propose(self):
+        """
+        First phase of the synchronous step (see parallel_moves): the next position of the car and whether
+        the move follows the traffic rules, read from the state at the start of the step. The car does not move.
+        Returns (None, False) if it has no move.
+        """
+        if self.asleep:
+            # Waiting for the light of next_pos
+            return self.next_pos, False
+        self.next_pos = self.plan_next_position()
+        if self.next_pos is None:
+            return None, False
+        valid = self.is_valid_move(self.pos, self.next_pos)
+        if not valid and self.model.wakeups is not None:
+            self.model.wakeups.sleep_at_light(self)
+        return self.next_pos, valid
+
+    def move(self):
+        if self.pos == self.destination.pos:
+            self.arrive()
+            return
+
+        self.next_pos = self.plan_next_position()
+        if self.next_pos is None:
+            return
+
+        # Finally check if move is valid (including traffic lights)
+        if self.is_valid_move(self.pos, self.next_pos) and self.is_valid_cell(self.next_pos):
+            # Move if path is clear and traffic rules allow
+            self.current_direction = self.get_dir(self.pos, self.next_pos)
+            self.model.grid.move_agent(self, self.next_pos)
+            if self.path:
+                self.path.pop(0)
+        # If invalid due to traffic light, keep the same path and wait
+        # The car will try again next step when the light might be green
+        elif not self.is_valid_cell(self.next_pos):
+            # Congestion routing detours around the car in the way, or waits behind it for a while
+            if self.model.congestion is not None and self.path and self.repair_path():
+                return
+
+            # Get current road direction
+            current_direction = self.model.cell_index.road_direction(self.pos)
+            if not current_direction:
+                if self.model.wakeups is not None:
+                    self.model.wakeups.sleep_blocked(self)
+                return
+
+            # Get perpendicular neighbors based on road direction
+            if current_direction in ["Left", "Right"]:
+                neighbors = [(self.pos[0], self.pos[1] + 1), (self.pos[0], self.pos[1] - 1)]
+            else:  # Up or Down
+                neighbors = [(self.pos[0] + 1, self.pos[1]), (self.pos[0] - 1, self.pos[1])]
+
+            # Try each adjacent lane
+            lane_changed = False
+            for lane_pos in neighbors:
+                # Check if lane position is valid and has a road
+                if self.is_valid_cell(lane_pos) and self.model.cell_index.road[lane_pos]:
+                    # Move to adjacent lane
+                    if self.model.profiler is not None:
+                        self.model.profiler.count("lane_change_fallbacks")
+                    self.model.grid.move_agent(self, lane_pos)
+                    # Reset path to recalculate from new position
+                    self.path = self.rejoin_path(self.path)
+                    lane_changed = True
+                    break
+
+            # If lane change failed, try moving to a random valid neighbor
+            if not lane_changed:
+                # Get all possible neighbors
+                all_neighbors = self.model.grid.get_neighborhood(
+                    self.pos,
+                    moore=True,
+                    include_center=False
+                )
+                # Filter valid moves
+                valid_moves = [pos for pos in all_neighbors 
+                             if self.is_valid_cell(pos) and self.model.cell_index.road[pos]]
+                
+                if valid_moves:
+                    # Choose random valid position
+                    new_pos = self.random.choice(valid_moves)
+                    if self.model.profiler is not None:
+                        self.model.profiler.count("random_move_fallbacks")
+                    self.model.grid.move_agent(self, new_pos)
+                    # Reset path from new position
+                    self.path = self.rejoin_path(self.path)
+                elif self.model.wakeups is not None:
+                    # Nothing changes until a car enters or leaves a neighbor cell
+                    self.model.wakeups.sleep_blocked(self)
+        elif self.model.wakeups is not None:
+            # Waiting for the light or for a legal turn into a free cell
+            self.model.wakeups.sleep_at_light(self)
 
 
     def step(self):
+        if self.asleep:
+            self.wait_steps += 1
+            return
+        pos = self.pos
         self.move()
+        if self.pos == pos:
+            self.wait_steps += 1
+        elif self.pos is not None:
+            self.moved()
 
 class Traffic_Light(Agent):
     """
@@ -270,48 +320,56 @@ class Traffic_Light(Agent):
         """
         self.state = state
         self.timeToChange = timeToChange
+        # With wake-ups, only awake in the steps the light can change (see wakeups)
+        self.asleep = False
 
     def step(self):
         """ 
         To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
+        The model's light controller decides it, see traffic_control.
         """
-        if self.model.schedule.steps % self.timeToChange == 0:
-            self.state = not self.state
-
-class Destination(Agent):
+        wakeups = self.model.wakeups
+        if wakeups is None:
+            self.model.light_controller.step_light(self)
+        elif not self.asleep:
+            self.model.light_controller.step_light(self)
+            wakeups.light_stepped(self)
+
+class Destination:
     """
-    Destination agent. Where each car should go.
+    Destination cell. Where each car should go.
+    Static cells are not Mesa agents, they live in the model's CellIndex and these views are created on demand.
     """
-    def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
+    __slots__ = ("unique_id", "pos")
 
-    def step(self):
-        pass
+    def __init__(self, unique_id, pos):
+        self.unique_id = unique_id
+        self.pos = pos
 
-class Obstacle(Agent):
+class Obstacle:
     """
-    Obstacle agent. Just to add obstacles to the grid.
+    Obstacle cell, view of CellIndex.obstacle.
     """
-    def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
+    __slots__ = ("unique_id", "pos")
 
-    def step(self):
-        pass
+    def __init__(self, unique_id, pos):
+        self.unique_id = unique_id
+        self.pos = pos
 
-class Road(Agent):
+class Road:
     """
-    Road agent. Determines where the cars can move, and in which direction.
+    Road cell, view of CellIndex.road. Determines where the cars can move, and in which direction.
     """
-    def __init__(self, unique_id, model, direction= "Left"):
+    __slots__ = ("unique_id", "pos", "direction")
+
+    def __init__(self, unique_id, pos, direction= "Left"):
         """
-        Creates a new road.
+        Creates a view of a road.
         Args:
-            unique_id: The agent's ID
-            model: Model reference for the agent
+            unique_id: The road's ID
+            pos: Position of the road
             direction: Direction where the cars can move
         """
-        super().__init__(unique_id, model)
+        self.unique_id = unique_id
+        self.pos = pos
         self.direction = direction
-
-    def step(self):
-        pass
\ No newline at end of file
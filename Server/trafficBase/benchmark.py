@@ -0,0 +1,238 @@
+"""
+Benchmark of CityModel and the Flask endpoints on generated cities of increasing size.
+Every city runs in its own process, so the peak memory of one does not hide the others.
+Results can be stored as a baseline and later runs compared against it to catch regressions. Runs with the
+default settings are compared with the baseline committed in BASELINE, recorded with those settings.
+
+Example:
+    python benchmark.py
+    python benchmark.py --sizes 100 500 2000 --steps 100 --save-baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from city_generator import generate_city, write_city
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Baseline compared by default, recorded with the default settings of main
+BASELINE = "./benchmarks/baseline.json"
+
+ENDPOINTS = [
+    "/update",
+    "/getAgents",
+    "/getAgents?format=binary",
+    "/getTrafficLights",
+    "/getTrafficLights?format=binary",
+    "/getObstacles",
+    "/map"
+]
+
+# Metrics compared against the baseline. All of them are better when lower
+METRICS = [
+    "build_s", "step_mean_ms", "step_p95_ms", "step_max_ms", "expansions", "expansions_per_step", "peak_rss_mb"
+] + [f"{endpoint}_ms" for endpoint in ENDPOINTS]
+
+
+def city_file(size, block, destination_density, light_ratio, seed):
+    """Generates the city of a benchmark case if it does not exist yet. Returns its name inside city_files/."""
+    name = os.path.join("generated", f"city_{size}_b{block}_d{destination_density}_l{light_ratio}_s{seed}.txt")
+    path = os.path.join("./city_files", name)
+    if not os.path.exists(path):
+        write_city(generate_city(size, size, block, destination_density, light_ratio, seed), path)
+    return name
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process, None where the resource module is not available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_case(case, steps, requests, routing, engine, step_mode="sequential", spawn=None, wakeups=False):
+    """
+    Builds the city of case in a session of server_traffic, steps it and then times the endpoints on it.
+    Returns the row of results of the case.
+    """
+    import server_traffic
+
+    start = time.perf_counter()
+    session = server_traffic.sessions.create(0, city_file=case["city_file"], routing=routing, engine=engine,
+                                             seed=case["seed"], step_mode=step_mode, spawn=spawn, wakeups=wakeups)
+    build = time.perf_counter() - start
+    model = session.model
+
+    step_times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        session.step()
+        step_times.append((time.perf_counter() - start) * 1000)
+    # Cells expanded by A*, plus the nodes and street cells of the hierarchical routing modes
+    expansions = model.road_graph.expansions + (model.hierarchy.expansions if model.hierarchy is not None else 0)
+
+    row = {
+        "case": case["name"],
+        "cells": model.width * model.height,
+        "roads": model.road_graph.road_count,
+        "lights": len(model.traffic_lights),
+        "destinations": len(model.destinations),
+        "steps": steps,
+        "cars_spawned": model.car_count,
+        "build_s": round(build, 3),
+        "step_mean_ms": round(sum(step_times) / len(step_times), 3) if step_times else 0,
+        "step_p95_ms": round(percentile(step_times, 0.95), 3),
+        "step_max_ms": round(max(step_times, default=0), 3),
+        "expansions": expansions,
+        "expansions_per_step": round(expansions / steps, 1) if steps else 0
+    }
+
+    client = server_traffic.app.test_client()
+    for endpoint in ENDPOINTS:
+        separator = "&" if "?" in endpoint else "?"
+        url = f"{endpoint}{separator}session={session.id}"
+        times = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = client.get(url)
+            times.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f"{endpoint} answered {response.status_code} on {case['name']}")
+        row[f"{endpoint}_ms"] = round(sum(times) / len(times), 3)
+
+    server_traffic.sessions.close(session.id)
+    row["peak_rss_mb"] = peak_rss_mb()
+    return row
+
+
+def run_benchmark(cases, steps, requests, routing="astar", engine="mesa", step_mode="sequential", spawn=None,
+                  wakeups=False):
+    """Runs every case in a fresh process, one after the other so they do not compete for the CPU."""
+    rows = []
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            rows.append(executor.submit(run_case, case, steps, requests, routing, engine, step_mode, spawn, wakeups).result())
+        print(f"{case['name']}: {rows[-1]['step_mean_ms']} ms/step", file=sys.stderr)
+    return rows
+
+
+def machine():
+    return {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()}
+
+
+def save_baseline(rows, settings, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as baselineFile:
+        json.dump({"machine": machine(), "settings": settings, "cases": {row["case"]: row for row in rows}},
+                  baselineFile, indent=2)
+
+
+def compare(rows, baseline, tolerance):
+    """
+    Ratio of every metric against the baseline.
+    Returns the list of (case, metric, baseline value, value) more than tolerance above the baseline.
+    """
+    regressions = []
+    for row in rows:
+        reference = baseline["cases"].get(row["case"])
+        if reference is None:
+            continue
+        for metric in METRICS:
+            old, new = reference.get(metric), row.get(metric)
+            if old is None or new is None:
+                continue
+            row[f"{metric}_ratio"] = round(new / old, 2) if old else None
+            if new > old * (1 + tolerance) and new - old > 1e-3:
+                regressions.append((row["case"], metric, old, new))
+    return regressions
+
+
+def print_results(rows):
+    """One column per case, one line per metric."""
+    metrics = [key for key in rows[0] if key != "case"] if rows else []
+    cells = [[row["case"] for row in rows]] + [[str(row.get(metric, "")) for row in rows] for metric in metrics]
+    label_width = max([len("case")] + [len(metric) for metric in metrics])
+    widths = [max(len(line[i]) for line in cells) for i in range(len(rows))]
+    for label, line in zip(["case"] + metrics, cells):
+        print(label.ljust(label_width) + "  " + "  ".join(value.rjust(width) for value, width in zip(line, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CityModel and the endpoints on generated cities")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 500, 2000], help="Side of the generated cities")
+    parser.add_argument("--block", type=int, default=6, help="Side of the blocks between streets")
+    parser.add_argument("--destinations", type=float, default=0.1, help="Density of destinations next to the streets")
+    parser.add_argument("--lights", type=float, default=1.0, help="Fraction of crossings with traffic lights")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated cities and of the models")
+    parser.add_argument("--steps", type=int, default=100, help="Steps run on every city")
+    parser.add_argument("--requests", type=int, default=20, help="Requests timed per endpoint")
+    parser.add_argument("--routing", choices=["astar", "next_hop", "congestion", "hierarchical", "hierarchical_ch"], default="astar")
+    parser.add_argument("--engine", choices=["mesa", "vectorized"], default="mesa")
+    parser.add_argument("--step-mode", choices=["sequential", "synchronous"], default="sequential")
+    parser.add_argument("--spawn", type=json.loads, help="JSON object with the options of spawning.Spawner")
+    parser.add_argument("--wakeups", action="store_true", help="Let the idle cars and lights sleep (mesa engine)")
+    parser.add_argument("--save-baseline", help="Store the results as the baseline in this JSON file")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="Compare the results with the baseline in this JSON file, '' to not compare")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative increase over the baseline")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    cases = [{
+        "name": f"{size}x{size}",
+        "city_file": city_file(size, args.block, args.destinations, args.lights, args.seed),
+        "seed": args.seed
+    } for size in args.sizes]
+    settings = {key: value for key, value in vars(args).items()
+                if key not in ("save_baseline", "baseline", "tolerance", "output")}
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        # Cases are matched by size, every other setting changes the numbers
+        recorded = {key: value for key, value in baseline.get("settings", {}).items() if key != "sizes"}
+        if recorded != {key: value for key, value in settings.items() if key != "sizes"}:
+            print(f"Not comparing with {args.baseline}, it was recorded with {baseline.get('settings')}", file=sys.stderr)
+            baseline = None
+        elif baseline.get("machine") != machine():
+            print(f"Warning: the baseline was recorded on {baseline.get('machine')}", file=sys.stderr)
+    elif args.baseline and args.baseline != BASELINE:
+        parser.error(f"There is no baseline at {args.baseline}")
+
+    rows = run_benchmark(cases, args.steps, args.requests, args.routing, args.engine, args.step_mode, args.spawn,
+                         args.wakeups)
+
+    regressions = compare(rows, baseline, args.tolerance) if baseline is not None else []
+
+    print_results(rows)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump({"machine": machine(), "settings": settings, "rows": rows}, outputFile, indent=2)
+    if args.save_baseline:
+        save_baseline(rows, settings, args.save_baseline)
+
+    for case, metric, old, new in regressions:
+        print(f"Regression in {case}: {metric} went from {old} to {new}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import numpy as np
+from cell_index import DIRECTION_CODES
+
+# One fixed-width record per car, little endian and without padding (9 bytes)
+CAR_RECORD = np.dtype([
+    ("id", "<u4"),
+    ("x", "<u2"),
+    ("y", "<u2"),
+    ("direction", "u1")
+])
+
+BINARY_MIMETYPE = "application/octet-stream"
+
+
+def car_number(car_id):
+    """Numeric part of a car id such as car_123."""
+    return int(car_id[car_id.rfind("_") + 1:])
+
+
+def pack_cars(deltas):
+    """
+    Packs the cars of a DeltaTracker at its last commit as CAR_RECORD records.
+    The direction is a cell_index.DIRECTION_CODES code, 0 if the car has not moved yet.
+    """
+    _, cars, _ = deltas.committed()
+    cars = list(cars.items())
+    records = np.empty(len(cars), dtype=CAR_RECORD)
+    if cars:
+        records["id"] = [car_number(car_id) for car_id, _ in cars]
+        records["x"] = [x for _, (x, _, _) in cars]
+        records["y"] = [y for _, (_, y, _) in cars]
+        records["direction"] = [DIRECTION_CODES.get(direction, 0) for _, (_, _, direction) in cars]
+    return records.tobytes()
+
+
+def pack_lights(deltas):
+    """
+    Packs the states of the traffic lights of a DeltaTracker at its last commit as a bitset, one bit per light
+    (least significant bit first) in the order /getTrafficLights lists them.
+    """
+    _, _, lights = deltas.committed()
+    states = np.array([state for _, _, state in lights.values()], dtype=bool)
+    return np.packbits(states, bitorder="little").tobytes()
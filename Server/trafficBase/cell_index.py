@@ -0,0 +1,139 @@
+import numpy as np
+from mesa.space import MultiGrid
+from agent import Car, Road, Obstacle, Destination
+
+# Codes stored in CellIndex.road. 0 means there is no road in the cell
+NO_ROAD = 0
+DIRECTION_CODES = {
+    "Right": 1,
+    "Left": 2,
+    "Up": 3,
+    "Down": 4,
+    "None": 5
+}
+DIRECTION_NAMES = (None, "Right", "Left", "Up", "Down", "None")
+
+NO_LIGHT = -1
+
+
+class CellIndex:
+    """
+    Typed arrays indexed by (x, y) with what is in each cell of the city.
+    They answer the hot-path checks of the cars without scanning the grid contents.
+    """
+    def __init__(self, width, height):
+        """
+        Args:
+            width: Width of the city grid
+            height: Height of the city grid
+        """
+        self.width = width
+        self.height = height
+        # Direction code of the road in each cell
+        self.road = np.zeros((width, height), dtype=np.uint8)
+        # True where there is an obstacle
+        self.obstacle = np.zeros((width, height), dtype=bool)
+        # True where there is a destination
+        self.destination = np.zeros((width, height), dtype=bool)
+        # Index in CityModel.traffic_lights of the light in each cell, NO_LIGHT if there is none
+        self.light = np.full((width, height), NO_LIGHT, dtype=np.int32)
+        # Number of cars in each cell
+        self.cars = np.zeros((width, height), dtype=np.uint16)
+
+    @classmethod
+    def from_arrays(cls, road, obstacle, destination, light):
+        """Index with the static layers copied from a CompiledCity, so the model can change them."""
+        cell_index = cls(*road.shape)
+        cell_index.road[:] = road
+        cell_index.obstacle[:] = obstacle
+        cell_index.destination[:] = destination
+        cell_index.light[:] = light
+        return cell_index
+
+    def in_bounds(self, pos):
+        return 0 <= pos[0] < self.width and 0 <= pos[1] < self.height
+
+    def set_road(self, pos, direction):
+        self.road[pos] = DIRECTION_CODES[direction]
+
+    def road_direction(self, pos):
+        """Direction of the road at pos, None if there is no road."""
+        return DIRECTION_NAMES[self.road[pos]]
+
+    def road_directions(self):
+        """Dictionary {(x, y): direction} with every road cell."""
+        return {(int(x), int(y)): DIRECTION_NAMES[self.road[x, y]] for x, y in zip(*np.nonzero(self.road))}
+
+    def cell_number(self, pos):
+        """Index of the character of pos in the city file (row-major, first row at the top), used in the static ids."""
+        return (self.height - pos[1] - 1) * self.width + pos[0]
+
+    def road_view(self, pos):
+        """Road view of pos, None if there is no road."""
+        direction = self.road_direction(pos)
+        if direction is None:
+            return None
+        return Road(f"r_{self.cell_number(pos)}", pos, direction)
+
+    def static_views(self, pos):
+        """Views of the obstacle, destination and road at pos, in that order."""
+        views = []
+        if self.obstacle[pos]:
+            views.append(Obstacle(f"ob_{self.cell_number(pos)}", pos))
+        if self.destination[pos]:
+            views.append(Destination(f"d_{self.cell_number(pos)}", pos))
+        road = self.road_view(pos)
+        if road:
+            views.append(road)
+        return views
+
+    def static_cells(self):
+        """(x, y) of every cell with a road or an obstacle, in grid.coord_iter() order."""
+        return [tuple(pos) for pos in np.argwhere(self.road.astype(bool) | self.obstacle).tolist()]
+
+    def is_free(self, pos):
+        """True if pos is inside the grid and has no obstacle and no car."""
+        return self.in_bounds(pos) and not self.obstacle[pos] and not self.cars[pos]
+
+
+class IndexedMultiGrid(MultiGrid):
+    """
+    MultiGrid that keeps the car occupancy of a CellIndex up to date,
+    and reports car changes to a DeltaTracker if one is given and to the Wakeups of the model if it has them.
+    """
+    def __init__(self, width, height, torus, cell_index, deltas=None):
+        super().__init__(width, height, torus)
+        self.cell_index = cell_index
+        self.deltas = deltas
+        self.wakeups = None
+
+    def place_agent(self, agent, pos):
+        super().place_agent(agent, pos)
+        if isinstance(agent, Car):
+            self.cell_index.cars[pos] += 1
+            if self.deltas is not None:
+                self.deltas.car_spawned(str(agent.unique_id), pos, agent.current_direction)
+            if self.wakeups is not None:
+                self.wakeups.cell_changed(pos)
+
+    def remove_agent(self, agent):
+        pos = agent.pos
+        super().remove_agent(agent)
+        if isinstance(agent, Car):
+            self.cell_index.cars[pos] -= 1
+            if self.deltas is not None:
+                self.deltas.car_removed(str(agent.unique_id))
+            if self.wakeups is not None:
+                self.wakeups.cell_changed(pos)
+
+    def move_agent(self, agent, pos):
+        old_pos = agent.pos
+        super().remove_agent(agent)
+        super().place_agent(agent, pos)
+        if isinstance(agent, Car):
+            self.cell_index.cars[old_pos] -= 1
+            self.cell_index.cars[pos] += 1
+            if self.deltas is not None:
+                self.deltas.car_moved(str(agent.unique_id), pos, agent.current_direction)
+            if self.wakeups is not None:
+                self.wakeups.car_moved(agent, old_pos, pos)
@@ -0,0 +1,205 @@
+"""
+Checkpoints of the dynamic state of a CityModel: cars, lights, light controller, spawn queues, counters,
+scheduler order and random number generator. The static city is not stored, a checkpoint is restored on a model built
+from the same city, routing and engine. Restoring one and stepping forward gives the same steps as the run
+it was taken from.
+
+Caches (routes, next-hop fields) and the collected metrics are not part of a checkpoint:
+routes only depend on the static city, and metrics keep appending rows after a restore.
+"""
+import io
+import math
+import zipfile
+from collections import OrderedDict
+import numpy as np
+from agent import Car
+from cell_index import DIRECTION_CODES, DIRECTION_NAMES
+
+CHECKPOINT_VERSION = 1
+
+# Integer counters of CityModel stored in the "counters" array, in order
+COUNTERS = ("car_count", "cars_completed", "active_cars", "total_travel_time", "total_wait_steps", "total_episodes")
+
+
+def capture(model):
+    """Dictionary {name: numpy array} with the dynamic state of model."""
+    version, internal, gauss = model.random.getstate()
+    state = {
+        "version": np.array(CHECKPOINT_VERSION),
+        "city": np.array(model.city.key),
+        "engine": np.array("mesa" if model.engine is None else "vectorized"),
+        "steps": np.array([model.schedule.steps, model.schedule.time], dtype=np.int64),
+        "counters": np.array([getattr(model, name) for name in COUNTERS], dtype=np.int64),
+        "running": np.array(model.running),
+        "rng": np.array((version,) + internal, dtype=np.int64),
+        "rng_gauss": np.array(math.nan if gauss is None else gauss),
+        "lights": np.array([light.state for light in model.traffic_lights], dtype=bool)
+    }
+    for name, values in model.light_controller.checkpoint_state().items():
+        state[f"controller_{name}"] = values
+    for name, values in model.spawner.checkpoint_state().items():
+        state[f"spawner_{name}"] = values
+
+    if model.engine is not None:
+        for name, values in model.engine.checkpoint_state().items():
+            state[f"engine_{name}"] = values
+    else:
+        state.update(capture_cars(model))
+    return state
+
+
+def capture_cars(model):
+    """Car agents and scheduler order of a model run by the mesa engine."""
+    height = model.height
+    n_lights = len(model.traffic_lights)
+    light_index = {light.unique_id: i for i, light in enumerate(model.traffic_lights)}
+    destination_index = {destination.pos: i for i, destination in enumerate(model.destinations)}
+
+    cars = []
+    order = []
+    for agent in model.schedule.agents:
+        if isinstance(agent, Car):
+            number = int(agent.unique_id[len("car_"):])
+            cars.append((number, agent))
+            order.append(n_lights + number)
+        else:
+            order.append(light_index[agent.unique_id])
+
+    return {
+        "order": np.array(order, dtype=np.int64),
+        "car_ids": np.array([number for number, _ in cars], dtype=np.int64),
+        "car_cells": np.array([car.pos[0] * height + car.pos[1] for _, car in cars], dtype=np.int64),
+        "car_destinations": np.array([destination_index[car.destination.pos] for _, car in cars], dtype=np.int64),
+        "car_directions": np.array([DIRECTION_CODES[car.current_direction] if car.current_direction else 0
+                                    for _, car in cars], dtype=np.uint8),
+        "car_episodes_waiting": np.array([car.episodes_waiting for _, car in cars], dtype=np.int64),
+        "car_spawn_steps": np.array([car.spawn_step for _, car in cars], dtype=np.int64),
+        "car_wait_steps": np.array([car.wait_steps for _, car in cars], dtype=np.int64),
+        "car_path_lengths": np.array([len(car.path) for _, car in cars], dtype=np.int64),
+        "car_paths": np.array([x * height + y for _, car in cars for x, y in car.path], dtype=np.int64)
+    }
+
+
+def restore(model, state):
+    """Replaces the dynamic state of model with a state returned by capture."""
+    if int(state["version"]) != CHECKPOINT_VERSION:
+        raise ValueError(f"Unsupported checkpoint version {int(state['version'])}")
+    if str(state["city"]) != model.city.key:
+        raise ValueError("The checkpoint was taken on another city")
+    engine = "mesa" if model.engine is None else "vectorized"
+    if str(state["engine"]) != engine:
+        raise ValueError(f"The checkpoint was taken with the {state['engine']} engine, the model uses {engine}")
+
+    controller = model.light_controller
+    for light, light_state in zip(model.traffic_lights, state["lights"].tolist()):
+        controller.set_light(light, light_state)
+    controller.restore_state({name[len("controller_"):]: values for name, values in state.items()
+                              if name.startswith("controller_")})
+
+    model.spawner.restore_state({name[len("spawner_"):]: values for name, values in state.items()
+                                 if name.startswith("spawner_")})
+
+    if model.engine is not None:
+        model.engine.restore_state({name[len("engine_"):]: values for name, values in state.items()
+                                    if name.startswith("engine_")})
+    else:
+        restore_cars(model, state)
+
+    model.schedule.steps, model.schedule.time = state["steps"].tolist()
+    for name, value in zip(COUNTERS, state["counters"].tolist()):
+        setattr(model, name, value)
+    model.running = bool(state["running"])
+    rng = state["rng"].tolist()
+    gauss = float(state["rng_gauss"])
+    model.random.setstate((rng[0], tuple(rng[1:]), None if math.isnan(gauss) else gauss))
+    model.deltas.reset(model.schedule.steps)
+    if model.wakeups is not None:
+        model.wakeups.reset()
+
+
+def restore_cars(model, state):
+    """Rebuilds the Car agents and the scheduler order of a model run by the mesa engine."""
+    for agent in list(model.schedule.agents):
+        model.schedule.remove(agent)
+        if isinstance(agent, Car):
+            model.grid.remove_agent(agent)
+
+    ends = np.cumsum(state["car_path_lengths"]).tolist()
+    paths = state["car_paths"].tolist()
+    cars = {}
+    start = 0
+    for i, number in enumerate(state["car_ids"].tolist()):
+        car = Car(f"car_{number}", model, model.destinations[int(state["car_destinations"][i])])
+        car.path = [divmod(cell, model.height) for cell in paths[start:ends[i]]]
+        start = ends[i]
+        car.current_direction = DIRECTION_NAMES[int(state["car_directions"][i])]
+        car.episodes_waiting = int(state["car_episodes_waiting"][i])
+        car.spawn_step = int(state["car_spawn_steps"][i])
+        car.wait_steps = int(state["car_wait_steps"][i])
+        if model.profiler is not None:
+            model.profiler.instrument_car(car)
+        model.grid.place_agent(car, divmod(int(state["car_cells"][i]), model.height))
+        cars[number] = car
+
+    n_lights = len(model.traffic_lights)
+    for code in state["order"].tolist():
+        model.schedule.add(model.traffic_lights[code] if code < n_lights else cars[code - n_lights])
+
+
+def pack(state):
+    """Compressed bytes of a checkpoint state."""
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **state)
+    return buffer.getvalue()
+
+
+def unpack(data):
+    """Checkpoint state stored by pack. Raises ValueError if data is not a packed checkpoint."""
+    try:
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            return {name: arrays[name] for name in arrays.files}
+    except (OSError, EOFError, zipfile.BadZipFile) as e:
+        raise ValueError(f"Not a packed checkpoint: {e}")
+
+
+class CheckpointStore:
+    """
+    Packed checkpoints of a session keyed by session step, taken every interval steps.
+    When there are more than max_checkpoints the oldest ones are dropped, except the first.
+    """
+    def __init__(self, interval=0, max_checkpoints=256):
+        """
+        Args:
+            interval: Steps between automatic checkpoints, 0 to only take them on request
+            max_checkpoints: Largest number of checkpoints kept
+        """
+        self.interval = interval
+        self.max_checkpoints = max_checkpoints
+        self.checkpoints = OrderedDict()
+
+    def __len__(self):
+        return len(self.checkpoints)
+
+    def steps(self):
+        return list(self.checkpoints)
+
+    def due(self, step):
+        return self.interval > 0 and step % self.interval == 0 and step not in self.checkpoints
+
+    def add(self, step, data):
+        self.checkpoints[step] = data
+        self.checkpoints = OrderedDict(sorted(self.checkpoints.items()))
+        while len(self.checkpoints) > self.max_checkpoints:
+            del self.checkpoints[list(self.checkpoints)[1]]
+
+    def get(self, step):
+        return self.checkpoints.get(step)
+
+    def nearest(self, step):
+        """Latest checkpoint at or before step, as (step, data), or None."""
+        best = None
+        for checkpoint_step, data in self.checkpoints.items():
+            if checkpoint_step > step:
+                break
+            best = (checkpoint_step, data)
+        return best
@@ -0,0 +1,176 @@
+import hashlib
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from road_graph import RoadGraph
+from cell_index import DIRECTION_CODES, DIRECTION_NAMES, NO_LIGHT
+
+# Bump when the layout of the artifact or the parsing rules change, so old artifacts are rebuilt
+COMPILER_VERSION = 1
+
+CACHE_DIR = './city_files/compiled'
+
+ROAD_SYMBOLS = ["V", "^", ">", "<"]
+LIGHT_SYMBOLS = ["S", "s"]
+
+# Most compiled cities kept loaded by this process. The least recently used one is dropped first
+MAX_LOADED_CITIES = 8
+
+# Compiled cities already loaded by this process, by artifact key, least recently used first
+_loaded = OrderedDict()
+_loaded_lock = threading.Lock()
+
+
+class CompiledCity:
+    """
+    Arrays describing a city layout, indexed by (x, y) like CellIndex.
+    They are shared between every model built from the same file, so they are read-only.
+    """
+    def __init__(self, key, arrays):
+        self.key = key
+        self.width = int(arrays["width"])
+        self.height = int(arrays["height"])
+        # Direction code of the road in each cell (cell_index.DIRECTION_CODES)
+        self.road = arrays["road"]
+        self.obstacle = arrays["obstacle"]
+        self.destination = arrays["destination"]
+        # Index of the light in each cell in file order, NO_LIGHT if there is none
+        self.light = arrays["light"]
+        # (x, y) of every light in file order, and whether it is an "s" light (starts green)
+        self.light_cells = arrays["light_cells"]
+        self.light_short = arrays["light_short"]
+        # (x, y) of every destination, sorted like grid.coord_iter() visits them
+        self.destinations = arrays["destinations"]
+        # RoadGraph.adjacency and RoadGraph.legal
+        self.adjacency = arrays["adjacency"]
+        self.legal = arrays["legal"]
+
+        for array in (self.road, self.obstacle, self.destination, self.light, self.light_cells,
+                      self.light_short, self.destinations, self.adjacency, self.legal):
+            array.flags.writeable = False
+
+    def road_graph(self):
+        """New RoadGraph over the compiled adjacency, without compiling the edges again."""
+        directions = [DIRECTION_NAMES[code] for code in self.road.ravel().tolist()]
+        return RoadGraph.from_arrays(self.width, self.height, directions, self.adjacency, self.legal)
+
+
+def light_road_direction(lines, r, c, dataDictionary):
+    """Direction of the road under the light at row r, column c, taken from the first road next to it."""
+    if r > 0 and lines[r-1][c] in ["V", "^"]:
+        return dataDictionary[lines[r-1][c]]
+    elif r < len(lines)-1 and lines[r+1][c] in ["V", "^"]:
+        return dataDictionary[lines[r+1][c]]
+    elif c > 0 and lines[r][c-1] in [">", "<"]:
+        return dataDictionary[lines[r][c-1]]
+    elif c < len(lines[r])-1 and lines[r][c+1] in [">", "<"]:
+        return dataDictionary[lines[r][c+1]]
+    return "Up"
+
+
+def compile_city(lines, dataDictionary):
+    """
+    Parses the lines of a city file into the arrays of a CompiledCity.
+    Returns a dictionary of numpy arrays.
+    """
+    width = len(lines[0])-1
+    height = len(lines)
+
+    road = np.zeros((width, height), dtype=np.uint8)
+    obstacle = np.zeros((width, height), dtype=bool)
+    destination = np.zeros((width, height), dtype=bool)
+    light = np.full((width, height), NO_LIGHT, dtype=np.int32)
+    light_cells = []
+    light_short = []
+
+    for r, row in enumerate(lines):
+        y = height - r - 1
+        for c, col in enumerate(row):
+            if col in ROAD_SYMBOLS:
+                road[c, y] = DIRECTION_CODES[dataDictionary[col]]
+            elif col in LIGHT_SYMBOLS:
+                light[c, y] = len(light_cells)
+                light_cells.append((c, y))
+                light_short.append(col == "s")
+                road[c, y] = DIRECTION_CODES[light_road_direction(lines, r, c, dataDictionary)]
+            elif col == "#":
+                obstacle[c, y] = True
+            elif col == "D":
+                destination[c, y] = True
+                road[c, y] = DIRECTION_CODES["None"]
+
+    directions = {(int(x), int(y)): DIRECTION_NAMES[road[x, y]] for x, y in zip(*np.nonzero(road))}
+    road_graph = RoadGraph(width, height, directions)
+
+    return {
+        "width": np.array(width),
+        "height": np.array(height),
+        "road": road,
+        "obstacle": obstacle,
+        "destination": destination,
+        "light": light,
+        "light_cells": np.array(light_cells, dtype=np.int32).reshape(-1, 2),
+        "light_short": np.array(light_short, dtype=bool),
+        "destinations": np.argwhere(destination).astype(np.int32),
+        "adjacency": np.frombuffer(road_graph.adjacency, dtype=np.int32).copy(),
+        "legal": np.frombuffer(road_graph.legal, dtype=np.uint8).copy()
+    }
+
+
+def artifact_key(contents, dataDictionary):
+    """Hash of the city file contents, the road symbols and the compiler version."""
+    symbols = {symbol: dataDictionary[symbol] for symbol in ROAD_SYMBOLS}
+    digest = hashlib.sha1(contents)
+    digest.update(json.dumps(symbols, sort_keys=True).encode())
+    digest.update(str(COMPILER_VERSION).encode())
+    return digest.hexdigest()
+
+
+def load_city(path, dataDictionary, cache_dir=CACHE_DIR):
+    """
+    Returns the CompiledCity of the city file at path. It is read from the artifact cached in cache_dir
+    if the file did not change, and compiled (and cached) otherwise.
+    Args:
+        path: Path of the city file
+        dataDictionary: Contents of mapDictionary.json
+        cache_dir: Directory of the .npz artifacts, None to keep them only in memory
+    """
+    with open(path, 'rb') as cityFile:
+        contents = cityFile.read()
+    key = artifact_key(contents, dataDictionary)
+    with _loaded_lock:
+        if key in _loaded:
+            _loaded.move_to_end(key)
+            return _loaded[key]
+
+    artifact = os.path.join(cache_dir, f"{key}.npz") if cache_dir else None
+    arrays = None
+    if artifact and os.path.exists(artifact):
+        try:
+            with np.load(artifact, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError, KeyError):
+            # Truncated or stale artifact, compile it again
+            arrays = None
+
+    if arrays is None:
+        arrays = compile_city(io.TextIOWrapper(io.BytesIO(contents)).readlines(), dataDictionary)
+        if artifact:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temporary = f"{artifact}.{os.getpid()}.tmp.npz"
+                np.savez(temporary, **arrays)
+                os.replace(temporary, artifact)
+            except OSError as e:
+                print(f"Could not cache compiled city {path}: {e}")
+
+    city = CompiledCity(key, arrays)
+    with _loaded_lock:
+        _loaded[key] = city
+        # Models built from a dropped city keep their own reference to it
+        while len(_loaded) > MAX_LOADED_CITIES:
+            _loaded.popitem(last=False)
+    return city
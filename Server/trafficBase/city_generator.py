@@ -0,0 +1,121 @@
+"""
+Procedural city generator. Writes maps in the character format of city_files/ (<>^V roads, S/s lights,
+# obstacles, D destinations) of any size, as a grid of two-lane one-way streets inside a two-lane ring.
+
+Example:
+    python city_generator.py 500 500 --block 6 --destinations 0.1 --lights 1 --output city_files/generated/city_500.txt
+"""
+import argparse
+import os
+import numpy as np
+
+# Two lanes per street, like the streets of the base maps
+LANES = 2
+
+
+def street_starts(length, block):
+    """First lane of every interior street along an axis of the given length."""
+    starts = []
+    start = LANES + block
+    # Leave at least one full block between the last street and the ring
+    while start + LANES + block <= length - LANES:
+        starts.append(start)
+        start += block + LANES
+    return starts
+
+
+def generate_city(width, height, block=6, destination_density=0.1, light_ratio=1.0, seed=None):
+    """
+    Generates a city. Returns its lines, without line breaks.
+    The ring goes counterclockwise and the interior streets alternate their direction, so every road
+    can reach every other one. Interior crossings take the direction of the horizontal street.
+    Args:
+        width: Number of columns
+        height: Number of rows
+        block: Side of the blocks of buildings between streets (at least 2)
+        destination_density: Probability that a building cell next to a street is a destination
+        light_ratio: Fraction of the interior crossings with traffic lights
+        seed: Seed of the random choices
+    """
+    if block < 2:
+        raise ValueError("block must be at least 2")
+    if width < 2 * LANES + block or height < 2 * LANES + block:
+        raise ValueError(f"The city must be at least {2 * LANES + block} cells wide and high")
+
+    rng = np.random.default_rng(seed)
+    # Indexed [row, column], row 0 is the first line of the file
+    city = np.full((height, width), ord("#"), dtype=np.uint8)
+
+    # Ring: top rows go left, left columns go down, bottom rows go right, right columns go up
+    for lane in range(LANES):
+        city[lane, lane:width - lane] = ord("<")
+        city[lane:height - lane, lane] = ord("V")
+        city[height - lane - 1, lane:width - lane] = ord(">")
+        city[lane:height - lane, width - lane - 1] = ord("^")
+        city[lane, lane] = ord("V")
+        city[height - lane - 1, lane] = ord(">")
+        city[height - lane - 1, width - lane - 1] = ord("^")
+        city[lane, width - lane - 1] = ord("<")
+
+    columns = street_starts(width, block)
+    rows = street_starts(height, block)
+    inner = slice(LANES, -LANES)
+
+    for i, column in enumerate(columns):
+        city[inner, column:column + LANES] = ord("V") if i % 2 else ord("^")
+    for i, row in enumerate(rows):
+        city[row:row + LANES, inner] = ord("<") if i % 2 else ord(">")
+
+    # Lights on the cells that enter each crossing: S on the vertical streets, s on the horizontal ones
+    crossings = [(i, row, j, column) for i, row in enumerate(rows) for j, column in enumerate(columns)]
+    lit = rng.random(len(crossings)) < light_ratio
+    for (i, row, j, column), has_lights in zip(crossings, lit):
+        if not has_lights:
+            continue
+        entry_row = row - 1 if j % 2 else row + LANES
+        city[entry_row, column:column + LANES] = ord("S")
+        entry_column = column + LANES if i % 2 else column - 1
+        city[row:row + LANES, entry_column] = ord("s")
+
+    # Destinations on the building cells next to a street
+    buildings = city == ord("#")
+    roads = ~buildings
+    next_to_road = np.zeros_like(buildings)
+    next_to_road[1:, :] |= roads[:-1, :]
+    next_to_road[:-1, :] |= roads[1:, :]
+    next_to_road[:, 1:] |= roads[:, :-1]
+    next_to_road[:, :-1] |= roads[:, 1:]
+    candidates = buildings & next_to_road
+    destinations = candidates & (rng.random(city.shape) < destination_density)
+    if not destinations.any() and candidates.any():
+        destinations[tuple(np.argwhere(candidates)[0])] = True
+    city[destinations] = ord("D")
+
+    return [row.tobytes().decode() for row in city]
+
+
+def write_city(lines, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as cityFile:
+        cityFile.write("\n".join(lines) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a city file")
+    parser.add_argument("width", type=int)
+    parser.add_argument("height", type=int)
+    parser.add_argument("--block", type=int, default=6, help="Side of the blocks between streets")
+    parser.add_argument("--destinations", type=float, default=0.1, help="Density of destinations next to the streets")
+    parser.add_argument("--lights", type=float, default=1.0, help="Fraction of crossings with traffic lights")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True, help="Path of the city file")
+    args = parser.parse_args()
+
+    lines = generate_city(args.width, args.height, args.block, args.destinations, args.lights, args.seed)
+    write_city(lines, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Static layout of a city for the viewers, served by /map. It does not change after a model is built, so it is
+serialized and compressed once per compiled city and shared by every session on the same map.
+
+The layout is a JSON object with:
+- width, height: size of the grid
+- roads: one digit per cell with the cell_index.DIRECTION_CODES code of its road (0 where there is none),
+  by cell id x * height + y
+- obstacles, destinations: {"id", "x", "y"} of every cell, with the same ids as /getObstacles
+- lights: {"id", "x", "y"} of every traffic light, in the order of /getTrafficLights
+"""
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+
+MAP_VERSION = 1
+MAP_MIMETYPE = "application/json"
+
+# Most layouts kept serialized. The least recently served one is dropped first
+MAX_PAYLOADS = 8
+
+# MapPayloads of the cities already served, by CompiledCity.key, least recently served first
+_payloads = OrderedDict()
+_lock = threading.Lock()
+
+
+class MapPayload:
+    """
+    Serialized layout of a city: the JSON body, the same body compressed with gzip and the ETag of its content.
+    """
+    def __init__(self, layout):
+        """
+        Args:
+            layout: Dictionary with the layout, see the module docstring
+        """
+        self.layout = layout
+        self.body = json.dumps(layout, separators=(",", ":")).encode()
+        # mtime=0 keeps the compressed bytes the same for the same layout
+        self.compressed = gzip.compress(self.body, compresslevel=9, mtime=0)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+
+def cell_views(cell_index, mask, prefix):
+    return [{"id": f"{prefix}_{cell_index.cell_number((x, y))}", "x": x, "y": y}
+            for x, y in np.argwhere(mask).tolist()]
+
+
+def build_layout(model):
+    """Layout of the city of a CityModel, see the module docstring."""
+    cell_index = model.cell_index
+    return {
+        "version": MAP_VERSION,
+        "width": model.width,
+        "height": model.height,
+        "roads": "".join(str(code) for code in cell_index.road.reshape(-1).tolist()),
+        "obstacles": cell_views(cell_index, cell_index.obstacle, "ob"),
+        "destinations": cell_views(cell_index, cell_index.destination, "d"),
+        "lights": [{"id": light.unique_id, "x": light.pos[0], "y": light.pos[1]} for light in model.traffic_lights]
+    }
+
+
+def map_payload(model):
+    """MapPayload of the city of model, built the first time the city is served."""
+    key = model.city.key
+    with _lock:
+        payload = _payloads.get(key)
+        if payload is None:
+            payload = _payloads[key] = MapPayload(build_layout(model))
+            while len(_payloads) > MAX_PAYLOADS:
+                _payloads.popitem(last=False)
+        else:
+            _payloads.move_to_end(key)
+    return payload
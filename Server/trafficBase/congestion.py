@@ -0,0 +1,50 @@
+import numpy as np
+from cell_index import NO_LIGHT
+
+
+class CongestionCosts:
+    """
+    Live edge costs for RoadGraph.find_path and RoadGraph.repair_path in the "congestion" routing mode.
+    Entering a cell costs one step, plus the expected wait behind the cars in it and at its traffic light.
+    Cars and light phases only matter near the car, farther away they will have changed before it arrives.
+    """
+    def __init__(self, model, occupancy_weight=2, horizon=10, patience=3):
+        """
+        Args:
+            model: CityModel whose cars and lights are read
+            occupancy_weight: Expected steps lost for each car in a cell
+            horizon: Steps ahead in which the current cars and light phases are trusted
+            patience: Steps a blocked car waits without a detour before changing lanes and replanning
+        """
+        self.model = model
+        self.occupancy_weight = occupancy_weight
+        self.horizon = horizon
+        self.patience = patience
+        # Flat view indexed by road graph cell id
+        self.cars = model.cell_index.cars.reshape(-1)
+        lights = model.cell_index.light.reshape(-1)
+        self.light_of_cell = {int(cell): int(lights[cell]) for cell in np.flatnonzero(lights != NO_LIGHT)}
+
+    def light_wait(self, light, eta):
+        """Expected steps waiting at light for a car arriving in eta steps."""
+        period = light.timeToChange
+        if not self.model.light_controller.flips_in_step:
+            # Adaptive controllers: the phase is only known now
+            if eta < self.horizon:
+                return 0 if light.state else period / 2
+            return period / 4
+        until_change = period - self.model.schedule.steps % period
+        if eta < until_change:
+            return 0 if light.state else until_change - eta
+        # Unknown phase: red half of the time, half of the red phase left on average
+        return period / 4
+
+    def __call__(self, g, cell):
+        """Cost of entering cell after g steps of route."""
+        cost = 1
+        if g < self.horizon:
+            cost += self.occupancy_weight * int(self.cars[cell])
+        light = self.light_of_cell.get(cell)
+        if light is not None:
+            cost += self.light_wait(self.model.traffic_lights[light], g)
+        return cost
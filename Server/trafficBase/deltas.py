@@ -0,0 +1,148 @@
+import threading
+from collections import deque
+
+
+class DeltaTracker:
+    """
+    Keeps the current state of the cars and traffic lights and the changes of each step, recorded as they happen.
+    Viewers read the state or the per-step deltas instead of walking the grid.
+
+    The model changes the current state while it steps, without locking. Viewers only read the copy of the
+    state taken at the last commit, under condition, so they never see a step half applied.
+    """
+    def __init__(self, history=256):
+        """
+        Args:
+            history: Number of committed step deltas kept for viewers that fall behind
+        """
+        # Current state: car id -> (x, y, direction) and light id -> (x, y, state)
+        self.cars = {}
+        self.lights = {}
+
+        # Changes of the step in progress
+        self.spawned = {}
+        self.moved = {}
+        self.removed = set()
+        self.toggled = {}
+
+        self.step = 0
+        self.history = deque(maxlen=history)
+        self.condition = threading.Condition()
+        # Copies of cars and lights at the last commit, replaced (never changed) under condition
+        self.committed_cars = {}
+        self.committed_lights = {}
+
+    def car_spawned(self, car_id, pos, direction):
+        self.cars[car_id] = (pos[0], pos[1], direction)
+        self.spawned[car_id] = self.cars[car_id]
+
+    def car_moved(self, car_id, pos, direction):
+        self.cars[car_id] = (pos[0], pos[1], direction)
+        if car_id in self.spawned:
+            self.spawned[car_id] = self.cars[car_id]
+        else:
+            self.moved[car_id] = self.cars[car_id]
+
+    def car_removed(self, car_id):
+        self.cars.pop(car_id, None)
+        if self.spawned.pop(car_id, None) is None:
+            self.moved.pop(car_id, None)
+            self.removed.add(car_id)
+
+    def light_added(self, light_id, pos, state):
+        self.lights[light_id] = (pos[0], pos[1], state)
+
+    def light_toggled(self, light_id, state):
+        x, y, _ = self.lights[light_id]
+        self.lights[light_id] = (x, y, state)
+        if self.toggled.pop(light_id, None) is None:
+            self.toggled[light_id] = state
+
+    def commit(self, step):
+        """Closes the changes of a step and wakes up the viewers waiting for it."""
+        delta = {
+            "step": step,
+            "spawned": [car_json(car_id, car) for car_id, car in self.spawned.items()],
+            "moved": [car_json(car_id, car) for car_id, car in self.moved.items()],
+            "removed": list(self.removed),
+            "lights": [{"id": light_id, "state": state} for light_id, state in self.toggled.items()]
+        }
+        self.spawned = {}
+        self.moved = {}
+        self.removed = set()
+        self.toggled = {}
+
+        with self.condition:
+            self.history.append(delta)
+            self.publish(step)
+        return delta
+
+    def publish(self, step):
+        """
+        Makes the current state the one read by the viewers as the state of step, keeping the changes in
+        progress. Called by commit and reset, and once the model is built, before its first step.
+        """
+        with self.condition:
+            self.step = step
+            self.committed_cars = dict(self.cars)
+            self.committed_lights = dict(self.lights)
+            self.condition.notify_all()
+
+    def reset(self, step):
+        """
+        Drops the changes in progress and the history, after the state was replaced (for example by
+        restoring a checkpoint). Viewers that were following the deltas get a new snapshot.
+        """
+        self.spawned = {}
+        self.moved = {}
+        self.removed = set()
+        self.toggled = {}
+        with self.condition:
+            self.history.clear()
+            self.publish(step)
+
+    def committed(self):
+        """(step, cars, lights) of the last commit. The dictionaries are never changed, only replaced."""
+        with self.condition:
+            return self.step, self.committed_cars, self.committed_lights
+
+    def snapshot(self):
+        """Full state of the cars and lights at the last commit."""
+        step, cars, lights = self.committed()
+        return {
+            "step": step,
+            "cars": [car_json(car_id, car) for car_id, car in cars.items()],
+            "lights": [light_json(light_id, light) for light_id, light in lights.items()]
+        }
+
+    def deltas_since(self, step):
+        """
+        Deltas of the steps after step, or None if some of them are no longer in the history
+        or the state went back before step.
+        """
+        with self.condition:
+            if self.step < step:
+                return None
+            deltas = [delta for delta in self.history if delta["step"] > step]
+            if self.step > step and (not deltas or deltas[0]["step"] != step + 1):
+                return None
+            return deltas
+
+    def wait_for_step(self, step, timeout=None):
+        """
+        Blocks until a step after step is committed, the state is reset to another step or timeout seconds pass.
+        Returns the last committed step.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.step != step, timeout)
+            return self.step
+
+
+def car_json(car_id, car):
+    x, y, direction = car
+    return {"id": car_id, "x": x, "y": y, "direction": direction}
+
+
+def light_json(light_id, light):
+    x, y, state = light
+    return {"id": light_id, "x": x, "y": y, "state": state}
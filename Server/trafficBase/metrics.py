@@ -0,0 +1,173 @@
+"""
+Columnar storage of the step metrics and trip records of CityModel.
+
+Every column is a preallocated numpy array filled row by row. Without a file the columns double their
+size when they are full; with one, every full chunk is appended to a CSV or Parquet file and its memory
+reused, so long runs keep a bounded amount of rows in memory.
+"""
+import csv
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 4096
+
+FILE_FORMATS = ("csv", "parquet")
+
+# One row per car that reached its destination
+TRIP_COLUMNS = {
+    "car": np.int64,
+    "spawn_step": np.int64,
+    "completion_step": np.int64,
+    "wait_steps": np.int64
+}
+
+
+class ColumnStore:
+    """
+    Table of typed columns that grows by rows.
+    """
+    def __init__(self, columns, chunk_size=DEFAULT_CHUNK_SIZE, path=None, file_format=None):
+        """
+        Args:
+            columns: Dictionary {name: numpy dtype} with the columns, in order
+            chunk_size: Rows preallocated at a time (at least 2)
+            path: File where the full chunks are written. None keeps every row in memory
+            file_format: "csv" or "parquet", None to take it from the extension of path
+        """
+        if chunk_size < 2:
+            raise ValueError("chunk_size must be at least 2")
+        if file_format is None and path is not None:
+            file_format = "parquet" if path.endswith(".parquet") else "csv"
+        if path is not None and file_format not in FILE_FORMATS:
+            raise ValueError(f"Unknown metrics file format: {file_format}")
+
+        self.path = path
+        self.file_format = file_format
+        self.data = {name: np.zeros(chunk_size, dtype=dtype) for name, dtype in columns.items()}
+        self.capacity = chunk_size
+        # Rows in memory, and how many of them are already in the file
+        self.length = 0
+        self.written = 0
+        self.rows_flushed = 0
+        self.parquet_writer = None
+
+    def __len__(self):
+        """Rows stored so far, in memory or in the file."""
+        return self.rows_flushed + self.length - self.written
+
+    def __getitem__(self, name):
+        """View of the rows of a column that are in memory. The last one is always the latest row."""
+        return self.data[name][:self.length]
+
+    @property
+    def names(self):
+        return list(self.data)
+
+    def append(self, *values):
+        """Adds one row with a value per column, in column order."""
+        if self.length == self.capacity:
+            self.make_room()
+        for column, value in zip(self.data.values(), values):
+            column[self.length] = value
+        self.length += 1
+
+    def extend(self, *columns):
+        """Adds one row per element of the columns, given in column order."""
+        count = len(columns[0])
+        done = 0
+        while done < count:
+            if self.length == self.capacity:
+                self.make_room()
+            take = min(count - done, self.capacity - self.length)
+            for column, values in zip(self.data.values(), columns):
+                column[self.length:self.length + take] = values[done:done + take]
+            self.length += take
+            done += take
+
+    def make_room(self):
+        if self.path is not None:
+            self.flush()
+            return
+        self.capacity *= 2
+        for name, column in self.data.items():
+            grown = np.zeros(self.capacity, dtype=column.dtype)
+            grown[:self.length] = column[:self.length]
+            self.data[name] = grown
+
+    def flush(self):
+        """
+        Appends the rows not written yet to the file and frees their memory.
+        The latest row stays in memory, so it can still be read.
+        """
+        if self.path is None or self.written == self.length:
+            return
+        rows = {name: column[self.written:self.length] for name, column in self.data.items()}
+        if self.file_format == "parquet":
+            self.write_parquet(rows)
+        else:
+            self.write_csv(rows)
+        self.rows_flushed += self.length - self.written
+
+        for column in self.data.values():
+            column[0] = column[self.length - 1]
+        self.length = self.written = 1
+
+    def write_csv(self, rows):
+        first = self.rows_flushed == 0
+        with open(self.path, "w" if first else "a", newline="") as output:
+            writer = csv.writer(output)
+            if first:
+                writer.writerow(rows)
+            writer.writerows(zip(*(values.tolist() for values in rows.values())))
+
+    def write_parquet(self, rows):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Writing metrics to Parquet needs pyarrow, install it or use the csv format")
+        table = pyarrow.table(rows)
+        if self.parquet_writer is None:
+            self.parquet_writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.parquet_writer.write_table(table)
+
+    def close(self):
+        """Writes the remaining rows and closes the file."""
+        self.flush()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+
+
+class ColumnarDataCollector:
+    """
+    Model reporters of mesa's DataCollector kept in a ColumnStore, one float column per reporter
+    plus the step of each row. model_vars gives the same access by label that ChartModule uses.
+    """
+    def __init__(self, model_reporters, chunk_size=DEFAULT_CHUNK_SIZE, path=None, file_format=None):
+        """
+        Args:
+            model_reporters: Dictionary {label: function of the model}
+            chunk_size: Rows preallocated at a time
+            path: File where the rows are written in chunks, None to keep them in memory
+            file_format: "csv" or "parquet", None to take it from the extension of path
+        """
+        self.model_reporters = model_reporters
+        columns = {"step": np.int64}
+        columns.update({label: np.float64 for label in model_reporters})
+        self.store = ColumnStore(columns, chunk_size, path, file_format)
+
+    def collect(self, model):
+        self.store.append(model.schedule.steps, *(reporter(model) for reporter in self.model_reporters.values()))
+
+    @property
+    def model_vars(self):
+        """Dictionary {label: column} with the rows in memory."""
+        return {label: self.store[label] for label in self.model_reporters}
+
+    def get_model_vars_dataframe(self):
+        """pandas DataFrame with the rows in memory, indexed by step."""
+        import pandas as pd
+        return pd.DataFrame(self.model_vars, index=pd.Index(self.store["step"], name="step"))
+
+    def close(self):
+        self.store.close()
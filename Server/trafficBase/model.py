@@ -1,115 +1,188 @@
 from mesa import Model
 from mesa.time import RandomActivation
-from mesa.space import MultiGrid
 from agent import *
+from road_graph import RouteCache, NextHopFields
+from road_hierarchy import RoadHierarchy
+from cell_index import CellIndex, IndexedMultiGrid
+from city_compiler import load_city
+from congestion import CongestionCosts
+from traffic_control import LIGHT_CONTROLLERS
+from profiling import StepProfiler
+from parallel_moves import MoveResolver, step_agents
+from spawning import Spawner
+from wakeups import Wakeups
+import checkpoint
+from metrics import ColumnarDataCollector, ColumnStore, TRIP_COLUMNS, DEFAULT_CHUNK_SIZE
+from vectorized_engine import VectorizedEngine
+from deltas import DeltaTracker
 import json
-from mesa.datacollection import DataCollector
+import os
+from time import perf_counter
 
 class CityModel(Model):
-    def __init__(self, N):
+    def __init__(self, N, city_file="2024_base.txt", light_timings=None, spawn_interval=10,
+                 routing="astar", engine="mesa", seed=None, light_control="fixed", profile=False,
+                 metrics_path=None, metrics_format="csv", metrics_chunk_size=DEFAULT_CHUNK_SIZE,
+                 step_mode="sequential", spawn=None, wakeups=False):
+        """
+        Creates the city.
+        Args:
+            N: Largest number of cars in the city at the same time, 0 for no limit
+            city_file: City layout, a file name in city_files/ or a path
+            light_timings: Dictionary {"S": steps, "s": steps} overriding the light timings of mapDictionary.json
+            spawn_interval: Number of steps between car spawns with the default interval demand
+            routing: "astar" to route each car with A* over the road graph, "next_hop"
+                     to precompute one next-hop field per destination at startup, "congestion"
+                     to route with live occupancy and light waits and detour around blocked cells, or
+                     "hierarchical" to search routes over the intersections and streets of the city
+                     (see road_hierarchy), "hierarchical_ch" with contraction hierarchy shortcuts
+            engine: "mesa" to step a Car agent per car with the scheduler, or "vectorized"
+                    to advance every car at once with the headless engine (no Car agents)
+            seed: Seed of the model's random number generator
+            light_control: Traffic light controller, a key of traffic_control.LIGHT_CONTROLLERS: "fixed" timings
+                           (the default), "green_wave", "actuated" or "max_pressure"
+            profile: Record the wall time of the phases of every step and count the hot-path calls
+                     (see profiling.StepProfiler). Off by default, when it costs nothing
+            metrics_path: Prefix of the files where the step metrics ({prefix}_steps) and the trip records
+                          ({prefix}_trips) are written in chunks. None keeps them in memory
+            metrics_format: "csv" or "parquet" (needs pyarrow)
+            metrics_chunk_size: Rows of metrics and trips kept in memory before they are written
+            step_mode: "sequential" to move the cars one by one in random order like RandomActivation, or
+                       "synchronous" to let every car propose a move from the state at the start of the step
+                       and grant them by priority (see parallel_moves). Congestion routing needs "sequential"
+            spawn: Dictionary with the options of spawning.Spawner: origins, demand profile, origin-destination
+                   matrix, spawn queue and stop conditions. By default a car enters at each corner every
+                   spawn_interval steps and the run stops when none can
+            wakeups: Let the cars that wait for a light or a free cell and the fixed-time lights sleep until
+                     an event can change what they do (see wakeups). Runs are the same. Mesa engine only
+        """
+        if seed is not None:
+            self.reset_randomizer(seed)
+
         with open('./city_files/mapDictionary.json') as mapDictionary:
             dataDictionary = json.load(mapDictionary)
-            
+        if light_timings:
+            dataDictionary.update(light_timings)
+
+        self.city_file = city_file
+        self.spawn_interval = spawn_interval
         self.traffic_lights = []
         self.car_count = 0
         self.cars_completed = 0
-        self.destinations = []
+        self.active_cars = 0
+        self.total_travel_time = 0
+        self.total_wait_steps = 0
+        # Car and light changes of every step, for the viewers
+        self.deltas = DeltaTracker()
+        self.wakeups = None
         self.total_episodes = 0
 
-        self.datacollector = DataCollector(
-            model_reporters={
-                "Active Cars": lambda m: len([a for a in m.schedule.agents if isinstance(a, Car)]),
-                "Completed Cars": lambda m: m.cars_completed,
-                "Average Completed Cars": lambda m: m.cars_completed / m.total_episodes
-            }
-        )
-        
-        # Define valid road directions based on neighbor position
-        neighbor_to_road_direction = {
-            "above": "Down",  # If neighbor is above, road should point down
-            "below": "Up",    # If neighbor is below, road should point up
-            "left": "Right",  # If neighbor is left, road should point right
-            "right": "Left"   # If neighbor is right, road should point left
+        model_reporters = {
+            "Active Cars": lambda m: m.active_cars,
+            "Completed Cars": lambda m: m.cars_completed,
+            "Average Completed Cars": lambda m: m.cars_completed / m.total_episodes,
+            "Mean Travel Time": lambda m: m.total_travel_time / m.cars_completed if m.cars_completed else 0,
+            "Mean Wait Steps": lambda m: m.total_wait_steps / m.cars_completed if m.cars_completed else 0,
+            "Queued Cars": lambda m: m.spawner.queued,
+            "Dropped Cars": lambda m: m.spawner.dropped,
+            "Route Cache Hits": lambda m: m.route_cache.hits,
+            "Route Cache Misses": lambda m: m.route_cache.misses
         }
+        if profile:
+            # Values of the steps before the one being collected
+            model_reporters.update({
+                "Step Seconds": lambda m: m.profiler.last_step_seconds,
+                "A* Calls": lambda m: m.profiler.counts["astar_calls"],
+                "A* Expansions": lambda m: m.road_graph.expansions,
+                "A* Seconds": lambda m: m.profiler.seconds["astar"],
+                "Validity Checks": lambda m: m.profiler.counts["validity_checks"],
+                "Lane Change Fallbacks": lambda m: m.profiler.counts["lane_change_fallbacks"],
+                "Random Move Fallbacks": lambda m: m.profiler.counts["random_move_fallbacks"]
+            })
+        steps_path = trips_path = None
+        if metrics_path is not None:
+            steps_path = f"{metrics_path}_steps.{metrics_format}"
+            trips_path = f"{metrics_path}_trips.{metrics_format}"
+        self.datacollector = ColumnarDataCollector(model_reporters, metrics_chunk_size, steps_path, metrics_format)
+        # One row per car that reached its destination, see metrics.TRIP_COLUMNS
+        self.trips = ColumnStore(TRIP_COLUMNS, metrics_chunk_size, trips_path, metrics_format)
+        
+        city = load_city(os.path.join('./city_files', city_file), dataDictionary)
+        self.city = city
+        self.width = city.width
+        self.height = city.height
 
-        with open('./city_files/2024_base.txt') as baseFile:
-            lines = baseFile.readlines()
-            self.width = len(lines[0])-1
-            self.height = len(lines)
-
-            self.grid = MultiGrid(self.width, self.height, torus = False) 
-            self.schedule = RandomActivation(self)
-
-            for r, row in enumerate(lines):
-                for c, col in enumerate(row):
-                    if col in ["V", "^", ">", "<"]:
-                        agent = Road(f"r_{r*self.width+c}", self, dataDictionary[col])
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                    elif col in ["S", "s"]:
-                        agent = Traffic_Light(f"tl_{r*self.width+c}", self, False if col == "S" else True, int(dataDictionary[col]))
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        self.schedule.add(agent)
-                        self.traffic_lights.append(agent)
-                        
-                        road_direction = "Up"
-                        if r > 0 and lines[r-1][c] in ["V", "^"]:
-                            road_direction = dataDictionary[lines[r-1][c]]
-                        elif r < len(lines)-1 and lines[r+1][c] in ["V", "^"]:
-                            road_direction = dataDictionary[lines[r+1][c]]
-                        elif c > 0 and lines[r][c-1] in [">", "<"]:
-                            road_direction = dataDictionary[lines[r][c-1]]
-                        elif c < len(lines[r])-1 and lines[r][c+1] in [">", "<"]:
-                            road_direction = dataDictionary[lines[r][c+1]]
-                        
-                        if road_direction:
-                            road = Road(f"r_{r*self.width+c}", self, road_direction)
-                            self.grid.place_agent(road, (c, self.height - r - 1))
-
-                    elif col == "#":
-                        agent = Obstacle(f"ob_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                    elif col == "D":
-                        agent = Destination(f"d_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        
-                        road_direction = "Right"  # Default direction
-                        road_symbols = ["V", "^", ">", "<"]
-                        
-                        # Check all neighboring cells
-                        neighbors = {
-                            "above": (r > 0, r-1, c, lines[r-1][c] if r > 0 else None),
-                            "below": (r < len(lines)-1, r+1, c, lines[r+1][c] if r < len(lines)-1 else None),
-                            "left": (c > 0, r, c-1, lines[r][c-1] if c > 0 else None),
-                            "right": (c < len(lines[r])-1, r, c+1, lines[r][c+1] if c < len(lines[r])-1 else None)
-                        }
-                        
-                        # Find first valid neighbor with a road
-                        for position, (is_valid, nr, nc, symbol) in neighbors.items():
-                            if is_valid and symbol in road_symbols:
-                                road_direction = neighbor_to_road_direction[position]
-                                break
-                        
-                        road = Road(f"r_{r*self.width+c}", self, "None")
-                        self.grid.place_agent(road, (c, self.height - r - 1))
+        # Roads, obstacles and destinations are not agents, they are only kept in the cell index
+        self.cell_index = CellIndex.from_arrays(city.road, city.obstacle, city.destination, city.light)
+        self.grid = IndexedMultiGrid(self.width, self.height, False, self.cell_index, self.deltas)
+        self.schedule = RandomActivation(self)
+
+        for (x, y), short in zip(city.light_cells.tolist(), city.light_short.tolist()):
+            agent = Traffic_Light(f"tl_{self.cell_index.cell_number((x, y))}", self, short, int(dataDictionary["s" if short else "S"]))
+            self.grid.place_agent(agent, (x, y))
+            self.schedule.add(agent)
+            self.traffic_lights.append(agent)
+            self.deltas.light_added(agent.unique_id, agent.pos, agent.state)
+
+        self.road_graph = city.road_graph()
 
         self.num_agents = N
         self.running = True
 
-        for cell in self.grid.coord_iter():
-            cell_content = cell[0]
-            for agent in cell_content:
-                if isinstance(agent, Destination):
-                    self.destinations.append(agent)
+        # Compiled in the order grid.coord_iter() visits the cells
+        self.destinations = [Destination(f"d_{self.cell_index.cell_number((x, y))}", (x, y))
+                             for x, y in city.destinations.tolist()]
+
+        self.next_hops = None
+        self.congestion = None
+        self.hierarchy = None
+        if routing == "next_hop":
+            self.next_hops = NextHopFields(self.road_graph, [destination.pos for destination in self.destinations])
+        elif routing == "congestion":
+            self.congestion = CongestionCosts(self)
+        elif routing in ("hierarchical", "hierarchical_ch"):
+            landmarks = [light.pos for light in self.traffic_lights] + [destination.pos for destination in self.destinations]
+            self.hierarchy = RoadHierarchy(self.road_graph, landmarks, shortcuts=routing == "hierarchical_ch")
+        elif routing != "astar":
+            raise ValueError(f"Unknown routing mode: {routing}")
+        # Routes of the cars without next-hop fields, searched by the hierarchy if there is one
+        self.route_cache = RouteCache(self.road_graph, router=self.hierarchy)
+
+        if light_control not in LIGHT_CONTROLLERS:
+            raise ValueError(f"Unknown light controller: {light_control}")
+        self.light_controller = LIGHT_CONTROLLERS[light_control](self)
+
+        spawn_options = {"max_active": N}
+        spawn_options.update(spawn or {})
+        self.spawner = Spawner(self, **spawn_options)
+
+        self.move_resolver = None
+        if step_mode == "synchronous":
+            if self.congestion is not None:
+                raise ValueError("Congestion routing detours around the cars as they move, use the sequential step mode")
+            self.move_resolver = MoveResolver(self)
+        elif step_mode != "sequential":
+            raise ValueError(f"Unknown step mode: {step_mode}")
 
+        self.engine = None
+        if engine == "vectorized":
+            self.engine = VectorizedEngine(self)
+        elif engine != "mesa":
+            raise ValueError(f"Unknown engine: {engine}")
+
+        self.profiler = StepProfiler(self) if profile else None
+
+        if wakeups:
+            if self.engine is not None:
+                raise ValueError("The vectorized engine does not step agents, wakeups need the mesa engine")
+            if self.congestion is not None:
+                raise ValueError("Congestion routing plans the waiting cars again every step, it cannot use wakeups")
+            self.wakeups = Wakeups(self)
+            self.grid.wakeups = self.wakeups
+
+        # Viewers read the state as of the last commit, which is the initial state until the first step
+        self.deltas.publish(self.schedule.steps)
 
-        destinations = []
-        for cell in self.grid.coord_iter():
-            cell_content = cell[0]
-            for agent in cell_content:
-                if isinstance(agent, Destination):
-                    destinations.append(agent)
         """
         destination = self.random.choice(self.destinations)
         car0 = Car(f"car_{self.car_count}", self, destination)
@@ -119,33 +192,70 @@ class CityModel(Model):
         """
         
             
+    def add_car(self, pos, destination):
+        """Creates a car at pos heading to destination."""
+        if self.engine is not None:
+            self.engine.add_car(pos, destination)
+        else:
+            car = Car(f"car_{self.car_count}", self, destination)
+            if self.profiler is not None:
+                self.profiler.instrument_car(car)
+            self.grid.place_agent(car, pos)
+            self.schedule.add(car)
+        self.car_count += 1
+        self.active_cars += 1
+
+    def record_trip(self, car, spawn_step, wait_steps):
+        """Counts a car that reached its destination this step."""
+        self.cars_completed += 1
+        self.active_cars -= 1
+        self.total_travel_time += self.schedule.steps - spawn_step
+        self.total_wait_steps += wait_steps
+        self.trips.append(car, spawn_step, self.schedule.steps, wait_steps)
+
+    def checkpoint(self):
+        """Dictionary {name: numpy array} with the state needed to continue the run, see checkpoint.capture."""
+        return checkpoint.capture(self)
+
+    def restore(self, state):
+        """Goes back (or forward) to a state returned by checkpoint, taken on a model with the same settings."""
+        checkpoint.restore(self, state)
+
+    def close(self):
+        """Writes the metrics and trips still in memory to their files."""
+        self.datacollector.close()
+        self.trips.close()
+
     def step(self):
-        cars_spawned = False
-        # Spawn cars every 2 steps
-        if self.schedule.steps % 10 == 0 and self.destinations:
-            corners = [
-                (0, 0),                    # Bottom left
-                (0, self.height-1),        # Top left
-                (self.width-1, 0),         # Bottom right
-                (self.width-1, self.height-1) # Top right
-            ]
-            
-            for corner in corners:
-                # Check if position is empty
-                cell_contents = self.grid.get_cell_list_contents(corner)
-                if not any(isinstance(content, Car) for content in cell_contents):
-                    destination = self.random.choice(self.destinations)
-                    car = Car(f"car_{self.car_count}", self, destination)
-                    self.grid.place_agent(car, corner)
-                    self.schedule.add(car)
-                    self.car_count += 1
-                    cars_spawned = True
-
-        # stop if cars are not spawned when they should, every two steps
-        if not cars_spawned and self.schedule.steps % 10 == 0:
+        profiler = self.profiler
+        if profiler is not None:
+            step_start = phase_start = perf_counter()
+
+        stop = self.spawner.step()
+        if profiler is not None:
+            phase_start = profiler.lap("spawn", phase_start)
+        if stop:
             self.running = False
             return
-        
+
         self.total_episodes += 1
         self.datacollector.collect(self)  # Collect data
-        self.schedule.step()
\ No newline at end of file
+        if profiler is not None:
+            phase_start = profiler.lap("collect", phase_start)
+        self.light_controller.step()
+        if self.wakeups is not None:
+            self.wakeups.advance()
+        if profiler is not None:
+            phase_start = perf_counter()
+        if self.engine is not None:
+            self.engine.step()
+        elif self.move_resolver is not None:
+            step_agents(self)
+        else:
+            self.schedule.step()
+        if profiler is not None:
+            phase_start = profiler.lap("agents", phase_start)
+        self.deltas.commit(self.schedule.steps)
+        if profiler is not None:
+            profiler.lap("deltas", phase_start)
+            profiler.end_step(step_start)
@@ -0,0 +1,183 @@
+"""
+Two-phase car step, used by CityModel(step_mode="synchronous").
+
+With RandomActivation every car reads the grid left by the cars activated before it, so who gets a cell and
+which cars fall back to a lane change depends on the random order. In the synchronous step every car first
+proposes its next cell from the state at the start of the step (and the lights are switched before that).
+Then MoveResolver grants the cells by priority and all moves are applied at once:
+
+- Each cell goes to the proposing car that has waited the most steps, the oldest car on ties.
+- A granted car moves if its cell is empty or its occupant leaves in the same step, so queues advance together.
+- A car whose next cell holds a car that stays falls back to a lane change or a random free neighbor, like in
+  Car.move. Cars that only lost a cell to another car wait, the cell is still moving.
+"""
+import numpy as np
+from agent import Car
+
+
+class MoveResolver:
+    """
+    Grants the proposed moves of a step. Works on arrays of cell ids, so both engines share it.
+    """
+    def __init__(self, model):
+        """
+        Args:
+            model: CityModel whose cars are resolved
+        """
+        cell_index = model.cell_index
+        self.model = model
+        self.width = model.width
+        self.height = model.height
+        self.size = model.width * model.height
+        self.drivable = ((cell_index.road != 0) & ~cell_index.obstacle).reshape(-1)
+        self.road_names = [cell_index.road_direction(divmod(cell, self.height)) for cell in range(self.size)]
+
+    def priority_ranks(self, waits, ids):
+        """Rank of every car, 0 for the car that goes first."""
+        order = np.lexsort((ids, -waits))
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+        return ranks
+
+    def resolve(self, cells, targets, valid, leaving, waits, ids, closed=None):
+        """
+        Args:
+            cells: Cell id of every car at the start of the step. A car outside the grid has the cell id
+                   self.size: it takes no cell and never falls back (the sharded mode adds the cars of
+                   other tiles that ask for a cell of this one like that)
+            targets: Proposed cell id of every car, -1 if it has no move
+            valid: Whether each proposed move follows the turn rules and the lights
+            leaving: Cars that are at their destination and leave the grid this step
+            waits: Steps each car has waited without moving
+            ids: Car numbers, lower is older
+            closed: Mask of the cells no car can fall back to, None for none
+        Returns:
+            (new cell id of every car, -1 if it stays, mask of the cars that moved by a fallback)
+        """
+        n = len(cells)
+        new_cells = np.full(n, -1, dtype=np.int64)
+        fallback = np.zeros(n, dtype=bool)
+        if n == 0:
+            return new_cells, fallback
+        ranks = self.priority_ranks(waits, ids)
+        # One more bin for the cars outside the grid
+        bins = self.size + 1
+        occupancy = np.bincount(cells, minlength=bins)
+
+        # One winner per proposed cell, the proposing car with the lowest rank
+        proposing = np.flatnonzero((targets >= 0) & valid & ~leaving)
+        proposing = proposing[np.lexsort((ranks[proposing], targets[proposing]))]
+        first = np.ones(len(proposing), dtype=bool)
+        first[1:] = targets[proposing[1:]] != targets[proposing[:-1]]
+        winners = proposing[first]
+        winner_targets = targets[winners]
+
+        # A winner moves when its cell is left empty. Moving cars empty more cells, so grow the set until it stops
+        leaving_out = np.bincount(cells[leaving], minlength=bins)
+        moving = np.zeros(n, dtype=bool)
+        out = leaving_out
+        while True:
+            can_move = winners[occupancy[winner_targets] == out[winner_targets]]
+            if len(can_move) == np.count_nonzero(moving):
+                break
+            moving[can_move] = True
+            out = leaving_out + np.bincount(cells[moving], minlength=bins)
+        new_cells[moving] = targets[moving]
+
+        # Cars whose next cell keeps a car this step fall back, one by one by priority
+        has_target = (targets >= 0) & ~leaving & ~moving
+        stuck = np.flatnonzero(has_target & (cells < self.size))
+        stuck = stuck[occupancy[targets[stuck]] > out[targets[stuck]]]
+        if len(stuck):
+            after = occupancy - out + np.bincount(targets[moving], minlength=bins)
+            if closed is not None:
+                after[:self.size] += closed
+            after = after.tolist()
+            for car in stuck[np.argsort(ranks[stuck], kind="stable")].tolist():
+                cell = int(cells[car])
+                new_cell = self.fallback_cell(cell, after)
+                if new_cell is not None:
+                    after[cell] -= 1
+                    after[new_cell] += 1
+                    new_cells[car] = new_cell
+                    fallback[car] = True
+
+        return new_cells, fallback
+
+    def fallback_cell(self, cell, occupancy):
+        """Free adjacent lane of cell, or else a random free neighbor, like the fallbacks of Car.move. None if there is none."""
+        direction = self.road_names[cell]
+        if not direction:
+            return None
+        x, y = divmod(cell, self.height)
+        if direction in ["Left", "Right"]:
+            lanes = [(x, y + 1), (x, y - 1)]
+        else:
+            lanes = [(x + 1, y), (x - 1, y)]
+
+        profiler = self.model.profiler
+        for lane_x, lane_y in lanes:
+            if 0 <= lane_x < self.width and 0 <= lane_y < self.height:
+                lane = lane_x * self.height + lane_y
+                if self.drivable[lane] and not occupancy[lane]:
+                    if profiler is not None:
+                        profiler.count("lane_change_fallbacks")
+                    return lane
+
+        neighbors = [nx * self.height + ny
+                     for nx, ny in self.model.grid.get_neighborhood((x, y), moore=True, include_center=False)]
+        free = [neighbor for neighbor in neighbors if self.drivable[neighbor] and not occupancy[neighbor]]
+        if not free:
+            return None
+        if profiler is not None:
+            profiler.count("random_move_fallbacks")
+        return self.model.random.choice(free)
+
+
+def step_agents(model):
+    """
+    Synchronous step of the Traffic_Light and Car agents of a model run by the mesa engine.
+    Replaces model.schedule.step().
+    """
+    height = model.height
+    for light in model.traffic_lights:
+        light.step()
+
+    cars = [agent for agent in model.schedule.agents if isinstance(agent, Car)]
+    cells = np.array([car.pos[0] * height + car.pos[1] for car in cars], dtype=np.int64)
+    leaving = np.array([car.pos == car.destination.pos for car in cars], dtype=bool)
+    targets = np.full(len(cars), -1, dtype=np.int64)
+    valid = np.zeros(len(cars), dtype=bool)
+
+    # Phase 1: proposals, read from the state at the start of the step
+    for i, car in enumerate(cars):
+        if leaving[i]:
+            continue
+        next_pos, valid[i] = car.propose()
+        if next_pos is not None:
+            targets[i] = next_pos[0] * height + next_pos[1]
+
+    # Phase 2: grant the cells and apply every move
+    new_cells, fallback = model.move_resolver.resolve(
+        cells, targets, valid, leaving,
+        np.array([car.wait_steps for car in cars], dtype=np.int64),
+        np.array([int(car.unique_id[len("car_"):]) for car in cars], dtype=np.int64)
+    )
+    for i, car in enumerate(cars):
+        if leaving[i]:
+            car.arrive()
+        elif new_cells[i] < 0:
+            car.wait_steps += 1
+        elif fallback[i]:
+            model.grid.move_agent(car, divmod(int(new_cells[i]), height))
+            car.path = car.rejoin_path(car.path)
+            car.moved()
+        else:
+            car.current_direction = car.get_dir(car.pos, car.next_pos)
+            model.grid.move_agent(car, car.next_pos)
+            if car.path:
+                car.path.pop(0)
+            car.moved()
+
+    model.schedule.steps += 1
+    model.schedule.time += 1
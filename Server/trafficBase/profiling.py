@@ -0,0 +1,119 @@
+"""
+Optional per-step instrumentation of CityModel, enabled with CityModel(profile=True).
+
+When a model is built without it nothing is instrumented: the StepProfiler wraps the methods it times
+on the model's own objects (road graph, light controller and cars) when it is attached, so
+models that are not profiled run the original code.
+"""
+from time import perf_counter
+
+# Wall time of the phases of CityModel.step. astar, route_repair and validity_checks run inside agents
+PHASES = ("spawn", "collect", "lights", "agents", "deltas", "astar", "route_repair", "validity_checks")
+
+COUNTERS = (
+    "steps", "astar_calls", "route_repairs", "validity_checks", "lane_change_fallbacks",
+    "random_move_fallbacks", "car_sleeps", "stuck_cars"
+)
+
+PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class StepProfiler:
+    """
+    Accumulated wall time per phase of CityModel.step and counters of the hot paths of one model.
+    Every key exists from the start, so other threads can read the dictionaries while the model steps.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        # Wall time of the last complete step
+        self.last_step_seconds = 0.0
+
+        self.wrap(model.road_graph, "find_path", phase="astar", counter="astar_calls")
+        if model.hierarchy is not None:
+            # Hierarchical routes are searched instead of A* ones, they count in the same phase
+            self.wrap(model.hierarchy, "find_path", phase="astar", counter="astar_calls")
+        self.wrap(model.road_graph, "repair_path", phase="route_repair", counter="route_repairs")
+        # step_light runs when the Traffic_Light agents are activated, so its time is already in "agents"
+        self.wrap(model.light_controller, "step", phase="lights")
+
+    def wrap(self, target, name, phase=None, counter=None):
+        """Replaces the method name of target by one that adds its wall time to phase and counts its calls."""
+        method = getattr(target, name)
+        seconds = self.seconds
+        counts = self.counts
+
+        def instrumented(*args, **kwargs):
+            if counter:
+                counts[counter] += 1
+            if phase is None:
+                return method(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                seconds[phase] += perf_counter() - start
+
+        setattr(target, name, instrumented)
+
+    def instrument_car(self, car):
+        self.wrap(car, "is_valid_move", phase="validity_checks", counter="validity_checks")
+        self.wrap(car, "is_valid_cell", phase="validity_checks", counter="validity_checks")
+
+    def lap(self, phase, start):
+        """Adds the time since start to phase. Returns the current time, the start of the next phase."""
+        now = perf_counter()
+        self.seconds[phase] += now - start
+        return now
+
+    def count(self, counter, amount=1):
+        self.counts[counter] += amount
+
+    def end_step(self, start):
+        self.counts["steps"] += 1
+        self.last_step_seconds = perf_counter() - start
+
+    def snapshot(self):
+        """Copy of the timings and counters, with the A* expansions of the road graph."""
+        counts = dict(self.counts)
+        counts["astar_expansions"] = self.model.road_graph.expansions
+        return {"seconds": dict(self.seconds), "counts": counts, "last_step_seconds": self.last_step_seconds}
+
+
+def prometheus_metrics(models):
+    """
+    Prometheus text exposition of a dictionary {label: CityModel}. Models without a profiler
+    only report their step and car counters.
+    """
+    lines = [
+        "# HELP traffic_sessions Simulation sessions alive.",
+        "# TYPE traffic_sessions gauge",
+        f"traffic_sessions {len(models)}"
+    ]
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            lines.append(f"{name}{{{label_text}}} {value}")
+
+    family("traffic_model_steps_total", "counter", "Steps run by the model.",
+           [((("session", label),), model.schedule.steps) for label, model in models.items()])
+    family("traffic_active_cars", "gauge", "Cars driving in the model.",
+           [((("session", label),), model.active_cars) for label, model in models.items()])
+    family("traffic_completed_cars_total", "counter", "Cars that reached their destination.",
+           [((("session", label),), model.cars_completed) for label, model in models.items()])
+
+    profiled = {label: model.profiler.snapshot() for label, model in models.items() if model.profiler is not None}
+    family("traffic_phase_seconds_total", "counter", "Wall time spent in each phase of CityModel.step.",
+           [((("session", label), ("phase", phase)), f"{seconds:.6f}")
+            for label, snapshot in profiled.items() for phase, seconds in snapshot["seconds"].items()])
+    family("traffic_events_total", "counter", "Hot-path calls and fallbacks counted by the profiler.",
+           [((("session", label), ("event", event)), count)
+            for label, snapshot in profiled.items() for event, count in snapshot["counts"].items()])
+    family("traffic_last_step_seconds", "gauge", "Wall time of the last complete step.",
+           [((("session", label),), f"{snapshot['last_step_seconds']:.6f}") for label, snapshot in profiled.items()])
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,416 @@
+from array import array
+from collections import OrderedDict, deque
+from heapq import heappush, heappop
+
+# Order in which neighbors are expanded. It matches the order returned by
+# MultiGrid.get_neighborhood(moore=False), so paths tie-break the same way.
+NEIGHBOR_OFFSETS = ((-1, 0), (0, -1), (0, 1), (1, 0))
+MOVE_DIRECTIONS = ("Left", "Down", "Up", "Right")
+
+# Value of a next-hop field in cells that cannot reach the destination
+NO_ROUTE = 255
+
+OPPOSITE_DIRECTIONS = {
+    "Right": "Left",
+    "Left": "Right",
+    "Up": "Down",
+    "Down": "Up"
+}
+
+
+class RoadGraph:
+    """
+    Static directed road graph compiled once from the city layout.
+    Cells are numbered x * height + y, so comparing ids gives the same order as comparing (x, y) tuples.
+    """
+    def __init__(self, width, height, road_directions):
+        """
+        Compiles the road graph.
+        Args:
+            width: Width of the city grid
+            height: Height of the city grid
+            road_directions: Dictionary {(x, y): direction} with every road cell of the city
+        """
+        self.width = width
+        self.height = height
+        self.size = width * height
+
+        # Direction of the road in each cell, None where there is no road
+        self.directions = [None] * self.size
+        for (x, y), direction in road_directions.items():
+            self.directions[x * height + y] = direction
+
+        # Neighbor road cell for each of the four moves (-1 if there is none)
+        # and whether the move is allowed by the turn rules
+        self.adjacency = array('i', [-1] * (self.size * 4))
+        self.legal = bytearray(self.size * 4)
+        self.road_count = 0
+        self.edge_count = 0
+
+        for cell in range(self.size):
+            if self.directions[cell] is not None:
+                self.road_count += 1
+                self._compile_cell(cell)
+
+        # Number of nodes expanded by find_path since the graph was built
+        self.expansions = 0
+        # Incremented every time the static topology changes
+        self.version = 0
+
+    @classmethod
+    def from_arrays(cls, width, height, directions, adjacency, legal):
+        """
+        Builds the graph from edges compiled beforehand (see city_compiler).
+        Args:
+            width: Width of the city grid
+            height: Height of the city grid
+            directions: List with the direction of the road in each cell id, None where there is no road
+            adjacency: int32 buffer with the adjacency slots of every cell
+            legal: uint8 buffer with the legality of every adjacency slot
+        """
+        graph = cls.__new__(cls)
+        graph.width = width
+        graph.height = height
+        graph.size = width * height
+        graph.directions = directions
+        graph.adjacency = array('i', bytes(adjacency))
+        graph.legal = bytearray(bytes(legal))
+        graph.road_count = graph.size - directions.count(None)
+        graph.edge_count = sum(graph.legal)
+        graph.expansions = 0
+        graph.version = 0
+        return graph
+
+    def _compile_cell(self, cell):
+        """Fill the adjacency and legality slots of the edges leaving cell."""
+        x, y = divmod(cell, self.height)
+        current_direction = self.directions[cell]
+
+        for slot, (dx, dy) in enumerate(NEIGHBOR_OFFSETS):
+            index = cell * 4 + slot
+            if self.legal[index]:
+                self.edge_count -= 1
+            self.adjacency[index] = -1
+            self.legal[index] = 0
+
+            nx, ny = x + dx, y + dy
+            if current_direction is None or nx < 0 or nx >= self.width or ny < 0 or ny >= self.height:
+                continue
+            neighbor = nx * self.height + ny
+            next_direction = self.directions[neighbor]
+            if next_direction is None:
+                continue
+
+            self.adjacency[index] = neighbor
+            if self.is_legal_move(current_direction, next_direction, MOVE_DIRECTIONS[slot]):
+                self.legal[index] = 1
+                self.edge_count += 1
+
+    def set_road(self, pos, direction):
+        """
+        Changes the road at pos (None removes it) and recompiles the affected edges.
+        Bumps the graph version so cached routes are dropped.
+        """
+        cell = self.cell_id(pos)
+        if self.directions[cell] == direction:
+            return
+        self.road_count += (direction is not None) - (self.directions[cell] is not None)
+        self.directions[cell] = direction
+
+        x, y = pos
+        self._compile_cell(cell)
+        for dx, dy in NEIGHBOR_OFFSETS:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < self.width and 0 <= ny < self.height:
+                self._compile_cell(nx * self.height + ny)
+        self.version += 1
+
+    @staticmethod
+    def is_legal_move(current_direction, next_direction, move_direction):
+        """
+        Same traffic rules as Car.is_valid_move, without traffic lights.
+        """
+        if move_direction == next_direction:
+            return True
+        if next_direction == "None":
+            return True
+        return (next_direction != OPPOSITE_DIRECTIONS.get(move_direction) and
+                move_direction != OPPOSITE_DIRECTIONS.get(current_direction))
+
+    def cell_id(self, pos):
+        return pos[0] * self.height + pos[1]
+
+    def cell_pos(self, cell):
+        return divmod(cell, self.height)
+
+    def is_road(self, pos):
+        return self.directions[self.cell_id(pos)] is not None
+
+    def legal_neighbors(self, cell):
+        """Yield the road cells that can be reached from cell in one move."""
+        base = cell * 4
+        for slot in range(4):
+            if self.legal[base + slot]:
+                yield self.adjacency[base + slot]
+
+    def find_path(self, start, goal, cost=None):
+        """
+        A* over the road graph. Returns the list of positions from start to goal, or None.
+        Args:
+            start: Position where the route starts
+            goal: Position where the route ends
+            cost: Function cost(g, cell) with the cost of entering cell after g steps of route (at least 1),
+                  None for one per move
+        """
+        height = self.height
+        start_cell = self.cell_id(start)
+        goal_cell = self.cell_id(goal)
+        if self.directions[start_cell] is None:
+            return None
+
+        goal_x, goal_y = goal
+        adjacency = self.adjacency
+        legal = self.legal
+
+        open_set = []
+        heappush(open_set, (0, start_cell))
+        came_from = {}
+        g_score = {start_cell: 0}
+
+        while open_set:
+            current = heappop(open_set)[1]
+            self.expansions += 1
+
+            if current == goal_cell:
+                path = []
+                while current in came_from:
+                    path.append(divmod(current, height))
+                    current = came_from[current]
+                path.append(start)
+                path.reverse()
+                return path
+
+            tentative_g_score = g_score[current] + 1
+            base = current * 4
+            for slot in range(4):
+                if not legal[base + slot]:
+                    continue
+                neighbor = adjacency[base + slot]
+                if cost is not None:
+                    tentative_g_score = g_score[current] + cost(g_score[current], neighbor)
+
+                if neighbor not in g_score or tentative_g_score < g_score[neighbor]:
+                    came_from[neighbor] = current
+                    g_score[neighbor] = tentative_g_score
+                    nx, ny = divmod(neighbor, height)
+                    heappush(open_set, (tentative_g_score + abs(nx - goal_x) + abs(ny - goal_y), neighbor))
+
+        return None
+
+    def repair_path(self, start, path, cost=None, max_cost=float("inf"), max_expansions=32):
+        """
+        Detour from start around path[0], the blocked next cell of a route, that rejoins the route further on.
+        Bounded Dijkstra where reaching path[j] costs the detour plus the len(path) - 1 - j moves left after it.
+        Returns the new route without start, or None if no detour cheaper than max_cost is found
+        within max_expansions expanded cells.
+        Args:
+            start: Current position
+            path: Rest of the route, path[0] is the blocked cell
+            cost: Edge cost function, as in find_path
+            max_cost: Cost of keeping the route, for example waiting for path[0] to be free
+            max_expansions: Largest number of cells expanded by the search
+        """
+        height = self.height
+        adjacency = self.adjacency
+        legal = self.legal
+        start_cell = self.cell_id(start)
+        blocked = self.cell_id(path[0])
+        rejoin = {}
+        for j in range(len(path) - 1, 0, -1):
+            rejoin[self.cell_id(path[j])] = j
+
+        open_set = [(0, start_cell)]
+        came_from = {}
+        g_score = {start_cell: 0}
+        best = None
+        best_cost = max_cost
+        expanded = 0
+
+        while open_set:
+            g, current = heappop(open_set)
+            if g >= best_cost or expanded >= max_expansions:
+                break
+            if g > g_score[current]:
+                continue
+            expanded += 1
+            self.expansions += 1
+
+            if current in rejoin:
+                total = g + len(path) - 1 - rejoin[current]
+                if total < best_cost:
+                    best, best_cost = current, total
+                continue
+
+            base = current * 4
+            for slot in range(4):
+                if not legal[base + slot]:
+                    continue
+                neighbor = adjacency[base + slot]
+                if neighbor == blocked:
+                    continue
+                tentative_g_score = g + (1 if cost is None else cost(g, neighbor))
+                if neighbor not in g_score or tentative_g_score < g_score[neighbor]:
+                    came_from[neighbor] = current
+                    g_score[neighbor] = tentative_g_score
+                    heappush(open_set, (tentative_g_score, neighbor))
+
+        if best is None:
+            return None
+        detour = []
+        current = best
+        while current != start_cell:
+            detour.append(divmod(current, height))
+            current = came_from[current]
+        detour.reverse()
+        return detour + path[rejoin[best] + 1:]
+
+
+class RouteCache:
+    """
+    LRU cache of full routes shared by every car of a model, keyed by (origin, destination).
+    Routes only depend on the static road graph, so the cache is cleared when the graph version changes.
+    """
+    def __init__(self, road_graph, max_size=4096, router=None):
+        """
+        Args:
+            road_graph: RoadGraph of the routes
+            max_size: Maximum number of routes kept before evicting the least recently used one
+            router: Object whose find_path(origin, destination) computes the missing routes,
+                    the road graph itself (A* over the cells) by default
+        """
+        self.road_graph = road_graph
+        self.router = router if router is not None else road_graph
+        self.max_size = max_size
+        self.routes = OrderedDict()
+        self.version = road_graph.version
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.routes)
+
+    def invalidate(self):
+        self.routes.clear()
+        self.version = self.road_graph.version
+
+    def get(self, origin, destination):
+        """
+        Returns a new list with the route from origin to destination, or None if there is no route.
+        """
+        if self.version != self.road_graph.version:
+            self.invalidate()
+
+        key = (origin, destination)
+        if key in self.routes:
+            self.hits += 1
+            self.routes.move_to_end(key)
+            route = self.routes[key]
+        else:
+            self.misses += 1
+            route = self.router.find_path(origin, destination)
+            if route is not None:
+                route = tuple(route)
+            self.store(key, route)
+
+        return list(route) if route is not None else None
+
+    def unreachable(self, origin, destination):
+        """Whether the cache already knows there is no route from origin to destination. Never searches."""
+        if self.version != self.road_graph.version:
+            self.invalidate()
+        key = (origin, destination)
+        if key in self.routes and self.routes[key] is None:
+            self.hits += 1
+            self.routes.move_to_end(key)
+            return True
+        return False
+
+    def mark_unreachable(self, origin, destination):
+        """Remembers that a search found no route from origin to destination."""
+        self.store((origin, destination), None)
+
+    def store(self, key, route):
+        self.routes[key] = route
+        if len(self.routes) > self.max_size:
+            self.routes.popitem(last=False)
+
+
+class NextHopFields:
+    """
+    Precomputed routes to every destination: one reverse breadth-first search per destination at startup.
+    Each field stores one byte per cell with the neighbor slot of the next move (NO_ROUTE if unreachable),
+    so finding the next position of a car is a constant time lookup.
+    """
+    def __init__(self, road_graph, destinations):
+        """
+        Args:
+            road_graph: RoadGraph with the legal moves of the city
+            destinations: Positions of the destinations cars can go to
+        """
+        self.road_graph = road_graph
+        self.version = road_graph.version
+        self.destinations = list(destinations)
+        self.fields = {}
+        self.build()
+
+    def build(self):
+        graph = self.road_graph
+        # Reverse adjacency: for each cell, the (cell, slot) moves that end in it
+        predecessors = [[] for _ in range(graph.size)]
+        for cell in range(graph.size):
+            base = cell * 4
+            for slot in range(4):
+                if graph.legal[base + slot]:
+                    predecessors[graph.adjacency[base + slot]].append((cell, slot))
+
+        self.fields = {}
+        for destination in self.destinations:
+            field = bytearray([NO_ROUTE]) * graph.size
+            goal = graph.cell_id(destination)
+            visited = bytearray(graph.size)
+            visited[goal] = 1
+            frontier = deque([goal])
+
+            while frontier:
+                current = frontier.popleft()
+                for cell, slot in predecessors[current]:
+                    if not visited[cell]:
+                        visited[cell] = 1
+                        field[cell] = slot
+                        frontier.append(cell)
+
+            self.fields[destination] = field
+        self.version = graph.version
+
+    def next_position(self, pos, destination):
+        """
+        Returns the position a car at pos should move to in order to reach destination, or None if there is no route.
+        """
+        if self.version != self.road_graph.version:
+            self.build()
+
+        slot = self.fields[destination][self.road_graph.cell_id(pos)]
+        if slot == NO_ROUTE:
+            return None
+        dx, dy = NEIGHBOR_OFFSETS[slot]
+        return (pos[0] + dx, pos[1] + dy)
+
+    def distance(self, pos, destination):
+        """Number of moves from pos to destination following the field, or None if there is no route."""
+        steps = 0
+        while pos != destination:
+            pos = self.next_position(pos, destination)
+            if pos is None:
+                return None
+            steps += 1
+        return steps
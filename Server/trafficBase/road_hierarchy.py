@@ -0,0 +1,381 @@
+"""
+Hierarchical routing over the intersections of the road graph, the "hierarchical" and "hierarchical_ch"
+routing modes of CityModel.
+
+Most road cells of a city are in the middle of a street: every road around them goes the same way, so a car
+in them can only go forward or change lanes. Those cells are collapsed into segments, the shortest paths
+through the street between two nodes, weighted by their number of moves. The nodes are the other road cells:
+junctions (cells next to a road that goes another way), traffic lights and destinations.
+Routes are searched over the nodes and segments and expanded back into the cell paths that Car.move
+follows, so a query grows with the number of intersections instead of the grid area. Cars that start or
+end in the middle of a street reach the nodes of that street with a search limited to it.
+
+With shortcuts ("hierarchical_ch") the nodes are also contracted once at startup, contraction hierarchy
+style, and queries run a bidirectional Dijkstra that only goes up the hierarchy.
+Routes have the same length as the ones of RoadGraph.find_path, ties may be broken another way.
+"""
+from collections import deque
+from heapq import heapify, heappush, heappop
+
+from road_graph import NEIGHBOR_OFFSETS
+
+# Largest number of nodes settled by a witness search while contracting a node
+WITNESS_LIMIT = 64
+
+STREET_DIRECTIONS = ("Right", "Left", "Up", "Down")
+
+
+class RoadHierarchy:
+    """
+    Nodes and segments of a RoadGraph, optionally with contraction shortcuts.
+    Used as the router of a RouteCache: find_path has the signature of RoadGraph.find_path.
+    """
+    def __init__(self, road_graph, landmarks=(), shortcuts=False):
+        """
+        Args:
+            road_graph: RoadGraph of the city
+            landmarks: Positions that are always nodes, such as the traffic lights and the destinations
+            shortcuts: Contract the nodes and answer queries on the hierarchy of shortcuts
+        """
+        self.road_graph = road_graph
+        self.landmarks = [road_graph.cell_id(pos) for pos in landmarks]
+        self.shortcuts = shortcuts
+        # Number of nodes and street cells settled by find_path since the hierarchy was built
+        self.expansions = 0
+        self.build()
+
+    def build(self):
+        graph = self.road_graph
+        directions, height = graph.directions, graph.height
+
+        # Street cells: every road next to them goes their way
+        self.street = bytearray(graph.size)
+        for cell in range(graph.size):
+            direction = directions[cell]
+            if direction not in STREET_DIRECTIONS:
+                continue
+            x, y = divmod(cell, height)
+            self.street[cell] = all(
+                directions[(x + dx) * height + y + dy] in (None, direction)
+                for dx, dy in NEIGHBOR_OFFSETS
+                if 0 <= x + dx < graph.width and 0 <= y + dy < height
+            )
+        for cell in self.landmarks:
+            self.street[cell] = 0
+        self.nodes = [cell for cell in range(graph.size) if directions[cell] is not None and not self.street[cell]]
+        self.node_count = len(self.nodes)
+
+        # Reverse adjacency, to search the streets backwards from a goal
+        self.predecessors = {}
+        for cell in range(graph.size):
+            for neighbor in graph.legal_neighbors(cell):
+                self.predecessors.setdefault(neighbor, []).append(cell)
+
+        # Start node, end node and street cells of every segment
+        self.segment_from = []
+        self.segment_to = []
+        self.segment_cells = []
+        # Node -> list of (node, moves, segment) leaving it
+        self.out_edges = {}
+        for node in self.nodes:
+            self.add_segments(node)
+
+        if self.shortcuts:
+            self.contract()
+        self.version = graph.version
+
+    def add_segments(self, node):
+        """Breadth-first search from node through the street cells, with one segment to every node reached."""
+        graph = self.road_graph
+        parents = {node: None}
+        frontier = deque([node])
+        while frontier:
+            current = frontier.popleft()
+            for neighbor in graph.legal_neighbors(current):
+                if neighbor in parents:
+                    continue
+                parents[neighbor] = current
+                if self.street[neighbor]:
+                    frontier.append(neighbor)
+                    continue
+                cells = []
+                cell = current
+                while cell != node:
+                    cells.append(cell)
+                    cell = parents[cell]
+                cells.reverse()
+                self.out_edges.setdefault(node, []).append((neighbor, len(cells) + 1, len(self.segment_cells)))
+                self.segment_from.append(node)
+                self.segment_to.append(neighbor)
+                self.segment_cells.append(cells)
+
+    def street_search(self, cell, forward=True):
+        """
+        Breadth-first search from a street cell, forwards or backwards, that stops at the nodes.
+        Returns (moves to every node reached, moves to every cell reached, parents of the cells reached).
+        """
+        graph = self.road_graph
+        moves = {cell: 0}
+        parents = {cell: None}
+        nodes = {}
+        frontier = deque([cell])
+        while frontier:
+            current = frontier.popleft()
+            self.expansions += 1
+            neighbors = graph.legal_neighbors(current) if forward else self.predecessors.get(current, ())
+            for neighbor in neighbors:
+                if neighbor in parents:
+                    continue
+                parents[neighbor] = current
+                moves[neighbor] = moves[current] + 1
+                if self.street[neighbor]:
+                    frontier.append(neighbor)
+                else:
+                    nodes[neighbor] = moves[neighbor]
+        return nodes, moves, parents
+
+    def contract(self):
+        """
+        Contracts the nodes from the least to the most important, adding a shortcut u -> w for every path
+        u -> v -> w through the contracted node v that no witness path avoiding v beats.
+        Keeps the edges that go up the hierarchy for the queries.
+        """
+        out = {node: {} for node in self.nodes}
+        into = {node: {} for node in self.nodes}
+        # Segment of every edge between two nodes and middle node of every shortcut
+        self.edge_segment = {}
+        self.middle = {}
+        for u, edges in self.out_edges.items():
+            for v, moves, segment in edges:
+                if u != v and moves < out[u].get(v, float("inf")):
+                    out[u][v] = into[v][u] = moves
+                    self.edge_segment[(u, v)] = segment
+
+        # Up edges of every node: leaving it in the forward search, entering it in the backward search
+        self.up_out = {}
+        self.up_in = {}
+        contracted_neighbors = dict.fromkeys(self.nodes, 0)
+
+        def priority(node):
+            # Edge difference, plus the contracted neighbors so that contractions spread over the city
+            return len(self.shortcuts_needed(out, into, node)) - len(into[node]) - len(out[node]) + contracted_neighbors[node]
+
+        queue = [(priority(node), node) for node in self.nodes]
+        heapify(queue)
+        while queue:
+            _, node = heappop(queue)
+            shortcuts = self.shortcuts_needed(out, into, node)
+            current = len(shortcuts) - len(into[node]) - len(out[node]) + contracted_neighbors[node]
+            if queue and current > queue[0][0]:
+                heappush(queue, (current, node))
+                continue
+
+            for u, w, moves in shortcuts:
+                out[u][w] = into[w][u] = moves
+                self.middle[(u, w)] = node
+            self.up_out[node] = list(out[node].items())
+            self.up_in[node] = list(into[node].items())
+            for u in into[node]:
+                del out[u][node]
+                contracted_neighbors[u] += 1
+            for w in out[node]:
+                del into[w][node]
+                contracted_neighbors[w] += 1
+            del out[node], into[node]
+
+    def shortcuts_needed(self, out, into, node):
+        """(u, w, moves) of the shortcuts that contracting node adds to the remaining graph."""
+        shortcuts = []
+        for u, moves_in in into[node].items():
+            targets = {w: moves_in + moves_out for w, moves_out in out[node].items() if w != u}
+            if not targets:
+                continue
+            witnesses = self.witness_search(out, u, node, max(targets.values()))
+            for w, moves in targets.items():
+                if witnesses.get(w, float("inf")) > moves and moves < out[u].get(w, float("inf")):
+                    shortcuts.append((u, w, moves))
+        return shortcuts
+
+    def witness_search(self, out, source, excluded, max_moves):
+        """Bounded Dijkstra from source that does not go through excluded. Returns the distances found."""
+        distances = {source: 0}
+        open_set = [(0, source)]
+        settled = 0
+        while open_set and settled < WITNESS_LIMIT:
+            moves, node = heappop(open_set)
+            if moves > max_moves:
+                break
+            if moves > distances[node]:
+                continue
+            settled += 1
+            for neighbor, edge_moves in out[node].items():
+                if neighbor == excluded:
+                    continue
+                tentative = moves + edge_moves
+                if tentative < distances.get(neighbor, float("inf")):
+                    distances[neighbor] = tentative
+                    heappush(open_set, (tentative, neighbor))
+        return distances
+
+    def find_path(self, start, goal):
+        """
+        Shortest route from start to goal. Returns the list of positions from start to goal, or None.
+        """
+        graph = self.road_graph
+        if self.version != graph.version:
+            self.build()
+
+        start_cell = graph.cell_id(start)
+        goal_cell = graph.cell_id(goal)
+        if graph.directions[start_cell] is None or graph.directions[goal_cell] is None:
+            return None
+        if start_cell == goal_cell:
+            return [start]
+
+        # Nodes where the search over the hierarchy starts and ends, with the moves to reach them
+        start_moves = start_parents = goal_parents = None
+        if self.street[start_cell]:
+            sources, start_moves, start_parents = self.street_search(start_cell)
+        else:
+            sources = {start_cell: 0}
+        if self.street[goal_cell]:
+            targets, _, goal_parents = self.street_search(goal_cell, forward=False)
+        else:
+            targets = {goal_cell: 0}
+
+        search = self.search_shortcuts if self.shortcuts else self.search
+        moves, source, segments, target = search(sources, targets, goal_cell)
+        # The goal further down the same street, without going through a node
+        direct = start_moves.get(goal_cell) if start_moves is not None and self.street[goal_cell] else None
+        if direct is not None and direct <= moves:
+            source, segments, target = goal_cell, [], goal_cell
+        elif segments is None:
+            return None
+
+        path = []
+        cell = source
+        while cell is not None:
+            path.append(cell)
+            cell = start_parents[cell] if start_parents is not None else None
+        path.reverse()
+        for segment in segments:
+            path.extend(self.segment_cells[segment])
+            path.append(self.segment_to[segment])
+        cell = goal_parents[target] if goal_parents is not None and target != goal_cell else None
+        while cell is not None:
+            path.append(cell)
+            cell = goal_parents[cell]
+        return [divmod(cell, graph.height) for cell in path]
+
+    def search(self, sources, targets, goal_cell):
+        """
+        A* over the nodes from the sources to the targets, {node: moves}.
+        Returns (moves, source, segments, target) of the shortest route, with segments None if there is none.
+        """
+        height = self.road_graph.height
+        goal_x, goal_y = divmod(goal_cell, height)
+        open_set = []
+        g_score = {}
+        for node, moves in sources.items():
+            g_score[node] = moves
+            nx, ny = divmod(node, height)
+            heappush(open_set, (moves + abs(nx - goal_x) + abs(ny - goal_y), node))
+        came_from = {}
+        closed = set()
+        # The goal itself is -1, entered from the targets
+        best_target = None
+
+        while open_set:
+            f, current = heappop(open_set)
+            if current == -1:
+                segments = []
+                node = best_target
+                while node in came_from:
+                    segment = came_from[node]
+                    segments.append(segment)
+                    node = self.segment_from[segment]
+                segments.reverse()
+                return f, node, segments, best_target
+            if current in closed:
+                continue
+            closed.add(current)
+            self.expansions += 1
+
+            if current in targets:
+                moves = g_score[current] + targets[current]
+                if moves < g_score.get(-1, float("inf")):
+                    g_score[-1] = moves
+                    best_target = current
+                    heappush(open_set, (moves, -1))
+            for neighbor, moves, segment in self.out_edges.get(current, ()):
+                tentative_g_score = g_score[current] + moves
+                if tentative_g_score < g_score.get(neighbor, float("inf")):
+                    came_from[neighbor] = segment
+                    g_score[neighbor] = tentative_g_score
+                    nx, ny = divmod(neighbor, height)
+                    heappush(open_set, (tentative_g_score + abs(nx - goal_x) + abs(ny - goal_y), neighbor))
+
+        return float("inf"), None, None, None
+
+    def search_shortcuts(self, sources, targets, goal_cell):
+        """
+        Bidirectional Dijkstra over the up edges of the hierarchy, the forward search from the sources and
+        the backward one from the targets. Returns like search.
+        """
+        edges = (self.up_out, self.up_in)
+        distances = (dict(sources), dict(targets))
+        parents = ({}, {})
+        open_sets = ([(moves, node) for node, moves in sources.items()],
+                     [(moves, node) for node, moves in targets.items()])
+        heapify(open_sets[0])
+        heapify(open_sets[1])
+        settled = (set(), set())
+        best, meeting = float("inf"), None
+
+        while open_sets[0] or open_sets[1]:
+            side = 0 if open_sets[0] and (not open_sets[1] or open_sets[0][0] <= open_sets[1][0]) else 1
+            moves, node = heappop(open_sets[side])
+            if moves >= best:
+                # Nothing left on this side can improve the route
+                open_sets[side].clear()
+                continue
+            if node in settled[side]:
+                continue
+            settled[side].add(node)
+            self.expansions += 1
+
+            other = distances[1 - side].get(node)
+            if other is not None and moves + other < best:
+                best, meeting = moves + other, node
+            for neighbor, edge_moves in edges[side].get(node, ()):
+                tentative = moves + edge_moves
+                if tentative < distances[side].get(neighbor, float("inf")):
+                    distances[side][neighbor] = tentative
+                    parents[side][neighbor] = node
+                    heappush(open_sets[side], (tentative, neighbor))
+
+        if meeting is None:
+            return best, None, None, None
+        nodes = [meeting]
+        while nodes[-1] in parents[0]:
+            nodes.append(parents[0][nodes[-1]])
+        nodes.reverse()
+        while nodes[-1] in parents[1]:
+            nodes.append(parents[1][nodes[-1]])
+
+        segments = []
+        for u, w in zip(nodes, nodes[1:]):
+            self.unpack(u, w, segments)
+        return best, nodes[0], segments, nodes[-1]
+
+    def unpack(self, u, w, segments):
+        """Appends the segments of the edge or shortcut u -> w."""
+        stack = [(u, w)]
+        while stack:
+            u, w = stack.pop()
+            middle = self.middle.get((u, w))
+            if middle is None:
+                segments.append(self.edge_segment[(u, w)])
+            else:
+                stack.append((middle, w))
+                stack.append((u, middle))
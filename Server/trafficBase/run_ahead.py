@@ -0,0 +1,76 @@
+import threading
+from collections import deque
+
+
+class RunAhead:
+    """
+    Steps a session ahead of its clients on a worker thread, keeping the snapshot of each step
+    in a bounded ring buffer. Clients read frames without waiting for the model to step.
+    """
+    def __init__(self, session, capacity=256):
+        """
+        Args:
+            session: Session whose model is stepped
+            capacity: Number of frames kept. The worker stops when it is this many steps ahead of the last frame read
+        """
+        self.session = session
+        self.capacity = capacity
+        self.frames = deque(maxlen=capacity)
+        self.last_read = session.current_step
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True, name=f"run-ahead-{self.session.id}")
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        model = self.session.model
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running or self.session.current_step - self.last_read < self.capacity)
+                if not self.running:
+                    return
+
+            step = self.session.step(touch=False)
+            frame = model.deltas.snapshot()
+            frame["step"] = step
+
+            with self.condition:
+                self.frames.append(frame)
+                self.condition.notify_all()
+
+    def latest_step(self):
+        with self.condition:
+            return self.frames[-1]["step"] if self.frames else None
+
+    def frame(self, step):
+        """
+        Returns the frame of a step without blocking. Returns None if it has not been computed yet.
+        Raises KeyError if it is no longer in the buffer.
+        """
+        with self.condition:
+            if not self.frames or step > self.frames[-1]["step"]:
+                return None
+            first = self.frames[0]["step"]
+            if step < first:
+                raise KeyError(step)
+
+            frame = self.frames[step - first]
+            # Let the worker keep going up to capacity steps after this frame
+            if step > self.last_read:
+                self.last_read = step
+                self.condition.notify_all()
+            return frame
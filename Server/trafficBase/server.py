@@ -8,6 +8,37 @@ from agent import *
 from model import CityModel
 from mesa.visualization import ModularServer, TextElement
 from mesa.visualization import CanvasGrid
+from collections import defaultdict
+
+
+class CityCanvasGrid(CanvasGrid):
+    """
+    CanvasGrid that only walks the agents of the schedule. Roads, obstacles and destinations are not
+    in the grid: their portrayals are built once per model from views of the model's CellIndex.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.static_model = None
+        self.static_state = None
+
+    def render(self, model):
+        if self.static_model is not model:
+            self.static_model = model
+            self.static_state = defaultdict(list)
+            for pos in model.cell_index.static_cells():
+                for view in model.cell_index.static_views(pos):
+                    portrayal = self.portrayal_method(view)
+                    if portrayal:
+                        portrayal["x"], portrayal["y"] = pos
+                        self.static_state[portrayal["Layer"]].append(portrayal)
+
+        grid_state = defaultdict(list, {layer: list(portrayals) for layer, portrayals in self.static_state.items()})
+        for agent in model.schedule.agents:
+            portrayal = self.portrayal_method(agent)
+            if portrayal:
+                portrayal["x"], portrayal["y"] = agent.pos
+                grid_state[portrayal["Layer"]].append(portrayal)
+        return grid_state
 
 
 class CarInfoElement(TextElement):
@@ -15,10 +46,7 @@ class CarInfoElement(TextElement):
         super().__init__()
         
     def render(self, model):
-        active_cars = len([a for a in model.schedule.agents if isinstance(a, Car)])
-        completed_cars = model.cars_completed
-        
-        return f"Active Cars: {active_cars} | Completed Cars: {completed_cars}"
+        return f"Active Cars: {model.active_cars} | Completed Cars: {model.cars_completed}"
     
 def agent_portrayal(agent):
     if agent is None: return
@@ -82,10 +110,11 @@ with open('city_files/2024_base.txt') as baseFile:
     width = len(lines[0])-1
     height = len(lines)
 
-model_params = {"N":5}
+# N = 0: no limit on the cars in the city
+model_params = {"N": 0}
 
 print(width, height)
-grid = CanvasGrid(agent_portrayal, width, height, 500, 500)
+grid = CityCanvasGrid(agent_portrayal, width, height, 500, 500)
 car_info = CarInfoElement()
 
 chart = ChartModule([
@@ -1,121 +1,453 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS, cross_origin
 from model import CityModel
-from agent import Car, Obstacle, Traffic_Light, Road, Destination
+from binary_snapshot import pack_cars, pack_lights, BINARY_MIMETYPE
+from city_map import map_payload, MAP_MIMETYPE
+from trajectory_log import log_path, log_names, open_log
+from sessions import SessionManager, SessionLimitError
+from traffic_control import LIGHT_CONTROLLERS
+from profiling import prometheus_metrics, PROMETHEUS_MIMETYPE
+import json
+import os
 
-cityModel = None
-currentStep = 0
+# Largest number of steps a single /update?steps=N may advance
+MAX_STEPS_PER_UPDATE = 10000
+
+# Largest number of recorded steps a single /playback may return
+MAX_PLAYBACK_STEPS = 1000
+
+# Steps between the automatic checkpoints of a session, used by /seek. /init can change it (0 turns them off)
+CHECKPOINT_INTERVAL = 100
+
+# Profile every session unless /init says otherwise (TRAFFIC_PROFILE=1)
+PROFILE_SESSIONS = os.environ.get('TRAFFIC_PROFILE', '0') == '1'
+
+# Each client gets its own model, created by /init and named by the session id it returns
+sessions = SessionManager(CityModel, max_sessions=16, idle_timeout=600)
 
 app = Flask("Traffic Simulation")
-cors = CORS(app, origins=['http://localhost'])
+cors = CORS(app, origins=['http://localhost'], expose_headers=['X-Session-Id', 'ETag'])
+
+def getSession():
+    """
+    Session named by the session query parameter or the X-Session-Id header, None if there is no such session.
+    """
+    session_id = request.args.get('session') or request.headers.get('X-Session-Id')
+    return sessions.get(session_id) if session_id else None
+
+def unknownSession():
+    return jsonify({"message": "Unknown or expired session. Call /init first"}), 404
 
 @app.route('/init', methods=['POST'])
 @cross_origin()
 def initModel():
-    global currentStep, cityModel
     if request.method == 'POST':
         try:
-            number_agents = int(request.json.get('NAgents', 1))
-            currentStep = 0
-            cityModel = CityModel(number_agents)
-            return jsonify({"message": "Traffic simulation model initiated successfully."})
+            # Largest number of cars in the city at the same time, 0 for no limit
+            number_agents = int(request.json.get('NAgents', 0))
+            # Optional traffic light controller of the session, see traffic_control.LIGHT_CONTROLLERS
+            light_control = request.json.get('lightControl', 'fixed')
+            if light_control not in LIGHT_CONTROLLERS:
+                return jsonify({"message": f"lightControl must be one of {sorted(LIGHT_CONTROLLERS)}"}), 400
+            # "sequential" (the default) or "synchronous" two-phase moves, see parallel_moves
+            step_mode = request.json.get('stepMode', 'sequential')
+            if step_mode not in ('sequential', 'synchronous'):
+                return jsonify({"message": "stepMode must be sequential or synchronous"}), 400
+            # Let the waiting cars and the lights sleep until something they wait for changes, see wakeups
+            wakeups = bool(request.json.get('wakeups', False))
+            # Optional per-step instrumentation, exposed by /metrics
+            profile = bool(request.json.get('profile', PROFILE_SESSIONS))
+            # Seed of the run. A random one is picked and returned if none is given, so every run can be replayed
+            seed = request.json.get('seed')
+            seed = int(seed) if seed is not None else int.from_bytes(os.urandom(4), 'little')
+            # Optional spawning.Spawner options: origins, demand profile, OD matrix, queue and stop conditions
+            spawn = request.json.get('spawn')
+            if spawn is not None and not isinstance(spawn, dict):
+                return jsonify({"message": "spawn must be an object"}), 400
+            checkpoint_interval = int(request.json.get('checkpointInterval', CHECKPOINT_INTERVAL))
+            if checkpoint_interval < 0:
+                return jsonify({"message": "checkpointInterval must be 0 or positive"}), 400
+            session = sessions.create(number_agents, light_control=light_control, profile=profile, seed=seed,
+                                      step_mode=step_mode, spawn=spawn, wakeups=wakeups,
+                                      checkpoint_interval=checkpoint_interval)
+            return jsonify({
+                "message": "Traffic simulation model initiated successfully.",
+                "sessionId": session.id,
+                "seed": seed
+            })
+        except SessionLimitError as e:
+            return jsonify({"message": str(e)}), 503
+        except (ValueError, TypeError) as e:
+            return jsonify({"message": f"Invalid model parameters: {e}"}), 400
         except Exception as e:
             print(e)
             return jsonify({"message": "Error initializing model"}), 500
 
+@app.route('/session', methods=['DELETE'])
+@cross_origin()
+def closeSession():
+    session = getSession()
+    if session is None:
+        return unknownSession()
+    sessions.close(session.id)
+    return jsonify({"message": "Session closed."})
+
 @app.route('/getAgents', methods=['GET'])
 @cross_origin()
 def getAgents():
-    global cityModel
     if request.method == 'GET':
-        if cityModel is None:
-            return jsonify({"message": "Model not initialized"}), 400
-            
-        carPositions = []
-        for cell_coords in cityModel.grid.coord_iter():
-            agents = cell_coords[0]
-            x, y = cell_coords[1]
+        session = getSession()
+        if session is None:
+            return unknownSession()
+        cityModel = session.model
+
+        # ?format=binary: one 9 byte record per car (uint32 id, uint16 x, uint16 y, uint8 direction)
+        if request.args.get('format') == 'binary':
+            return Response(pack_cars(cityModel.deltas), mimetype=BINARY_MIMETYPE)
             
-            for agent in agents:
-                if isinstance(agent, Car):
-                    carPositions.append({
-                        "id": str(agent.unique_id),
-                        "x": x,
-                        "y": y,
-                        "direction": agent.current_direction
-                    })
-        
-        return jsonify({'positions': carPositions})
+        return jsonify({'positions': cityModel.deltas.snapshot()['cars']})
 
 @app.route('/getTrafficLights', methods=['GET'])
 @cross_origin()
 def getTrafficLights():
-    global cityModel
     if request.method == 'GET':
+        session = getSession()
+        if session is None:
+            return unknownSession()
+        cityModel = session.model
+
         try:
-            lightPositions = []
-            for cell_coords in cityModel.grid.coord_iter():
-                agents = cell_coords[0]
-                x, y = cell_coords[1]
-                
-                for agent in agents:
-                    if isinstance(agent, Traffic_Light):
-                        lightPositions.append({
-                            "id": str(agent.unique_id),
-                            "x": x,
-                            "y": y,
-                            "state": agent.state
-                        })
-            
-            return jsonify({'positions': lightPositions})
+            # ?format=binary: bitset of the light states, in the same order as the JSON list
+            if request.args.get('format') == 'binary':
+                return Response(pack_lights(cityModel.deltas), mimetype=BINARY_MIMETYPE)
+
+            return jsonify({'positions': cityModel.deltas.snapshot()['lights']})
         except Exception as e:
             print(e)
             return jsonify({"message": "Error getting traffic light positions"}), 500
 
+@app.route('/stream', methods=['GET'])
+@cross_origin()
+def streamUpdates():
+    """
+    Server-sent events with the changes of every step. Sends a snapshot event with the full state first,
+    then one delta event per step. Viewers that fall too far behind get a new snapshot.
+    """
+    session = getSession()
+    if session is None:
+        return unknownSession()
+
+    deltas = session.model.deltas
+
+    def events():
+        snapshot = deltas.snapshot()
+        step = snapshot['step']
+        yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+        while True:
+            if deltas.wait_for_step(step, timeout=15) == step:
+                if session.closed:
+                    # The session was closed or evicted, end the stream instead of keeping its model alive
+                    return
+                # Keep the connection alive while the simulation is paused
+                yield ": keep-alive\n\n"
+                continue
+
+            pending = deltas.deltas_since(step)
+            if pending is None:
+                snapshot = deltas.snapshot()
+                step = snapshot['step']
+                yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+                continue
+            for delta in pending:
+                step = delta['step']
+                yield f"event: delta\ndata: {json.dumps(delta)}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/getObstacles', methods=['GET'])
 @cross_origin()
 def getObstacles():
-    global cityModel
     if request.method == 'GET':
+        session = getSession()
+        if session is None:
+            return unknownSession()
+
         try:
-            obstaclePositions = []
-            for cell_coords in cityModel.grid.coord_iter():
-                agents = cell_coords[0]
-                x, y = cell_coords[1]
-                
-                for agent in agents:
-                    if isinstance(agent, Obstacle):
-                        obstaclePositions.append({
-                            "id": str(agent.unique_id),
-                            "x": x,
-                            "y": y
-                        })
-            
-            return jsonify({'positions': obstaclePositions})
+            # The obstacles never move, so they come from the cached layout of the city
+            return jsonify({'positions': map_payload(session.model).layout['obstacles']})
         except Exception as e:
             print(e)
             return jsonify({"message": "Error getting obstacle positions"}), 500
 
+@app.route('/map', methods=['GET'])
+@cross_origin()
+def getMap():
+    """
+    Static layout of the session's city (see city_map), built once per city file and light timings.
+    Served compressed with gzip to the clients that accept it. A client that sends the ETag it already
+    has in If-None-Match gets an empty 304.
+    """
+    session = getSession()
+    if session is None:
+        return unknownSession()
+
+    payload = map_payload(session.model)
+    # The compressed and the identity bodies are different representations, each with its own strong ETag
+    if 'gzip' in request.accept_encodings:
+        body, etag, encoding = payload.compressed, f"{payload.etag}-gzip", 'gzip'
+    else:
+        body, etag, encoding = payload.body, payload.etag, None
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=MAP_MIMETYPE)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    # Cached by the client but revalidated every time, the same session id may name another city later
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    """
+    Step and car counters of every session (or only ?session=) in the Prometheus text format,
+    with the phase timings and hot-path counters of the sessions created with profiling on.
+    """
+    if request.args.get('session'):
+        session = getSession()
+        if session is None:
+            return unknownSession()
+        selected = [session]
+    else:
+        selected = sessions.all()
+    return Response(prometheus_metrics({session.id: session.model for session in selected}),
+                    mimetype=PROMETHEUS_MIMETYPE)
+
 @app.route('/update', methods=['GET'])
 @cross_origin()
 def updateModel():
-    global currentStep, cityModel
     if request.method == 'GET':
-        if cityModel is None:
-            print("Debug: Cannot update - model not initialized")
-            return jsonify({"message": "Model not initialized. Call /init first"}), 400
-            
+        session = getSession()
+        if session is None:
+            print("Debug: Cannot update - unknown session")
+            return unknownSession()
+
+        if session.run_ahead:
+            return jsonify({"message": "Run-ahead is active, read the steps with /frame"}), 409
+
         try:
-            print(f"Debug: Updating model at step {currentStep}")
-            cityModel.step()
-            currentStep += 1
+            # ?steps=N advances several steps in one request
+            steps = int(request.args.get('steps', 1))
+            if steps < 1 or steps > MAX_STEPS_PER_UPDATE:
+                return jsonify({"message": f"steps must be between 1 and {MAX_STEPS_PER_UPDATE}"}), 400
+
+            # Sessions are stepped concurrently on the manager's worker pool
+            currentStep = sessions.step(session, steps)
             return jsonify({
                 'message': f'Model updated to step {currentStep}.',
                 'currentStep': currentStep
             })
+        except ValueError:
+            return jsonify({"message": "steps must be an integer"}), 400
         except Exception as e:
             print(f"Debug: Update failed with error: {str(e)}")
             return jsonify({"message": "Error updating model"}), 500
 
+@app.route('/checkpoints', methods=['GET', 'POST'])
+@cross_origin()
+def checkpoints():
+    """GET lists the steps with a checkpoint, POST checkpoints the current step."""
+    session = getSession()
+    if session is None:
+        return unknownSession()
+
+    if request.method == 'POST':
+        step, data = session.checkpoint()
+        return jsonify({"message": f"Checkpoint taken at step {step}.", "step": step, "bytes": len(data)})
+    return jsonify({"steps": session.checkpoints.steps(), "interval": session.checkpoints.interval,
+                    "currentStep": session.current_step})
+
+@app.route('/checkpoint', methods=['GET'])
+@cross_origin()
+def getCheckpoint():
+    """Packed checkpoint of step ?step=, it can be sent back to /restore of a session with the same city."""
+    session = getSession()
+    if session is None:
+        return unknownSession()
+    try:
+        step = int(request.args['step'])
+    except (KeyError, ValueError):
+        return jsonify({"message": "step must be an integer"}), 400
+    data = session.checkpoints.get(step)
+    if data is None:
+        return jsonify({"message": f"There is no checkpoint at step {step}"}), 404
+    return Response(data, mimetype='application/octet-stream')
+
+@app.route('/restore', methods=['POST'])
+@cross_origin()
+def restoreCheckpoint():
+    """Restores the packed checkpoint sent as the request body."""
+    session = getSession()
+    if session is None:
+        return unknownSession()
+    if session.run_ahead:
+        return jsonify({"message": "Stop the run-ahead before restoring a checkpoint"}), 409
+    if session.recorder:
+        return jsonify({"message": "Stop the recording before restoring a checkpoint"}), 409
+    try:
+        currentStep = session.restore(request.get_data())
+    except (ValueError, KeyError) as e:
+        return jsonify({"message": f"Invalid checkpoint: {e}"}), 400
+    return jsonify({"message": f"Model restored to step {currentStep}.", "currentStep": currentStep})
+
+@app.route('/seek', methods=['POST'])
+@cross_origin()
+def seek():
+    """
+    Moves the session to step {"step": k}: restores the latest checkpoint before it and steps forward from there.
+    """
+    session = getSession()
+    if session is None:
+        return unknownSession()
+    if session.run_ahead:
+        return jsonify({"message": "Stop the run-ahead before seeking"}), 409
+    try:
+        step = int((request.get_json(silent=True) or {})['step'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"message": "step must be an integer"}), 400
+    if step < 0:
+        return jsonify({"message": "step must be 0 or positive"}), 400
+
+    try:
+        restoredFrom = sessions.seek(session, step, MAX_STEPS_PER_UPDATE)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    return jsonify({"message": f"Model moved to step {step}.", "currentStep": step, "restoredFrom": restoredFrom})
+
+@app.route('/runAhead', methods=['POST', 'DELETE'])
+@cross_origin()
+def runAhead():
+    """
+    POST starts stepping the session in the background into a ring buffer of frames ({"capacity": frames}),
+    DELETE stops it.
+    """
+    session = getSession()
+    if session is None:
+        return unknownSession()
+
+    if request.method == 'DELETE':
+        sessions.stop_run_ahead(session)
+        return jsonify({"message": "Run-ahead stopped.", "currentStep": session.current_step})
+
+    try:
+        capacity = int((request.get_json(silent=True) or {}).get('capacity', 256))
+    except (TypeError, ValueError):
+        return jsonify({"message": "capacity must be an integer"}), 400
+    if capacity < 1:
+        return jsonify({"message": "capacity must be at least 1"}), 400
+    runner = sessions.start_run_ahead(session, capacity)
+    return jsonify({"message": "Run-ahead started.", "capacity": runner.capacity, "currentStep": session.current_step})
+
+@app.route('/frame', methods=['GET'])
+@cross_origin()
+def getFrame():
+    """
+    Cars and lights at step k (?k=) computed by the run-ahead worker. Never waits for the model:
+    answers 202 if the step is not computed yet and 410 if it already left the buffer.
+    """
+    session = getSession()
+    if session is None:
+        return unknownSession()
+    if session.run_ahead is None:
+        return jsonify({"message": "Run-ahead is not active. Start it with POST /runAhead"}), 409
+
+    try:
+        step = int(request.args['k'])
+    except (KeyError, ValueError):
+        return jsonify({"message": "k must be an integer step"}), 400
+
+    try:
+        frame = session.run_ahead.frame(step)
+    except KeyError:
+        return jsonify({"message": f"Step {step} is no longer buffered"}), 410
+    if frame is None:
+        return jsonify({"message": f"Step {step} is not ready", "latestStep": session.run_ahead.latest_step()}), 202
+    return jsonify(frame)
+
+@app.route('/recording', methods=['POST', 'DELETE'])
+@cross_origin()
+def recording():
+    """
+    POST starts appending the current step and every step after it to the trajectory log {"name": name},
+    which /playback can serve without a model. DELETE stops the recording.
+    """
+    session = getSession()
+    if session is None:
+        return unknownSession()
+
+    if request.method == 'DELETE':
+        session.stop_recording()
+        return jsonify({"message": "Recording stopped.", "currentStep": session.current_step})
+
+    try:
+        name = str((request.get_json(silent=True) or {})['name'])
+        recorder = session.start_recording(log_path(name))
+    except KeyError:
+        return jsonify({"message": "name is required"}), 400
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    except FileExistsError:
+        return jsonify({"message": f"There is already a log named {name}"}), 409
+    return jsonify({"message": "Recording started.", "log": recorder.path, "currentStep": session.current_step})
+
+@app.route('/recordings', methods=['GET'])
+@cross_origin()
+def recordings():
+    """Trajectory logs that /playback can serve, with their city file and steps."""
+    logs = []
+    for name in log_names():
+        try:
+            logs.append(dict(open_log(name).summary(), name=name))
+        except (OSError, ValueError) as e:
+            print(f"Skipping log {name}: {e}")
+    return jsonify({"recordings": logs})
+
+@app.route('/playback', methods=['GET'])
+@cross_origin()
+def playback():
+    """
+    Recorded steps ?from= to ?to= of the trajectory log ?log=, read from the memory-mapped log without
+    running a model. JSON frames have the format of /stream snapshots.
+    ?format=binary returns the frames as stored in the log (see trajectory_log), and ?format=metadata
+    the city of the log and the order of the lights in the bitsets.
+    """
+    try:
+        log = open_log(request.args.get('log', ''))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    except FileNotFoundError:
+        return jsonify({"message": "Unknown log, see /recordings"}), 404
+
+    if request.args.get('format') == 'metadata':
+        return jsonify(dict(log.summary(), **log.metadata))
+    if not len(log):
+        return jsonify({"message": "The log has no frames yet"}), 404
+
+    try:
+        first = int(request.args.get('from', log.first_step()))
+        last = int(request.args.get('to', first + MAX_PLAYBACK_STEPS - 1))
+    except ValueError:
+        return jsonify({"message": "from and to must be integer steps"}), 400
+    if last < first or last - first >= MAX_PLAYBACK_STEPS:
+        return jsonify({"message": f"to must be between from and from + {MAX_PLAYBACK_STEPS - 1}"}), 400
+
+    if request.args.get('format') == 'binary':
+        return Response(log.raw(first, last), mimetype=BINARY_MIMETYPE)
+    return jsonify({"steps": log.frames(first, last), "lastStep": log.last_step()})
+
 if __name__=='__main__':
-    app.run(host="localhost", port=8585, debug=False)
\ No newline at end of file
+    app.run(host="localhost", port=8585, debug=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,249 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from run_ahead import RunAhead
+from checkpoint import CheckpointStore, pack, unpack
+from trajectory_log import TrajectoryWriter
+
+
+class SessionLimitError(Exception):
+    """Raised when a session is requested and the server already has the maximum number of sessions."""
+
+
+class Session:
+    """
+    One simulation owned by a client, with its own lock so its requests never interleave.
+    """
+    def __init__(self, model, checkpoint_interval=0):
+        """
+        Args:
+            model: CityModel of the session
+            checkpoint_interval: Steps between automatic checkpoints, 0 to only take them on request
+        """
+        self.id = uuid.uuid4().hex
+        self.model = model
+        self.lock = threading.Lock()
+        self.current_step = 0
+        self.last_access = time.monotonic()
+        # RunAhead stepping the model in the background, if enabled. Its own lock, the worker holds self.lock
+        # while it steps and stopping it waits for the worker
+        self.run_ahead = None
+        self.run_ahead_lock = threading.Lock()
+        self.checkpoints = CheckpointStore(checkpoint_interval)
+        # TrajectoryWriter appending every step to a log, if recording
+        self.recorder = None
+        # Set once the session is closed or evicted, so the streams of its viewers end
+        self.closed = False
+        if checkpoint_interval:
+            self.store_checkpoint()
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+    def step(self, steps=1, touch=True):
+        """Advances the model steps times. Returns the current step."""
+        with self.lock:
+            self.advance(steps)
+            if touch:
+                self.touch()
+            return self.current_step
+
+    def advance(self, steps):
+        """Steps the model, taking the checkpoints that are due. The caller holds the lock."""
+        for _ in range(steps):
+            self.model.step()
+            self.current_step += 1
+            if self.checkpoints.due(self.current_step):
+                self.store_checkpoint()
+            if self.recorder:
+                self.recorder.record(self.current_step)
+
+    def store_checkpoint(self):
+        """Checkpoints the current step. The caller holds the lock. Returns the packed checkpoint."""
+        state = self.model.checkpoint()
+        state["session_step"] = np.array(self.current_step)
+        data = pack(state)
+        self.checkpoints.add(self.current_step, data)
+        return data
+
+    def checkpoint(self):
+        """Checkpoints the current step. Returns (step, packed checkpoint)."""
+        with self.lock:
+            return self.current_step, self.store_checkpoint()
+
+    def start_recording(self, path):
+        """
+        Starts appending the current step and every step after it to a new trajectory log.
+        Raises FileExistsError if the log exists.
+        """
+        with self.lock:
+            if self.recorder is None:
+                self.recorder = TrajectoryWriter(self.model, path, self.current_step)
+            return self.recorder
+
+    def stop_recording(self):
+        with self.lock:
+            if self.recorder:
+                self.recorder.close()
+                self.recorder = None
+
+    def restore(self, data):
+        """Restores a packed checkpoint. Returns the current step."""
+        state = unpack(data)
+        with self.lock:
+            if self.recorder:
+                raise ValueError("Stop the recording before restoring a checkpoint, logs only go forward")
+            step = int(state.pop("session_step", self.model.schedule.steps))
+            self.model.restore(state)
+            self.current_step = step
+            self.touch()
+            return step
+
+    def seek(self, step, max_steps=None):
+        """
+        Moves the model to step: restores the latest checkpoint before it, unless stepping from the current
+        step is shorter, and steps forward. Raises ValueError if there is no checkpoint to go back to or more
+        than max_steps would be run. Returns the step the model was restored from, None if it was not restored.
+        """
+        with self.lock:
+            nearest = self.checkpoints.nearest(step)
+            restore_from = None
+            if step < self.current_step or (nearest is not None and nearest[0] > self.current_step):
+                if nearest is None:
+                    raise ValueError(f"There is no checkpoint at or before step {step}")
+                restore_from = nearest[0]
+            if restore_from is not None and self.recorder:
+                raise ValueError("Stop the recording before seeking back, logs only go forward")
+            start = self.current_step if restore_from is None else restore_from
+            if max_steps is not None and step - start > max_steps:
+                raise ValueError(f"Step {step} is {step - start} steps after the nearest checkpoint, the limit is {max_steps}")
+
+            if restore_from is not None:
+                state = unpack(nearest[1])
+                state.pop("session_step", None)
+                self.model.restore(state)
+                self.current_step = restore_from
+            self.advance(step - start)
+            self.touch()
+        return restore_from
+
+    def close(self):
+        self.closed = True
+        with self.run_ahead_lock:
+            if self.run_ahead:
+                self.run_ahead.stop()
+                self.run_ahead = None
+        self.stop_recording()
+        with self.lock:
+            self.model.close()
+
+
+class SessionManager:
+    """
+    Keeps isolated simulation sessions, steps them on a shared worker pool and evicts the idle ones.
+    """
+    def __init__(self, model_factory, max_sessions=16, idle_timeout=600, workers=None):
+        """
+        Args:
+            model_factory: Callable that builds the model of a new session from the /init parameters
+            max_sessions: Maximum number of sessions alive at the same time
+            idle_timeout: Seconds without requests after which a session is evicted
+            workers: Number of threads stepping sessions concurrently
+        """
+        self.model_factory = model_factory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count(), thread_name_prefix="session-step")
+
+        self.reaper = threading.Thread(target=self.reap_idle_sessions, daemon=True)
+        self.reaper.start()
+
+    def create(self, *args, checkpoint_interval=0, **kwargs):
+        """
+        Builds a new session, checkpointed every checkpoint_interval steps.
+        Raises SessionLimitError if the server is full even after evicting idle sessions.
+        """
+        self.evict_idle()
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                raise SessionLimitError(f"Maximum number of sessions ({self.max_sessions}) reached")
+
+        # Build the model outside the lock, other sessions keep being served meanwhile
+        session = Session(self.model_factory(*args, **kwargs), checkpoint_interval)
+        with self.lock:
+            full = len(self.sessions) >= self.max_sessions
+            if not full:
+                self.sessions[session.id] = session
+        if full:
+            # Another request took the last slot while the model was built
+            session.close()
+            raise SessionLimitError(f"Maximum number of sessions ({self.max_sessions}) reached")
+        return session
+
+    def get(self, session_id):
+        """Returns the session with the given id, or None if it does not exist or was evicted."""
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session:
+            session.touch()
+        return session
+
+    def close(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def step(self, session, steps=1):
+        """Steps a session on the worker pool and waits for it. Returns the current step."""
+        return self.executor.submit(session.step, steps).result()
+
+    def seek(self, session, step, max_steps=None):
+        """Moves a session to step on the worker pool, see Session.seek."""
+        return self.executor.submit(session.seek, step, max_steps).result()
+
+    def start_run_ahead(self, session, capacity=256):
+        """Starts stepping a session in the background. Returns its RunAhead."""
+        with session.run_ahead_lock:
+            if session.run_ahead is None:
+                session.run_ahead = RunAhead(session, capacity)
+                session.run_ahead.start()
+            return session.run_ahead
+
+    def stop_run_ahead(self, session):
+        with session.run_ahead_lock:
+            if session.run_ahead:
+                session.run_ahead.stop()
+                session.run_ahead = None
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [session_id for session_id, session in self.sessions.items()
+                    if now - session.last_access > self.idle_timeout and not session.lock.locked()]
+            evicted = [self.sessions.pop(session_id) for session_id in idle]
+        for session in evicted:
+            session.close()
+        return idle
+
+    def reap_idle_sessions(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 4))
+            for session_id in self.evict_idle():
+                print(f"Evicted idle session {session_id}")
+
+    def all(self):
+        """List of the sessions alive."""
+        with self.lock:
+            return list(self.sessions.values())
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
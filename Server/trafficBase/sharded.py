@@ -0,0 +1,502 @@
+"""
+Sharded run of a city over several processes. The grid is split in rectangular tiles, one worker process per tile,
+and each worker steps a CityModel (vectorized engine, synchronous step mode) that only holds the cars of its tile
+and controls the lights of its tile. Every worker loads the whole static city, so routes are planned over the
+full road graph and reach destinations in other tiles.
+
+The workers share these arrays through multiprocessing.shared_memory and meet at a barrier between the phases
+of every step:
+
+1. Spawn the cars of the tile's origins and switch its lights. The light states and the spawn counts (for the
+   stop rule) are published.
+2. Propose the next cell of every car. A car whose next cell is in another tile publishes a request on that
+   edge, with its counters, instead of taking part in the local resolution.
+3. Resolve the cells of the tile (parallel_moves.MoveResolver) between the local cars and the requests of
+   the neighbors, and publish which requests were granted.
+4. Apply the moves. Granted requests hand the car over: the owner of the edge's tile adds it from the
+   published record and the sender removes it. Every worker publishes the occupancy of its tile, and the
+   neighbors copy the halo around their tile from it at the start of the next step (the spawner and the
+   queue-reading light controllers look at it).
+
+Compared with CityModel(step_mode="synchronous") on one process, which gives the same run as a single tile:
+- A car crossing a tile edge takes a cell that is empty or emptied by the cars of its owner. The cell it leaves
+  is freed for the next step, and it does not fall back while it waits. Fallbacks stay inside the tile.
+- Every tile draws from its own random number generator, seeded with seed + tile index.
+- max_active (CityModel's N) and max_cars are global limits and are not supported.
+
+Example:
+    python sharded.py --city generated/city_120_b6_d0.1_l1.0_s0.txt --tiles 2 2 --steps 1000 --seed 0
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing import shared_memory
+import numpy as np
+from city_compiler import load_city
+from vectorized_engine import MOVE_CODES
+
+# Cells of the neighbor tiles copied around every tile each step. The queue controllers read up to
+# 5 cells before and after every light, and the lights of an intersection can reach into the next tile
+HALO = 8
+
+# Seconds a worker waits for the others at a barrier before the run is considered broken
+BARRIER_TIMEOUT = 120
+
+# Fields of the record published with every handover request, in order
+HANDOVER_FIELDS = ("ids", "destination", "spawn_step", "wait_steps", "waiting")
+
+# Totals reported by the workers, summed over the tiles
+COUNTERS = ("car_count", "cars_completed", "active_cars", "total_travel_time", "total_wait_steps")
+
+
+def tile_bounds(width, height, tiles):
+    """(x0, x1, y0, y1) of each tile, row by row of tiles along y for each column of tiles along x."""
+    columns, rows = tiles
+    if columns < 1 or rows < 1 or columns > width or rows > height:
+        raise ValueError(f"Cannot split a {width}x{height} city in {columns}x{rows} tiles")
+    xs = np.linspace(0, width, columns + 1).astype(int).tolist()
+    ys = np.linspace(0, height, rows + 1).astype(int).tolist()
+    return [(xs[i], xs[i + 1], ys[j], ys[j + 1]) for i in range(columns) for j in range(rows)]
+
+
+def tile_map(width, height, bounds):
+    """Tile index of every cell, indexed by cell id (x * height + y)."""
+    tile_of = np.empty((width, height), dtype=np.int32)
+    for tile, (x0, x1, y0, y1) in enumerate(bounds):
+        tile_of[x0:x1, y0:y1] = tile
+    return tile_of.reshape(-1)
+
+
+def crossing_edges(city, tile_of):
+    """
+    Legal moves between cells of different tiles, as (source cell ids, slots in NEIGHBOR_OFFSETS order,
+    target cell ids), sorted by source * 4 + slot.
+    """
+    adjacency = np.asarray(city.adjacency, dtype=np.int64)
+    legal = np.asarray(city.legal, dtype=bool)
+    keys = np.flatnonzero(legal & (adjacency >= 0))
+    source, slot = np.divmod(keys, 4)
+    target = adjacency[keys]
+    crossing = tile_of[source] != tile_of[target]
+    return source[crossing], slot[crossing], target[crossing]
+
+
+class SharedArrays:
+    """
+    Numpy arrays in shared memory blocks, created by the coordinator and attached by the workers by name.
+    """
+    def __init__(self, layout, names=None):
+        """
+        Args:
+            layout: Dictionary {array name: (shape, dtype)}
+            names: Dictionary {array name: shared memory block name} to attach to, None to create the blocks
+        """
+        self.layout = layout
+        self.owner = names is None
+        self.blocks = {}
+        self.arrays = {}
+        for name, (shape, dtype) in layout.items():
+            size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            if self.owner:
+                block = shared_memory.SharedMemory(create=True, size=size)
+            else:
+                block = shared_memory.SharedMemory(name=names[name])
+            self.blocks[name] = block
+            self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            if self.owner:
+                self.arrays[name].fill(0)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def names(self):
+        return {name: block.name for name, block in self.blocks.items()}
+
+    def close(self):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = {}
+
+
+class TileWorker:
+    """
+    The CityModel of one tile and its part of every step, see the module docstring.
+    """
+    def __init__(self, tile, options, shared, barrier):
+        """
+        Args:
+            tile: Index of the tile in options["bounds"]
+            options: Dictionary with the model options, the tile bounds and the crossing edges (see ShardedCity)
+            shared: SharedArrays attached to the coordinator's blocks
+            barrier: multiprocessing.Barrier of all the workers
+        """
+        from model import CityModel
+        from spawning import Spawner
+
+        self.tile = tile
+        self.shared = shared
+        self.barrier = barrier
+        seed = options["seed"]
+        spawn = dict(options["spawn"] or {})
+        self.model = model = CityModel(
+            0, options["city_file"], options["light_timings"], options["spawn_interval"], options["routing"],
+            engine="vectorized", seed=None if seed is None else seed + tile, light_control=options["light_control"],
+            spawn=spawn, step_mode="synchronous"
+        )
+        self.engine = engine = model.engine
+        engine.id_stride = len(options["bounds"])
+        engine.id_offset = tile
+
+        width, height = model.width, model.height
+        self.tile_of = tile_map(width, height, options["bounds"])
+        self.in_tile = self.tile_of == tile
+        # Cells of other tiles, where no car of this one can fall back to
+        self.closed = ~self.in_tile
+        x0, x1, y0, y1 = options["bounds"][tile]
+        halo = options["halo"]
+        self.box = (slice(x0, x1), slice(y0, y1))
+        self.halo_box = (slice(max(0, x0 - halo), min(width, x1 + halo)), slice(max(0, y0 - halo), min(height, y1 + halo)))
+
+        # Only the origins of this tile spawn here
+        origins = model.spawner.origins
+        mine = [i for i, (x, y) in enumerate(origins) if self.in_tile[x * height + y]]
+        spawn["origins"] = [origins[i] for i in mine]
+        if spawn.get("od_matrix") is not None:
+            spawn["od_matrix"] = [spawn["od_matrix"][i] for i in mine]
+        model.spawner = Spawner(model, **spawn)
+
+        # Lights of this tile. Phase controllers switch whole intersections, owned by the tile of their first light
+        lights = model.traffic_lights
+        light_tiles = np.array([self.tile_of[x * height + y] for x, y in (light.pos for light in lights)], dtype=np.int32)
+        controller = model.light_controller
+        if hasattr(controller, "intersections"):
+            for intersection in controller.intersections:
+                light_tiles[intersection.lights] = light_tiles[intersection.lights[0]]
+            controller.intersections = [intersection for intersection in controller.intersections
+                                        if light_tiles[intersection.lights[0]] == tile]
+        self.owned_lights = light_tiles == tile
+
+        source, slot, target = options["edges"]
+        self.edge_keys = source * 4 + slot
+        self.edge_targets = target
+        self.edge_codes = np.array(MOVE_CODES, dtype=np.uint8)[slot]
+        self.out_edges = np.flatnonzero(self.in_tile[source])
+        self.in_edges = np.flatnonzero(self.in_tile[target])
+
+        shared["lights"][self.owned_lights] = [light.state for light, owned in zip(lights, self.owned_lights) if owned]
+        shared["occupancy"][self.box] = model.cell_index.cars[self.box]
+
+    def step(self, steps=1):
+        """Runs steps steps in lockstep with the other workers. Returns the counters of the tile."""
+        for _ in range(steps):
+            if not self.model.running:
+                break
+            self.step_once()
+        return self.counters()
+
+    def step_once(self):
+        model = self.model
+        engine = self.engine
+        shared = self.shared
+        cars = model.cell_index.cars
+        cars[self.halo_box] = shared["occupancy"][self.halo_box]
+
+        # Phase 1: spawn, switch the lights of the tile and publish them
+        spawner = model.spawner
+        if spawner.should_stop():
+            # max_steps, the same in every tile
+            model.running = False
+            return
+        shared["spawns"][self.tile] = spawner.spawn()
+        model.total_episodes += 1
+        model.light_controller.step()
+        if model.light_controller.flips_in_step:
+            engine.toggle_lights((model.schedule.steps % engine.light_period == 0) & self.owned_lights)
+        shared["lights"][self.owned_lights] = [light.state for light, owned in zip(model.traffic_lights, self.owned_lights) if owned]
+        self.barrier.wait()
+
+        requested, spawned, limited = shared["spawns"].sum(axis=0).tolist()
+        if spawner.stop_when_blocked and requested and not spawned and not limited:
+            model.running = False
+            return
+        states = shared["lights"].astype(bool)
+        for light, state in zip(model.traffic_lights, states.tolist()):
+            if light.state != state:
+                model.light_controller.set_light(light, state)
+        engine.light_state = states
+
+        # Phase 2: proposals. Moves into other tiles become requests to their owners
+        cells, arrived, next_cell, valid = engine.propose_moves()
+        crossing = np.zeros(len(cells), dtype=bool)
+        has_next = next_cell >= 0
+        crossing[has_next] = ~self.in_tile[next_cell[has_next]]
+        sending = np.flatnonzero(crossing & valid)
+        slot = np.searchsorted(engine.offsets, next_cell[sending] - cells[sending])
+        sent_edges = np.searchsorted(self.edge_keys, cells[sending] * 4 + slot)
+        shared["requested"][self.out_edges] = 0
+        shared["requested"][sent_edges] = 1
+        shared["handover"][sent_edges] = np.stack([getattr(engine, name)[sending] for name in HANDOVER_FIELDS], axis=1)
+        targets = np.where(crossing, -1, next_cell)
+        self.barrier.wait()
+
+        # Phase 3: grant the cells of the tile to the local cars and the requests of the neighbors
+        incoming = self.in_edges[shared["requested"][self.in_edges] == 1]
+        records = shared["handover"][incoming].copy()
+        n = len(cells)
+        new_cell, fallback = model.move_resolver.resolve(
+            np.concatenate((cells, np.full(len(incoming), engine.size, dtype=np.int64))),
+            np.concatenate((targets, self.edge_targets[incoming])),
+            np.concatenate((valid, np.ones(len(incoming), dtype=bool))),
+            np.concatenate((arrived, np.zeros(len(incoming), dtype=bool))),
+            np.concatenate((engine.wait_steps, records[:, 3])),
+            np.concatenate((engine.ids, records[:, 0])),
+            self.closed
+        )
+        granted = new_cell[n:] >= 0
+        shared["granted"][incoming] = granted
+        self.barrier.wait()
+
+        # Phase 4: apply the moves and hand the cars over
+        new_cell = new_cell[:n]
+        handed = shared["granted"][sent_edges] == 1
+        new_cell[sending[handed]] = self.edge_targets[sent_edges[handed]]
+        engine.apply_moves(cells, arrived, new_cell, fallback[:n])
+        for edge, record in zip(incoming[granted].tolist(), records[granted].tolist()):
+            car_id, destination, spawn_step, wait_steps, waiting = record
+            engine.import_car(car_id, int(self.edge_targets[edge]), destination, spawn_step, wait_steps, waiting,
+                              int(self.edge_codes[edge]))
+        handed_ids = engine.ids[sending[handed]]
+        engine.finish_step(cells, arrived)
+        engine.remove_cars(handed_ids)
+        shared["occupancy"][self.box] = cars[self.box]
+        model.deltas.commit(model.schedule.steps)
+        self.barrier.wait()
+
+    def counters(self):
+        model = self.model
+        counters = {name: getattr(model, name) for name in COUNTERS}
+        counters.update({
+            "steps": model.schedule.steps,
+            "running": model.running,
+            "queued": model.spawner.queued,
+            "dropped": model.spawner.dropped
+        })
+        return counters
+
+    def positions(self):
+        return self.engine.positions()
+
+    def light_states(self):
+        """{light index: state} of the lights of the tile."""
+        return {i: light.state for i, light in enumerate(self.model.traffic_lights) if self.owned_lights[i]}
+
+    def trips(self):
+        return {name: self.model.trips[name].copy() for name in ("car", "spawn_step", "completion_step", "wait_steps")}
+
+
+def run_tile(tile, options, names, layout, barrier, connection):
+    """Entry point of a worker process: builds the TileWorker and runs the commands of the coordinator."""
+    shared = SharedArrays(layout, names)
+    try:
+        worker = TileWorker(tile, options, shared, barrier)
+        connection.send(("ok", None))
+        while True:
+            command, args = connection.recv()
+            if command == "close":
+                break
+            connection.send(("ok", getattr(worker, command)(*args)))
+    except Exception:
+        # Wake up the workers waiting for this one at a barrier
+        barrier.abort()
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        shared.close()
+
+
+class ShardedCity:
+    """
+    Coordinator of a sharded run: starts one worker process per tile and sends them the steps.
+    Close it (or use it in a with block) to stop the workers and free the shared memory.
+    """
+    def __init__(self, tiles=(2, 2), city_file="2024_base.txt", light_timings=None, spawn_interval=10,
+                 routing="astar", seed=None, light_control="fixed", spawn=None, halo=HALO):
+        """
+        Args:
+            tiles: (columns, rows) of tiles the grid is split in, along x and y
+            city_file, light_timings, spawn_interval, routing, seed, light_control, spawn: Like CityModel.
+                Routing "congestion" and the spawn options max_active and max_cars are not supported
+            halo: Cells around every tile copied from its neighbors every step
+        """
+        if routing == "congestion":
+            raise ValueError("Congestion routing needs the sequential step mode, it cannot be sharded")
+        for option in ("max_active", "max_cars"):
+            if (spawn or {}).get(option):
+                raise ValueError(f"The spawn option {option} is a global limit, it cannot be sharded")
+
+        with open('./city_files/mapDictionary.json') as mapDictionary:
+            dataDictionary = json.load(mapDictionary)
+        if light_timings:
+            dataDictionary.update(light_timings)
+        city = load_city(os.path.join('./city_files', city_file), dataDictionary)
+        self.width = city.width
+        self.height = city.height
+        self.bounds = tile_bounds(city.width, city.height, tiles)
+        n_tiles = len(self.bounds)
+        edges = crossing_edges(city, tile_map(city.width, city.height, self.bounds))
+
+        layout = {
+            "occupancy": ((city.width, city.height), np.uint16),
+            "lights": ((len(city.light_cells),), np.uint8),
+            "spawns": ((n_tiles, 3), np.int64),
+            "requested": ((len(edges[0]),), np.uint8),
+            "granted": ((len(edges[0]),), np.uint8),
+            "handover": ((len(edges[0]), len(HANDOVER_FIELDS)), np.int64)
+        }
+        self.shared = SharedArrays(layout)
+        options = {
+            "city_file": city_file,
+            "light_timings": light_timings,
+            "spawn_interval": spawn_interval,
+            "routing": routing,
+            "seed": seed,
+            "light_control": light_control,
+            "spawn": spawn,
+            "halo": halo,
+            "bounds": self.bounds,
+            "edges": edges
+        }
+
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(n_tiles, timeout=BARRIER_TIMEOUT)
+        self.connections = []
+        self.workers = []
+        for tile in range(n_tiles):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target=run_tile, args=(tile, options, self.shared.names(), layout, barrier,
+                                                            worker_connection), daemon=True)
+            worker.start()
+            # Only the worker keeps its end, so the pipe reports EOF if it dies
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+        try:
+            self.receive()
+        except Exception:
+            self.close()
+            raise
+        self.last_counters = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def receive(self):
+        """Replies of every worker to the last command. Raises RuntimeError if one of them failed."""
+        replies = []
+        for connection in self.connections:
+            try:
+                replies.append(connection.recv())
+            except EOFError:
+                replies.append(("error", "The worker process exited"))
+        errors = [(tile, reply) for tile, (status, reply) in enumerate(replies) if status == "error"]
+        if errors:
+            # The first worker that failed, the others only saw the barrier break
+            tile, error = next(((tile, error) for tile, error in errors if "BrokenBarrierError" not in error), errors[0])
+            raise RuntimeError(f"Tile {tile} failed:\n{error}")
+        return [reply for _, reply in replies]
+
+    def call(self, command, *args):
+        for connection in self.connections:
+            connection.send((command, args))
+        return self.receive()
+
+    def step(self, steps=1):
+        """Advances every tile steps steps, or until the run stops. Returns the counters (see counters)."""
+        self.last_counters = self.call("step", steps)
+        return self.counters()
+
+    def counters(self):
+        """Counters of CityModel summed over the tiles, plus steps, running, queued and dropped."""
+        if self.last_counters is None:
+            self.last_counters = self.call("counters")
+        tiles = self.last_counters
+        counters = {name: sum(tile[name] for tile in tiles) for name in COUNTERS + ("queued", "dropped")}
+        counters["steps"] = tiles[0]["steps"]
+        counters["running"] = all(tile["running"] for tile in tiles)
+        return counters
+
+    @property
+    def running(self):
+        return self.counters()["running"]
+
+    def positions(self):
+        """List of (car id, (x, y), direction) of the cars of every tile, by car id."""
+        return sorted(car for tile in self.call("positions") for car in tile)
+
+    def light_states(self):
+        """State of every traffic light, in the order of CityModel.traffic_lights."""
+        states = {}
+        for tile in self.call("light_states"):
+            states.update(tile)
+        return [states[i] for i in range(len(states))]
+
+    def trips(self):
+        """Columns of metrics.TRIP_COLUMNS with the trips of every tile, sorted by car id."""
+        tiles = self.call("trips")
+        columns = {name: np.concatenate([tile[name] for tile in tiles]) for name in tiles[0]}
+        order = np.argsort(columns["car"], kind="stable")
+        return {name: values[order] for name, values in columns.items()}
+
+    def close(self):
+        """Stops the workers and frees the shared memory."""
+        for connection, worker in zip(self.connections, self.workers):
+            if worker.is_alive():
+                try:
+                    connection.send(("close", ()))
+                except OSError:
+                    pass
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        self.connections = []
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a city split in tiles, one process per tile")
+    parser.add_argument("--city", default="2024_base.txt", help="City file in city_files/")
+    parser.add_argument("--tiles", nargs=2, type=int, default=[2, 2], metavar=("COLUMNS", "ROWS"))
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--routing", choices=["astar", "next_hop", "hierarchical", "hierarchical_ch"], default="astar")
+    parser.add_argument("--light-control", default="fixed", help="Key of traffic_control.LIGHT_CONTROLLERS")
+    parser.add_argument("--spawn-interval", type=int, default=10)
+    parser.add_argument("--spawn", type=json.loads, help="JSON object with the options of spawning.Spawner")
+    parser.add_argument("--halo", type=int, default=HALO)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with ShardedCity(tuple(args.tiles), args.city, spawn_interval=args.spawn_interval, routing=args.routing,
+                     seed=args.seed, light_control=args.light_control, spawn=args.spawn, halo=args.halo) as city:
+        started = time.perf_counter()
+        counters = city.step(args.steps)
+        seconds = time.perf_counter() - started
+    print(f"{len(city.bounds)} tiles, started in {started - start:.2f}s, "
+          f"{counters['steps']} steps in {seconds:.2f}s ({counters['steps'] / max(seconds, 1e-9):.1f} steps/s)")
+    print(json.dumps(counters))
+
+
+if __name__ == "__main__":
+    main()
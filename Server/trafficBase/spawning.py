@@ -0,0 +1,273 @@
+"""
+Entry of cars into the city, configured by the spawn argument of CityModel:
+
+- origins: cells where cars enter, "corners" (the default), "border" (road cells on the edge of the map)
+  or a list of [x, y] positions
+- demand: cars requested per step and origin, a key of DEMAND_PROFILES. "interval" (the default) requests one
+  car per origin every spawn_interval steps, "poisson" draws Poisson arrivals with a fixed rate and
+  "time_of_day" with a rate that follows a daily profile
+- od_matrix: weights of each destination per origin (rows in origin order, columns in the order of
+  CityModel.destinations). Destinations are uniform without it
+- queue: cars whose entry cell is taken wait in a queue of their origin instead of being dropped
+- stop conditions: max_steps, max_cars (cars spawned, then the run ends when the last one arrives if drain)
+  and stop_when_blocked, the original rule that ends the run when no car can enter on a spawn step
+"""
+import math
+from collections import deque
+import numpy as np
+
+
+class IntervalDemand:
+    """One car per origin every interval steps."""
+    def __init__(self, interval=10):
+        """
+        Args:
+            interval: Steps between requests
+        """
+        self.interval = interval
+
+    def arrivals(self, step, origins, rng):
+        """Number of cars requested at each of the origins in step."""
+        return [1 if step % self.interval == 0 else 0] * origins
+
+
+class PoissonDemand:
+    """Poisson arrivals at every origin."""
+    def __init__(self, rate=0.1):
+        """
+        Args:
+            rate: Mean cars per step at each origin
+        """
+        self.rate = rate
+
+    def rate_at(self, step):
+        return self.rate
+
+    def arrivals(self, step, origins, rng):
+        limit = math.exp(-self.rate_at(step))
+        counts = []
+        for _ in range(origins):
+            # Knuth's method, fine for the small rates of one origin
+            count = 0
+            product = rng.random()
+            while product > limit:
+                count += 1
+                product *= rng.random()
+            counts.append(count)
+        return counts
+
+
+class TimeOfDayDemand(PoissonDemand):
+    """Poisson arrivals whose rate changes along a day, for example with rush hours."""
+    def __init__(self, rates=(0.02, 0.1, 0.05, 0.1), period=1000):
+        """
+        Args:
+            rates: Mean cars per step at each origin in each equal slot of the day
+            period: Steps of a day
+        """
+        super().__init__(rates[0])
+        self.rates = list(rates)
+        self.period = period
+
+    def rate_at(self, step):
+        return self.rates[(step % self.period) * len(self.rates) // self.period]
+
+
+DEMAND_PROFILES = {
+    "interval": IntervalDemand,
+    "poisson": PoissonDemand,
+    "time_of_day": TimeOfDayDemand
+}
+
+
+def origin_positions(model, origins):
+    """Positions of an origin set of model."""
+    width, height = model.width, model.height
+    if origins == "corners":
+        return [
+            (0, 0),                    # Bottom left
+            (0, height - 1),           # Top left
+            (width - 1, 0),            # Bottom right
+            (width - 1, height - 1)    # Top right
+        ]
+    if origins == "border":
+        # Road cells on the edge of the map that lead somewhere
+        road = model.cell_index.road
+        border = np.zeros_like(road, dtype=bool)
+        border[[0, -1], :] = True
+        border[:, [0, -1]] = True
+        return [(x, y) for x, y in np.argwhere(border & (road != 0)).tolist() if leads_somewhere(model, (x, y))]
+    if isinstance(origins, str):
+        raise ValueError(f"Unknown origin set: {origins}")
+
+    positions = []
+    for pos in origins:
+        if (not isinstance(pos, (list, tuple)) or len(pos) != 2
+                or not all(isinstance(value, int) and not isinstance(value, bool) for value in pos)):
+            raise ValueError(f"Origins must be [x, y] pairs of integers, got {pos!r}")
+        x, y = pos
+        if not (0 <= x < width and 0 <= y < height):
+            raise ValueError(f"Origin {[x, y]} is outside the {width}x{height} city")
+        if not model.cell_index.road[x, y] or not leads_somewhere(model, (x, y)):
+            raise ValueError(f"Origin {[x, y]} is not a road cell that leads somewhere")
+        positions.append((x, y))
+    return positions
+
+
+def leads_somewhere(model, pos):
+    """Whether a car at pos has at least one legal move."""
+    graph = model.road_graph
+    return any(True for _ in graph.legal_neighbors(graph.cell_id(pos)))
+
+
+class Spawner:
+    """
+    Adds the cars of a CityModel at the start of every step and decides when the run stops.
+    """
+    def __init__(self, model, origins="corners", demand="interval", od_matrix=None, queue=False, max_queue=100,
+                 max_active=0, max_steps=None, max_cars=None, drain=True, stop_when_blocked=None, **demand_args):
+        """
+        Args:
+            model: CityModel the cars are added to
+            origins: "corners", "border" or a list of [x, y] positions
+            demand: Demand profile, a key of DEMAND_PROFILES. "interval" takes the model's spawn_interval
+            od_matrix: Weights of the destinations of each origin, None for uniform destinations
+            queue: Keep the cars whose entry cell is taken (or that exceed max_active) until they can enter
+            max_queue: Largest number of cars waiting at one origin, the rest are dropped
+            max_active: Largest number of cars in the city at the same time, 0 for no limit
+            max_steps: Stop after this many steps
+            max_cars: Stop spawning after this many cars
+            drain: With max_cars, stop when the last car arrives
+            stop_when_blocked: Stop when cars are requested and none can enter. Defaults to not queue
+            demand_args: Arguments of the demand profile, like rate, rates or period
+        """
+        if demand not in DEMAND_PROFILES:
+            raise ValueError(f"Unknown demand profile: {demand}")
+        if demand == "interval":
+            demand_args.setdefault("interval", model.spawn_interval)
+
+        self.model = model
+        self.origins = origin_positions(model, origins)
+        self.demand = DEMAND_PROFILES[demand](**demand_args)
+        self.weights = None
+        if od_matrix is not None:
+            self.weights = np.asarray(od_matrix, dtype=float)
+            if self.weights.shape != (len(self.origins), len(model.destinations)):
+                raise ValueError(f"od_matrix must have one row per origin ({len(self.origins)}) "
+                                 f"and one column per destination ({len(model.destinations)})")
+            self.weights = self.weights.tolist()
+
+        self.queue = queue
+        self.max_queue = max_queue
+        self.max_active = max_active
+        self.max_steps = max_steps
+        self.max_cars = max_cars
+        self.drain = drain
+        self.stop_when_blocked = not queue if stop_when_blocked is None else stop_when_blocked
+
+        # Destination indexes waiting at each origin
+        self.queues = [deque() for _ in self.origins]
+        self.dropped = 0
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def done_spawning(self):
+        return self.max_cars is not None and self.model.car_count >= self.max_cars
+
+    def should_stop(self):
+        model = self.model
+        if self.max_steps is not None and model.schedule.steps >= self.max_steps:
+            return True
+        return self.drain and self.done_spawning() and not self.queued and not model.active_cars
+
+    def pick_destination(self, origin):
+        """Index in model.destinations of the destination of a new car, None if the origin sends no cars."""
+        model = self.model
+        if not model.destinations:
+            return None
+        if self.weights is None:
+            # Same draw as random.choice(model.destinations)
+            return model.random.randrange(len(model.destinations))
+        row = self.weights[origin]
+        if not any(row):
+            return None
+        return model.random.choices(range(len(row)), weights=row)[0]
+
+    def can_enter(self, pos):
+        """Whether a car can be added at pos now. Returns (can enter, limited by max_active)."""
+        model = self.model
+        if self.max_active and model.active_cars >= self.max_active:
+            return False, True
+        return not model.cell_index.cars[pos], False
+
+    def step(self):
+        """Adds the cars of this step. Returns True if the run should stop instead."""
+        if self.should_stop():
+            return True
+        requested, spawned, blocked_by_limit = self.spawn()
+        return self.stop_when_blocked and requested and not spawned and not blocked_by_limit
+
+    def spawn(self):
+        """
+        Adds the cars of this step without checking the stop conditions.
+        Returns (cars requested, whether any car entered, whether max_active kept a car out).
+        """
+        model = self.model
+        requested = 0
+        spawned = False
+        blocked_by_limit = False
+        counts = self.demand.arrivals(model.schedule.steps, len(self.origins), model.random)
+        for origin, pos in enumerate(self.origins):
+            for _ in range(counts[origin]):
+                if self.max_cars is not None and model.car_count + self.queued >= self.max_cars:
+                    break
+                requested += 1
+                if self.queue:
+                    destination = self.pick_destination(origin)
+                    if destination is None:
+                        continue
+                    if len(self.queues[origin]) < self.max_queue:
+                        self.queues[origin].append(destination)
+                    else:
+                        self.dropped += 1
+                    continue
+
+                free, limited = self.can_enter(pos)
+                blocked_by_limit |= limited
+                if not free:
+                    self.dropped += 1
+                    continue
+                destination = self.pick_destination(origin)
+                if destination is not None:
+                    model.add_car(pos, model.destinations[destination])
+                    spawned = True
+
+        # The first car of every queue enters if its cell is free
+        for origin, pos in enumerate(self.origins):
+            if self.queues[origin]:
+                free, limited = self.can_enter(pos)
+                blocked_by_limit |= limited
+                if free:
+                    model.add_car(pos, model.destinations[self.queues[origin].popleft()])
+                    spawned = True
+
+        return requested, spawned, blocked_by_limit
+
+    def checkpoint_state(self):
+        """Dictionary {name: numpy array} with the queues and counters, see checkpoint.capture."""
+        return {
+            "queue_lengths": np.array([len(queue) for queue in self.queues], dtype=np.int64),
+            "queued": np.array([destination for queue in self.queues for destination in queue], dtype=np.int64),
+            "dropped": np.array(self.dropped)
+        }
+
+    def restore_state(self, state):
+        queued = state["queued"].tolist()
+        start = 0
+        for queue, length in zip(self.queues, state["queue_lengths"].tolist()):
+            queue.clear()
+            queue.extend(queued[start:start + length])
+            start += length
+        self.dropped = int(state["dropped"])
@@ -0,0 +1,128 @@
+"""
+Parameter sweep over city files, light timings, spawn intervals and seeds.
+Every configuration runs in its own CityModel on a process pool and the results are gathered in one table.
+
+Example:
+    python sweep.py --maps 2023_base.txt 2024_base.txt --S 10 15 --s 5 7 --seeds 1 2 3 --steps 1000 --output sweep.csv
+    python sweep.py --light-controls fixed green_wave actuated max_pressure --seeds 1 2 3
+    python sweep.py --spawn '{"origins": "border", "demand": "poisson", "rate": 0.05, "queue": true}' --steps 2000
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from model import CityModel
+from traffic_control import LIGHT_CONTROLLERS
+
+COLUMNS = [
+    "map", "light_control", "S", "s", "spawn_interval", "seed", "steps", "cars_spawned", "cars_completed",
+    "active_cars", "completed_per_step", "mean_travel_time", "mean_wait_steps", "wall_time"
+]
+
+
+def parameter_grid(maps, light_timings, spawn_intervals, seeds, light_controls=("fixed",)):
+    """
+    Every combination of the given values.
+    Args:
+        maps: City file names
+        light_timings: List of {"S": steps, "s": steps} dictionaries
+        spawn_intervals: Steps between spawns
+        seeds: Seeds of the models
+        light_controls: Names of traffic light controllers
+    """
+    return [
+        {"map": city_file, "light_control": light_control, "light_timings": timings,
+         "spawn_interval": spawn_interval, "seed": seed}
+        for city_file, light_control, timings, spawn_interval, seed
+        in itertools.product(maps, light_controls, light_timings, spawn_intervals, seeds)
+    ]
+
+
+def run_configuration(config, steps, routing="next_hop", engine="vectorized", step_mode="sequential", spawn=None):
+    """Runs one configuration for up to steps steps and returns its row of the results table."""
+    start = time.perf_counter()
+    model = CityModel(0, city_file=config["map"], light_timings=config["light_timings"],
+                      spawn_interval=config["spawn_interval"], routing=routing, engine=engine, seed=config["seed"],
+                      light_control=config["light_control"], step_mode=step_mode, spawn=spawn)
+    steps_run = 0
+    while steps_run < steps and model.running:
+        model.step()
+        steps_run += 1
+
+    return {
+        "map": config["map"],
+        "light_control": config["light_control"],
+        "S": config["light_timings"]["S"],
+        "s": config["light_timings"]["s"],
+        "spawn_interval": config["spawn_interval"],
+        "seed": config["seed"],
+        "steps": steps_run,
+        "cars_spawned": model.car_count,
+        "cars_completed": model.cars_completed,
+        "active_cars": model.active_cars,
+        "completed_per_step": model.cars_completed / steps_run if steps_run else 0,
+        "mean_travel_time": model.total_travel_time / model.cars_completed if model.cars_completed else 0,
+        "mean_wait_steps": model.total_wait_steps / model.cars_completed if model.cars_completed else 0,
+        "wall_time": round(time.perf_counter() - start, 3)
+    }
+
+
+def run_sweep(configs, steps, workers=None, routing="next_hop", engine="vectorized", step_mode="sequential",
+              spawn=None):
+    """Runs every configuration on a process pool. Returns the rows in the order of configs."""
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_configuration, config, steps, routing, engine, step_mode, spawn) for config in configs]
+        return [future.result() for future in futures]
+
+
+def write_csv(rows, path):
+    with open(path, "w", newline="") as output:
+        writer = csv.DictWriter(output, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_table(rows):
+    widths = {column: max([len(column)] + [len(format_value(row[column])) for row in rows]) for column in COLUMNS}
+    print("  ".join(column.rjust(widths[column]) for column in COLUMNS))
+    for row in rows:
+        print("  ".join(format_value(row[column]).rjust(widths[column]) for column in COLUMNS))
+
+
+def format_value(value):
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run CityModel over a grid of parameters")
+    parser.add_argument("--maps", nargs="+", default=["2024_base.txt"], help="City files in city_files/")
+    parser.add_argument("--S", nargs="+", type=int, default=[15], help="Timings of the S lights")
+    parser.add_argument("--s", nargs="+", type=int, default=[7], help="Timings of the s lights")
+    parser.add_argument("--light-controls", nargs="+", choices=sorted(LIGHT_CONTROLLERS), default=["fixed"],
+                        help="Traffic light controllers")
+    parser.add_argument("--spawn-intervals", nargs="+", type=int, default=[10])
+    parser.add_argument("--seeds", nargs="+", type=int, default=[1])
+    parser.add_argument("--steps", type=int, default=1000, help="Maximum steps per run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--routing", choices=["astar", "next_hop", "congestion", "hierarchical", "hierarchical_ch"], default="next_hop")
+    parser.add_argument("--engine", choices=["mesa", "vectorized"], default="vectorized")
+    parser.add_argument("--step-mode", choices=["sequential", "synchronous"], default="sequential")
+    parser.add_argument("--spawn", type=json.loads, help="JSON object with the options of spawning.Spawner")
+    parser.add_argument("--output", help="CSV file for the results")
+    args = parser.parse_args()
+
+    light_timings = [{"S": big, "s": small} for big, small in itertools.product(args.S, args.s)]
+    configs = parameter_grid(args.maps, light_timings, args.spawn_intervals, args.seeds, args.light_controls)
+    rows = run_sweep(configs, args.steps, args.workers, args.routing, args.engine, args.step_mode, args.spawn)
+
+    print_table(rows)
+    if args.output:
+        write_csv(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+Traffic light controllers. A controller decides the state of every Traffic_Light of a CityModel;
+the model uses the one named by its light_control argument (see LIGHT_CONTROLLERS).
+
+Lights that touch each other (8-neighborhood) form an intersection. The lights of an intersection are split
+in phases by the axis of their road, and only one phase is green at a time. An intersection whose lights are
+all on one axis gets an empty phase, during which they are red.
+"""
+from abc import ABC, abstractmethod
+from collections import deque
+import numpy as np
+from road_graph import NEIGHBOR_OFFSETS
+
+VERTICAL = ("Up", "Down")
+
+
+class Intersection:
+    """
+    Lights of one crossing and the phase that is green.
+    """
+    def __init__(self, lights, phases, greens, center):
+        """
+        Args:
+            lights: Indexes in CityModel.traffic_lights of the lights of the intersection
+            phases: List with the light indexes of each phase
+            greens: Green steps of each phase when it runs on a fixed cycle
+            center: Mean (x, y) of the lights
+        """
+        self.lights = lights
+        self.phases = phases
+        self.greens = greens
+        self.center = center
+        self.phase = 0
+        # Steps since the phase turned green
+        self.elapsed = 0
+
+    @property
+    def cycle(self):
+        return sum(self.greens)
+
+
+def find_intersections(model):
+    """Groups the traffic lights of model in Intersections."""
+    cell_index = model.cell_index
+    lights = model.traffic_lights
+    seen = set()
+    intersections = []
+
+    for first in range(len(lights)):
+        if first in seen:
+            continue
+        seen.add(first)
+        group = [first]
+        queue = deque([first])
+        while queue:
+            x, y = lights[queue.popleft()].pos
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    pos = (x + dx, y + dy)
+                    if not cell_index.in_bounds(pos):
+                        continue
+                    neighbor = int(cell_index.light[pos])
+                    if neighbor >= 0 and neighbor not in seen:
+                        seen.add(neighbor)
+                        group.append(neighbor)
+                        queue.append(neighbor)
+
+        group.sort()
+        vertical = [light for light in group if cell_index.road_direction(lights[light].pos) in VERTICAL]
+        horizontal = [light for light in group if light not in vertical]
+        phases = [phase for phase in (vertical, horizontal) if phase]
+        greens = [max(lights[light].timeToChange for light in phase) for phase in phases]
+        if len(phases) == 1:
+            phases.append([])
+            greens.append(greens[0])
+
+        center = (sum(lights[light].pos[0] for light in group) / len(group),
+                  sum(lights[light].pos[1] for light in group) / len(group))
+        intersections.append(Intersection(group, phases, greens, center))
+
+    return intersections
+
+
+def detector_cells(road_graph, cell, depth, forward=False):
+    """
+    Road cells within depth moves before cell (after it if forward), not counting cell.
+    They are the approach lanes of a light, or the lanes it discharges into.
+    """
+    adjacency = road_graph.adjacency
+    legal = road_graph.legal
+    found = {cell: 0}
+    queue = deque([cell])
+    while queue:
+        current = queue.popleft()
+        if found[current] == depth:
+            continue
+        for slot in range(len(NEIGHBOR_OFFSETS)):
+            neighbor = adjacency[current * 4 + slot]
+            if neighbor < 0:
+                continue
+            # The opposite move of slot is 3 - slot in NEIGHBOR_OFFSETS order
+            edge = current * 4 + slot if forward else neighbor * 4 + 3 - slot
+            if legal[edge] and neighbor not in found:
+                found[neighbor] = found[current] + 1
+                queue.append(neighbor)
+    del found[cell]
+    return np.array(sorted(found), dtype=np.int64)
+
+
+class LightController:
+    """
+    Base controller. step is called once per model step before the agents move, and step_light
+    whenever a Traffic_Light agent is activated.
+    """
+    # True if the lights change while the agents are activated, like the original fixed timings
+    flips_in_step = False
+
+    def __init__(self, model):
+        self.model = model
+
+    def set_light(self, light, state):
+        if light.state != state:
+            light.state = state
+            self.model.deltas.light_toggled(light.unique_id, state)
+            if self.model.wakeups is not None:
+                self.model.wakeups.light_changed(light)
+
+    def step(self):
+        pass
+
+    def step_light(self, light):
+        pass
+
+    def checkpoint_state(self):
+        """Dictionary {name: numpy array} with the state of the controller besides the light states."""
+        return {}
+
+    def restore_state(self, state):
+        pass
+
+
+class FixedTimeController(LightController):
+    """
+    Every light flips on its own every timeToChange steps, when it is activated. This is the original behavior.
+    """
+    flips_in_step = True
+
+    def step_light(self, light):
+        if self.model.schedule.steps % light.timeToChange == 0:
+            self.set_light(light, not light.state)
+
+
+class PhaseController(LightController, ABC):
+    """
+    Base of the controllers that switch whole intersections between phases. Subclasses implement control.
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        self.intersections = find_intersections(model)
+        for intersection in self.intersections:
+            # Start with the phase that has a green light, like the map does
+            intersection.phase = next((p for p, phase in enumerate(intersection.phases)
+                                       if any(model.traffic_lights[light].state for light in phase)), 0)
+            self.apply(intersection)
+
+    def apply(self, intersection):
+        lights = self.model.traffic_lights
+        for p, phase in enumerate(intersection.phases):
+            for light in phase:
+                self.set_light(lights[light], p == intersection.phase)
+
+    def switch(self, intersection, phase):
+        if phase != intersection.phase:
+            intersection.phase = phase
+            intersection.elapsed = 0
+            self.apply(intersection)
+
+    def step(self):
+        for intersection in self.intersections:
+            intersection.elapsed += 1
+            self.control(intersection)
+
+    @abstractmethod
+    def control(self, intersection):
+        """Called every step for each intersection, after its elapsed steps are increased."""
+
+    def checkpoint_state(self):
+        return {
+            "phase": np.array([intersection.phase for intersection in self.intersections], dtype=np.int64),
+            "elapsed": np.array([intersection.elapsed for intersection in self.intersections], dtype=np.int64)
+        }
+
+    def restore_state(self, state):
+        for intersection, phase, elapsed in zip(self.intersections, state["phase"].tolist(), state["elapsed"].tolist()):
+            intersection.phase = phase
+            intersection.elapsed = elapsed
+
+
+class GreenWaveController(PhaseController):
+    """
+    Fixed cycles with one offset per intersection, so a car moving one cell per step towards +x or +y
+    reaches the next intersection as its phase turns green.
+    """
+    def __init__(self, model, speed=1):
+        """
+        Args:
+            model: CityModel whose lights are controlled
+            speed: Cells per step of the wave
+        """
+        self.speed = speed
+        super().__init__(model)
+
+    def offset(self, intersection):
+        x, y = intersection.center
+        return round((x + y) / self.speed)
+
+    def control(self, intersection):
+        position = (self.model.schedule.steps - self.offset(intersection)) % intersection.cycle
+        for phase, green in enumerate(intersection.greens):
+            if position < green:
+                self.switch(intersection, phase)
+                return
+            position -= green
+
+
+class QueueController(PhaseController):
+    """
+    Base of the controllers that read the cars on the approach lanes of the lights.
+    """
+    def __init__(self, model, min_green=5, detector_length=5):
+        """
+        Args:
+            model: CityModel whose lights are controlled
+            min_green: Steps a phase stays green before it can be switched
+            detector_length: Cells of road measured before (and after) every light
+        """
+        self.min_green = min_green
+        graph = model.road_graph
+        self.cars = model.cell_index.cars.reshape(-1)
+        self.upstream = [detector_cells(graph, graph.cell_id(light.pos), detector_length)
+                         for light in model.traffic_lights]
+        self.downstream = [detector_cells(graph, graph.cell_id(light.pos), detector_length, forward=True)
+                           for light in model.traffic_lights]
+        super().__init__(model)
+
+    def queue(self, phase):
+        """Cars waiting on the approach lanes of the lights of a phase."""
+        return sum(int(self.cars[self.upstream[light]].sum()) for light in phase)
+
+
+class ActuatedController(QueueController):
+    """
+    Keeps a phase green while cars keep arriving on its approaches, up to max_green steps,
+    and switches as soon as it is empty and another phase has cars waiting.
+    """
+    def __init__(self, model, min_green=3, max_green=20, detector_length=2):
+        """
+        Args:
+            model: CityModel whose lights are controlled
+            min_green: Steps a phase stays green before it can be switched
+            max_green: Steps after which a phase is switched if another one has cars waiting
+            detector_length: Cells of road measured before every light
+        """
+        self.max_green = max_green
+        super().__init__(model, min_green, detector_length)
+
+    def control(self, intersection):
+        if intersection.elapsed < self.min_green:
+            return
+        queues = [self.queue(phase) for phase in intersection.phases]
+        waiting = max((queue, p) for p, queue in enumerate(queues) if p != intersection.phase)
+        if waiting[0] and (not queues[intersection.phase] or intersection.elapsed >= self.max_green):
+            self.switch(intersection, waiting[1])
+
+
+class MaxPressureController(QueueController):
+    """
+    Gives green to the phase with the highest pressure: cars waiting before its lights
+    minus cars on the lanes they discharge into.
+    """
+    def pressure(self, phase):
+        return sum(int(self.cars[self.upstream[light]].sum()) - int(self.cars[self.downstream[light]].sum())
+                   for light in phase)
+
+    def control(self, intersection):
+        if intersection.elapsed < self.min_green:
+            return
+        pressures = [self.pressure(phase) if phase else 0 for phase in intersection.phases]
+        best = max(range(len(pressures)), key=lambda p: pressures[p])
+        if pressures[best] > pressures[intersection.phase]:
+            self.switch(intersection, best)
+
+
+LIGHT_CONTROLLERS = {
+    "fixed": FixedTimeController,
+    "green_wave": GreenWaveController,
+    "actuated": ActuatedController,
+    "max_pressure": MaxPressureController
+}
@@ -0,0 +1,268 @@
+"""
+Append-only log of the cars and lights of every step of a run, and its memory-mapped playback.
+
+A log starts with MAGIC, the size of its metadata and the metadata as JSON (city file, grid size and the
+id and position of every light, in the order of the bitsets). Then comes one frame per recorded step:
+
+    FRAME_HEADER (uint32 step, uint32 cars)
+    cars * binary_snapshot.CAR_RECORD
+    the light states as the bitset of binary_snapshot.pack_lights
+
+Frames are only ever appended, so a log being recorded can be played back at the same time. A trailing
+frame cut short by a crash is ignored. Playback never builds a CityModel: it maps the file and indexes
+the frames once, then any range of steps is read straight from the mapping.
+
+Example:
+    python trajectory_log.py --map 2024_base.txt --steps 1000 --seed 1 --output demo
+"""
+import argparse
+import bisect
+import json
+import mmap
+import os
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from binary_snapshot import CAR_RECORD, pack_cars, pack_lights
+from cell_index import DIRECTION_NAMES
+
+MAGIC = b"TRAJLOG1"
+METADATA_SIZE = np.dtype("<u4")
+FRAME_HEADER = np.dtype([
+    ("step", "<u4"),
+    ("cars", "<u4")
+])
+
+# Logs are files of this directory named <name>.trj
+RECORDINGS_DIR = "./recordings"
+LOG_EXTENSION = ".trj"
+LOG_NAME = re.compile(r"[A-Za-z0-9_.-]+")
+
+# Most logs kept mapped at the same time. The least recently read one is released first
+MAX_OPEN_LOGS = 16
+
+# Open TrajectoryLogs, by path, least recently read first
+_logs = OrderedDict()
+_lock = threading.Lock()
+
+
+def log_path(name):
+    """Path of the log with the given name. Raises ValueError for names that are not plain file names."""
+    if not LOG_NAME.fullmatch(name) or name.startswith("."):
+        raise ValueError("Log names may only have letters, digits, '_', '-' and '.'")
+    return os.path.join(RECORDINGS_DIR, name + LOG_EXTENSION)
+
+
+def log_names():
+    """Names of the logs in RECORDINGS_DIR."""
+    if not os.path.isdir(RECORDINGS_DIR):
+        return []
+    return sorted(file_name[:-len(LOG_EXTENSION)] for file_name in os.listdir(RECORDINGS_DIR)
+                  if file_name.endswith(LOG_EXTENSION))
+
+
+class TrajectoryWriter:
+    """
+    Records the steps of a CityModel at the end of a log file, from the model's DeltaTracker.
+    """
+    def __init__(self, model, path, step=None):
+        """
+        Creates the log and records the current state of the model as its first frame.
+        Raises FileExistsError if the file exists, logs are never overwritten.
+        Args:
+            model: CityModel recorded
+            path: Path of the new log
+            step: Step of the first frame, the step of the model's scheduler by default
+        """
+        self.model = model
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "xb")
+
+        metadata = json.dumps({
+            "city_file": model.city_file,
+            "width": model.width,
+            "height": model.height,
+            "lights": [{"id": light.unique_id, "x": light.pos[0], "y": light.pos[1]} for light in model.traffic_lights]
+        }).encode()
+        self.file.write(MAGIC + np.array(len(metadata), dtype=METADATA_SIZE).tobytes() + metadata)
+        self.frames = 0
+        # Set once the frame of the step where the model stopped running is written
+        self.finished = False
+        self.record(model.schedule.steps if step is None else step)
+
+    def record(self, step):
+        """
+        Appends the cars and lights of the model as the frame of step. Once the model stops running
+        its state no longer changes, so nothing is appended after that frame. Returns whether it appended.
+        """
+        if self.finished:
+            return False
+        self.finished = not self.model.running
+        deltas = self.model.deltas
+        cars = pack_cars(deltas)
+        header = np.array((step, len(cars) // CAR_RECORD.itemsize), dtype=FRAME_HEADER)
+        # One write per frame, flushed so that a playback of the same file sees whole frames
+        self.file.write(header.tobytes() + cars + pack_lights(deltas))
+        self.file.flush()
+        self.frames += 1
+        return True
+
+    def close(self):
+        self.file.close()
+
+
+class TrajectoryLog:
+    """
+    Read-only memory mapping of a log and the index of its frames.
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path: Path of the log
+        Raises ValueError if the file is not a log.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        with open(path, "rb") as logFile:
+            self.data = mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a trajectory log")
+        start = len(MAGIC) + METADATA_SIZE.itemsize
+        metadata_size = int(np.frombuffer(self.data, METADATA_SIZE, 1, len(MAGIC))[0])
+        self.metadata = json.loads(self.data[start:start + metadata_size])
+        self.light_bytes = (len(self.metadata["lights"]) + 7) // 8
+
+        # Step, offset and number of cars of every frame, and the end of the last whole frame
+        self.steps = []
+        self.offsets = []
+        self.car_counts = []
+        self.end = start + metadata_size
+        self.index()
+
+    def index(self):
+        """Indexes the whole frames after the last one indexed."""
+        data, offset, size = self.data, self.end, len(self.data)
+        while offset + FRAME_HEADER.itemsize <= size:
+            step, cars = np.frombuffer(data, FRAME_HEADER, 1, offset)[0].tolist()
+            end = offset + FRAME_HEADER.itemsize + cars * CAR_RECORD.itemsize + self.light_bytes
+            if end > size:
+                break
+            self.steps.append(step)
+            self.offsets.append(offset)
+            self.car_counts.append(cars)
+            offset = end
+        self.end = offset
+
+    def refresh(self):
+        """Maps and indexes the frames appended since the log was opened, if it is still being recorded."""
+        with self.lock:
+            if os.path.getsize(self.path) > len(self.data):
+                with open(self.path, "rb") as logFile:
+                    # The previous mapping is released once no frame read from it is alive
+                    self.data = mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ)
+                self.index()
+
+    def __len__(self):
+        return len(self.steps)
+
+    def first_step(self):
+        return self.steps[0] if self.steps else None
+
+    def last_step(self):
+        return self.steps[-1] if self.steps else None
+
+    def frame_range(self, first, last):
+        """Indices of the frames with first <= step <= last."""
+        return bisect.bisect_left(self.steps, first), bisect.bisect_right(self.steps, last)
+
+    def raw(self, first, last):
+        """Frames of the steps first to last as stored in the log, ready to be served."""
+        with self.lock:
+            start, stop = self.frame_range(first, last)
+            if start == stop:
+                return b""
+            end = self.offsets[stop] if stop < len(self.offsets) else self.end
+            return self.data[self.offsets[start]:end]
+
+    def frames(self, first, last):
+        """
+        Frames of the steps first to last in the format of DeltaTracker.snapshot:
+        {"step", "cars": [{"id", "x", "y", "direction"}], "lights": [{"id", "x", "y", "state"}]}
+        """
+        with self.lock:
+            start, stop = self.frame_range(first, last)
+            return [self.frame(i) for i in range(start, stop)]
+
+    def frame(self, i):
+        offset = self.offsets[i] + FRAME_HEADER.itemsize
+        cars = np.frombuffer(self.data, CAR_RECORD, self.car_counts[i], offset).tolist()
+        offset += self.car_counts[i] * CAR_RECORD.itemsize
+        bits = np.frombuffer(self.data, np.uint8, self.light_bytes, offset)
+        lights = self.metadata["lights"]
+        states = np.unpackbits(bits, count=len(lights), bitorder="little").astype(bool).tolist()
+        return {
+            "step": self.steps[i],
+            "cars": [{"id": f"car_{car_id}", "x": x, "y": y, "direction": DIRECTION_NAMES[direction]}
+                     for car_id, x, y, direction in cars],
+            "lights": [{"id": light["id"], "x": light["x"], "y": light["y"], "state": state}
+                       for light, state in zip(lights, states)]
+        }
+
+    def summary(self):
+        return {"cityFile": self.metadata["city_file"], "frames": len(self),
+                "firstStep": self.first_step(), "lastStep": self.last_step()}
+
+
+def open_log(name):
+    """
+    TrajectoryLog of the log with the given name, mapped the first time it is read and refreshed after that.
+    Raises ValueError for invalid names or files and FileNotFoundError if there is no such log.
+    """
+    path = log_path(name)
+    with _lock:
+        log = _logs.get(path)
+        if log is None:
+            log = _logs[path] = TrajectoryLog(path)
+            # The mapping of an evicted log is released once no request is reading it
+            while len(_logs) > MAX_OPEN_LOGS:
+                _logs.popitem(last=False)
+            return log
+        _logs.move_to_end(path)
+    log.refresh()
+    return log
+
+
+def main():
+    from model import CityModel
+
+    parser = argparse.ArgumentParser(description="Record a run of CityModel as a trajectory log")
+    parser.add_argument("--map", default="2024_base.txt", help="City file in city_files/")
+    parser.add_argument("--steps", type=int, default=1000, help="Maximum steps recorded")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--engine", choices=["mesa", "vectorized"], default="vectorized")
+    parser.add_argument("--routing", choices=["astar", "next_hop", "congestion"], default="next_hop")
+    parser.add_argument("--step-mode", choices=["sequential", "synchronous"], default="sequential")
+    parser.add_argument("--output", required=True, help=f"Name of the log in {RECORDINGS_DIR}")
+    args = parser.parse_args()
+
+    model = CityModel(0, city_file=args.map, routing=args.routing, engine=args.engine, seed=args.seed,
+                      step_mode=args.step_mode)
+    writer = TrajectoryWriter(model, log_path(args.output))
+    try:
+        for _ in range(args.steps):
+            if not model.running:
+                break
+            model.step()
+            writer.record(model.schedule.steps)
+    finally:
+        writer.close()
+    print(f"Recorded {writer.frames} frames in {writer.path}")
+
+
+if __name__ == "__main__":
+    main()
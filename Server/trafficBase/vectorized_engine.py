@@ -0,0 +1,516 @@
+import numpy as np
+from road_graph import NEIGHBOR_OFFSETS, NO_ROUTE
+from cell_index import DIRECTION_CODES, DIRECTION_NAMES
+
+# Direction code of each move, in NEIGHBOR_OFFSETS order
+MOVE_CODES = (DIRECTION_CODES["Left"], DIRECTION_CODES["Down"], DIRECTION_CODES["Up"], DIRECTION_CODES["Right"])
+
+# Arrays with the state of the cars and their types
+CAR_COLUMNS = {
+    "ids": np.int64,
+    "cell": np.int64,
+    "destination": np.int64,
+    "route_start": np.int64,
+    "route_len": np.int64,
+    "cursor": np.int64,
+    "direction": np.uint8,
+    "waiting": np.int64,
+    "wait_steps": np.int64,
+    "spawn_step": np.int64
+}
+
+MOORE_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+class VectorizedEngine:
+    """
+    Headless stepping engine for CityModel. Cars are not Mesa agents: their state is kept as
+    arrays (cells, destination ids, route cursors, wait counters) and all cars are advanced at once.
+
+    The engine reproduces the RandomActivation semantics of the Mesa path exactly, so a model run with
+    the same seed produces the same statistics. Cars whose outcome cannot depend on the activation order
+    (their next cell is free and no other car can enter it this step) are resolved and moved in bulk.
+    Only the cars that compete for a cell are resolved one by one, in activation order.
+    With CityModel(step_mode="synchronous") the cars are resolved by parallel_moves.MoveResolver instead.
+    """
+    def __init__(self, model):
+        """
+        Args:
+            model: CityModel whose cars are stepped by the engine
+        """
+        if model.congestion is not None:
+            raise ValueError("Congestion routing depends on every car's own path, use the mesa engine")
+        self.model = model
+        graph = model.road_graph
+        cell_index = model.cell_index
+        self.width = model.width
+        self.height = model.height
+        self.size = graph.size
+
+        # Flat views over the cell index, indexed by road graph cell id
+        self.road = cell_index.road.reshape(-1)
+        self.obstacle = cell_index.obstacle.reshape(-1)
+        self.occupancy = cell_index.cars.reshape(-1)
+        self.light_of_cell = cell_index.light.reshape(-1)
+        self.legal = np.frombuffer(graph.legal, dtype=np.uint8).reshape(-1, 4)
+        # Cells a car can fall back to, as plain Python values for the one by one resolution
+        self.drivable = ((self.road != 0) & ~self.obstacle).tolist()
+        self.road_names = [DIRECTION_NAMES[code] for code in self.road.tolist()]
+        self.cell_occupancy = None
+
+        # Cell id difference of each move, in NEIGHBOR_OFFSETS order
+        self.offsets = np.array([dx * self.height + dy for dx, dy in NEIGHBOR_OFFSETS], dtype=np.int64)
+        self.move_codes = np.array(MOVE_CODES, dtype=np.uint8)
+        self.slot_of_offset = {offset: slot for slot, offset in enumerate(self.offsets.tolist())}
+
+        self.light_state = np.array([light.state for light in model.traffic_lights], dtype=bool)
+        self.light_period = np.array([light.timeToChange for light in model.traffic_lights], dtype=np.int64)
+
+        self.destination_ids = {destination.pos: i for i, destination in enumerate(model.destinations)}
+        self.destination_cells = np.array([graph.cell_id(destination.pos) for destination in model.destinations], dtype=np.int64)
+        self.fields = None
+        if model.next_hops is not None:
+            self.fields = np.stack([np.frombuffer(model.next_hops.fields[destination.pos], dtype=np.uint8)
+                                    for destination in model.destinations])
+
+        # Car state, one entry per active car in spawn order
+        for name, dtype in CAR_COLUMNS.items():
+            setattr(self, name, np.empty(0, dtype=dtype))
+        # Cars added since the last step, as dictionaries of the columns that are not zero
+        self.pending = []
+
+        # Routes shared by the cars, stored back to back as cell ids
+        self.route_pool = np.empty(1024, dtype=np.int64)
+        self.pool_used = 0
+        self.route_offsets = {}
+        self.route_version = graph.version
+
+        # Mesa versions whose scheduler keeps agents in an AgentSet shuffle it in place every step,
+        # older ones shuffle the keys in insertion order. The activation order follows the scheduler.
+        self.persistent_order = not isinstance(getattr(model.schedule, "_agents", None), dict)
+        self.activation_order = list(range(len(model.traffic_lights)))
+
+        # New cars get the id car_count * id_stride + id_offset, so the tiles of a sharded run never share one
+        self.id_stride = 1
+        self.id_offset = 0
+
+    def add_car(self, pos, destination):
+        """Adds a car at pos heading to destination. It is activated from the next step on."""
+        car_id = self.model.car_count * self.id_stride + self.id_offset
+        self.pending.append({
+            "ids": car_id,
+            "cell": pos[0] * self.height + pos[1],
+            "destination": self.destination_ids[destination.pos],
+            "spawn_step": self.model.schedule.steps
+        })
+        self.occupancy[pos[0] * self.height + pos[1]] += 1
+        self.model.deltas.car_spawned(f"car_{car_id}", pos, None)
+        if self.persistent_order:
+            self.activation_order.append(len(self.light_state) + car_id)
+
+    def import_car(self, car_id, cell, destination, spawn_step, wait_steps, waiting, direction):
+        """
+        Adds a car that another tile of a sharded run handed over, keeping its id and counters.
+        It is not counted as spawned, and it plans its route again from cell.
+        """
+        self.pending.append({
+            "ids": car_id,
+            "cell": cell,
+            "destination": destination,
+            "spawn_step": spawn_step,
+            "wait_steps": wait_steps,
+            "waiting": waiting,
+            "direction": direction
+        })
+        self.occupancy[cell] += 1
+        self.model.active_cars += 1
+        self.model.deltas.car_spawned(f"car_{car_id}", divmod(cell, self.height), DIRECTION_NAMES[direction] if direction else None)
+
+    def remove_cars(self, car_ids):
+        """Takes the cars with the given ids off the grid without recording a trip, when they are handed over."""
+        self.flush_pending()
+        remove = np.isin(self.ids, car_ids)
+        np.subtract.at(self.occupancy, self.cell[remove], 1)
+        for car_id in self.ids[remove].tolist():
+            self.model.deltas.car_removed(f"car_{car_id}")
+        if self.persistent_order:
+            done = set((self.ids[remove] + len(self.light_state)).tolist())
+            self.activation_order = [agent for agent in self.activation_order if agent not in done]
+        self.model.active_cars -= int(np.count_nonzero(remove))
+        for name in CAR_COLUMNS:
+            setattr(self, name, getattr(self, name)[~remove])
+
+    def positions(self):
+        """List of (car id, (x, y), direction) of the active cars."""
+        self.flush_pending()
+        return [(int(car_id), divmod(int(cell), self.height), DIRECTION_NAMES[code] if code else None)
+                for car_id, cell, code in zip(self.ids, self.cell, self.direction)]
+
+    def checkpoint_state(self):
+        """Dictionary {name: numpy array} with the car columns, their routes and the activation order."""
+        self.flush_pending()
+        state = {name: getattr(self, name).copy() for name in CAR_COLUMNS}
+        # Every car keeps its own copy of its route, the shared pool also has routes nobody uses anymore
+        route_ends = np.cumsum(self.route_len)
+        offsets = np.arange(int(route_ends[-1]) if len(route_ends) else 0) - np.repeat(route_ends - self.route_len, self.route_len)
+        state["routes"] = self.route_pool[np.repeat(self.route_start, self.route_len) + offsets]
+        state["activation_order"] = np.array(self.activation_order, dtype=np.int64)
+        return state
+
+    def restore_state(self, state):
+        """Replaces the cars with the ones of a state returned by checkpoint_state."""
+        self.flush_pending()
+        deltas = self.model.deltas
+        for car_id in self.ids.tolist():
+            deltas.car_removed(f"car_{car_id}")
+        np.subtract.at(self.occupancy, self.cell, 1)
+
+        for name, dtype in CAR_COLUMNS.items():
+            setattr(self, name, state[name].astype(dtype))
+        self.route_start = np.cumsum(self.route_len) - self.route_len
+        self.route_pool = np.resize(state["routes"].astype(np.int64), max(1024, len(state["routes"])))
+        self.pool_used = len(state["routes"])
+        self.route_offsets = {}
+        self.route_version = self.model.road_graph.version
+        self.activation_order = state["activation_order"].tolist()
+        self.light_state = np.array([light.state for light in self.model.traffic_lights], dtype=bool)
+
+        np.add.at(self.occupancy, self.cell, 1)
+        for car_id, cell, code in zip(self.ids.tolist(), self.cell.tolist(), self.direction.tolist()):
+            deltas.car_spawned(f"car_{car_id}", divmod(cell, self.height), DIRECTION_NAMES[code] if code else None)
+
+    def flush_pending(self):
+        if not self.pending:
+            return
+        for name, dtype in CAR_COLUMNS.items():
+            added = np.array([car.get(name, 0) for car in self.pending], dtype=dtype)
+            setattr(self, name, np.concatenate((getattr(self, name), added)))
+        self.pending = []
+
+    def activation_ranks(self):
+        """
+        Shuffles the agents like RandomActivation does and returns the rank of each light and of each car.
+        """
+        model = self.model
+        n_lights = len(self.light_state)
+        if self.persistent_order:
+            order = self.activation_order
+        else:
+            order = list(range(n_lights)) + (self.ids + n_lights).tolist()
+        model.random.shuffle(order)
+
+        rank_of = np.empty(n_lights + model.car_count, dtype=np.int64)
+        rank_of[np.array(order, dtype=np.int64)] = np.arange(len(order))
+        return rank_of[:n_lights], rank_of[n_lights + self.ids]
+
+    def assign_route(self, car):
+        """Asks the route cache for the route of a car that has none, like Car.find_path."""
+        graph = self.model.road_graph
+        if self.route_version != graph.version:
+            self.route_offsets = {}
+            self.pool_used = 0
+            self.route_version = graph.version
+
+        pos = divmod(int(self.cell[car]), self.height)
+        destination = self.model.destinations[self.destination[car]].pos
+        route = self.model.route_cache.get(pos, destination)
+        if not route:
+            self.route_len[car] = 0
+            return False
+
+        key = (pos, destination)
+        if key not in self.route_offsets:
+            if self.pool_used + len(route) > len(self.route_pool):
+                self.route_pool = np.resize(self.route_pool, max(2 * len(self.route_pool), self.pool_used + len(route)))
+            self.route_pool[self.pool_used:self.pool_used + len(route)] = [x * self.height + y for x, y in route]
+            self.route_offsets[key] = (self.pool_used, len(route))
+            self.pool_used += len(route)
+
+        self.route_start[car], self.route_len[car] = self.route_offsets[key]
+        # Skip the current position, like Car.move does with path[0]
+        self.cursor[car] = 1 if route[0] == pos else 0
+        return True
+
+    def moore_claims(self, cells):
+        """Number of the given cars that could fall back to each cell (Moore neighborhood of their cell)."""
+        x, y = np.divmod(cells, self.height)
+        claims = np.zeros(self.size, dtype=np.int64)
+        for dx, dy in MOORE_OFFSETS:
+            nx, ny = x + dx, y + dy
+            inside = (nx >= 0) & (nx < self.width) & (ny >= 0) & (ny < self.height)
+            np.add.at(claims, nx[inside] * self.height + ny[inside], 1)
+        return claims
+
+    def is_free(self, pos):
+        """Same as Car.is_valid_cell plus the road check of the lane change fallback."""
+        x, y = pos
+        if x < 0 or x >= self.width or y < 0 or y >= self.height:
+            return False
+        cell = x * self.height + y
+        return self.drivable[cell] and not self.cell_occupancy[cell]
+
+    def resolve_blocked(self, car, next_cell, valid):
+        """
+        Resolves a car whose next cell may be taken by another car, reading the occupancy left by
+        the cars activated before it. Mirrors the move and fallback logic of Car.move.
+        """
+        cell = int(self.cell[car])
+        occupancy = self.cell_occupancy
+
+        if valid and not occupancy[next_cell]:
+            self.move(car, cell, next_cell)
+            self.cursor[car] += 1
+            self.direction[car] = self.move_codes[self.slot_of_offset[next_cell - cell]]
+            return
+
+        if not occupancy[next_cell]:
+            # Waiting for the light or for a legal turn
+            return
+
+        direction = self.road_names[cell]
+        if not direction:
+            return
+        x, y = divmod(cell, self.height)
+        if direction in ["Left", "Right"]:
+            lanes = [(x, y + 1), (x, y - 1)]
+        else:
+            lanes = [(x + 1, y), (x - 1, y)]
+
+        profiler = self.model.profiler
+        new_pos = None
+        for lane_pos in lanes:
+            if self.is_free(lane_pos):
+                new_pos = lane_pos
+                if profiler is not None:
+                    profiler.count("lane_change_fallbacks")
+                break
+
+        if new_pos is None:
+            all_neighbors = self.model.grid.get_neighborhood((x, y), moore=True, include_center=False)
+            valid_moves = [pos for pos in all_neighbors if self.is_free(pos)]
+            if valid_moves:
+                new_pos = self.model.random.choice(valid_moves)
+                if profiler is not None:
+                    profiler.count("random_move_fallbacks")
+
+        if new_pos is not None:
+            self.move(car, cell, new_pos[0] * self.height + new_pos[1])
+            # Recalculate the route from the new position
+            self.route_len[car] = 0
+
+    def move(self, car, cell, new_cell):
+        self.cell_occupancy[cell] -= 1
+        self.cell_occupancy[new_cell] += 1
+        self.cell[car] = new_cell
+
+    def next_cells(self, cells, active):
+        """
+        Next cell of every active car from its route or from the next-hop field of its destination.
+        Returns (next cell ids, -1 where there is none, mask of the cars that have one).
+        """
+        next_cell = np.full(len(cells), -1, dtype=np.int64)
+        if self.fields is not None:
+            slot = self.fields[self.destination, cells]
+            has_next = active & (slot != NO_ROUTE)
+            next_cell[has_next] = cells[has_next] + self.offsets[slot[has_next]]
+        else:
+            for car in np.flatnonzero(active & (self.route_len == 0)):
+                self.assign_route(car)
+            has_next = active & (self.route_len > 0) & (self.cursor < self.route_len)
+            next_cell[has_next] = self.route_pool[self.route_start[has_next] + self.cursor[has_next]]
+        self.waiting[active & ~has_next] += 1
+        return next_cell, has_next
+
+    def step(self):
+        """Advances every car and light one step, like RandomActivation.step."""
+        model = self.model
+        if model.move_resolver is not None:
+            self.step_synchronous()
+            return
+        self.flush_pending()
+        light_rank, car_rank = self.activation_ranks()
+        if model.light_controller.flips_in_step:
+            # Fixed timings: each light flips when it is activated
+            flips = model.schedule.steps % self.light_period == 0
+        else:
+            # The controller already set the lights for the whole step
+            self.light_state = np.array([light.state for light in model.traffic_lights], dtype=bool)
+            flips = np.zeros(len(self.light_state), dtype=bool)
+
+        cells = self.cell.copy()
+        arrived = cells == self.destination_cells[self.destination]
+        active = ~arrived
+
+        next_cell, has_next = self.next_cells(cells, active)
+        movers = np.flatnonzero(has_next)
+        origin = cells[movers]
+        target = next_cell[movers]
+        # The offsets are in increasing order (-height, -1, 1, height)
+        slot = np.searchsorted(self.offsets, target - origin)
+
+        # Turn rules and the state of the light in the target cell at the moment the car is activated
+        valid = self.legal[origin, slot].astype(bool)
+        light = self.light_of_cell[target]
+        lit = np.flatnonzero(light >= 0)
+        lights = light[lit]
+        state = self.light_state[lights] ^ (flips[lights] & (light_rank[lights] < car_rank[movers[lit]]))
+        valid[lit] &= state
+
+        # A car can only be blocked if its target is taken, another car moves into it, or another blocked
+        # car may fall back into it. Iterate until the set of possibly blocked cars stops growing.
+        occupied = self.occupancy[target] > 0
+        entering = np.bincount(target[valid], minlength=self.size)
+        contested = occupied | (entering[target] - valid > 0)
+        blocked = contested
+        while True:
+            fallback = self.moore_claims(origin[blocked])
+            grown = contested | (fallback[target] - blocked > 0)
+            if np.array_equal(grown, blocked):
+                break
+            blocked = grown
+
+        # Cars that certainly move, applied in bulk at the end
+        free_movers = movers[~blocked & valid]
+        free_origin = origin[~blocked & valid]
+        free_target = target[~blocked & valid]
+        free_slot = slot[~blocked & valid]
+
+        # Cells vacated or entered by the free movers and the arrived cars, ordered by activation
+        arrived_cars = np.flatnonzero(arrived)
+        event_rank = np.concatenate((car_rank[free_movers], car_rank[arrived_cars]))
+        event_origin = np.concatenate((free_origin, cells[arrived_cars]))
+        event_target = np.concatenate((free_target, np.full(len(arrived_cars), -1, dtype=np.int64)))
+        event_order = np.argsort(event_rank, kind="stable")
+        event_rank = event_rank[event_order].tolist()
+        event_origin = event_origin[event_order].tolist()
+        event_target = event_target[event_order].tolist()
+
+        # Contended cars, one by one in activation order
+        contended = movers[blocked]
+        contended_target = target[blocked].tolist()
+        contended_valid = valid[blocked].tolist()
+        contended_order = np.argsort(car_rank[contended], kind="stable").tolist()
+        contended = contended.tolist()
+
+        occupancy = self.cell_occupancy = self.occupancy.tolist()
+        applied = 0
+        for i in contended_order:
+            rank = car_rank[contended[i]]
+            while applied < len(event_rank) and event_rank[applied] < rank:
+                occupancy[event_origin[applied]] -= 1
+                if event_target[applied] >= 0:
+                    occupancy[event_target[applied]] += 1
+                applied += 1
+            self.resolve_blocked(contended[i], contended_target[i], contended_valid[i])
+        for i in range(applied, len(event_rank)):
+            occupancy[event_origin[i]] -= 1
+            if event_target[i] >= 0:
+                occupancy[event_target[i]] += 1
+        self.occupancy[:] = occupancy
+        self.cell_occupancy = None
+
+        self.cell[free_movers] = free_target
+        self.cursor[free_movers] += 1
+        self.direction[free_movers] = self.move_codes[free_slot]
+
+        self.finish_step(cells, arrived, flips)
+
+    def finish_step(self, cells, arrived, flips=None):
+        """
+        Reports the moves of the step, removes the cars that were at their destination,
+        toggles the lights in flips (if given) and advances the step counter.
+        Args:
+            cells: Cell of every car at the start of the step
+            arrived: Mask of the cars that were at their destination
+            flips: Mask of the lights that change at the end of the step
+        """
+        model = self.model
+        active = ~arrived
+        arrived_cars = np.flatnonzero(arrived)
+
+        # Report the cars that changed cell this step
+        deltas = model.deltas
+        moved = np.flatnonzero(self.cell != cells)
+        self.wait_steps[active & (self.cell == cells)] += 1
+        for car_id, cell, code in zip(self.ids[moved].tolist(), self.cell[moved].tolist(), self.direction[moved].tolist()):
+            deltas.car_moved(f"car_{car_id}", divmod(cell, self.height), DIRECTION_NAMES[code] if code else None)
+        for car_id in self.ids[arrived_cars].tolist():
+            deltas.car_removed(f"car_{car_id}")
+
+        # Remove the cars that were already at their destination
+        if len(arrived_cars):
+            keep = ~arrived
+            if self.persistent_order:
+                done = set((self.ids[arrived_cars] + len(self.light_state)).tolist())
+                self.activation_order = [agent for agent in self.activation_order if agent not in done]
+            model.cars_completed += len(arrived_cars)
+            model.active_cars -= len(arrived_cars)
+            model.total_travel_time += int((model.schedule.steps - self.spawn_step[arrived_cars]).sum())
+            model.total_wait_steps += int(self.wait_steps[arrived_cars].sum())
+            model.trips.extend(self.ids[arrived_cars], self.spawn_step[arrived_cars],
+                               np.full(len(arrived_cars), model.schedule.steps), self.wait_steps[arrived_cars])
+            for name in CAR_COLUMNS:
+                setattr(self, name, getattr(self, name)[keep])
+
+        if flips is not None:
+            self.toggle_lights(flips)
+
+        model.schedule.steps += 1
+        model.schedule.time += 1
+
+    def toggle_lights(self, flips):
+        """Toggles the lights in flips and keeps the Traffic_Light agents in sync."""
+        self.light_state ^= flips
+        for light in np.flatnonzero(flips):
+            self.model.traffic_lights[light].state = bool(self.light_state[light])
+            self.model.deltas.light_toggled(self.model.traffic_lights[light].unique_id, self.model.traffic_lights[light].state)
+
+    def step_synchronous(self):
+        """
+        Two-phase step (see parallel_moves): the lights switch first, every car proposes its next cell
+        from the state at the start of the step and the model's MoveResolver grants them.
+        """
+        model = self.model
+        if model.light_controller.flips_in_step:
+            self.toggle_lights(model.schedule.steps % self.light_period == 0)
+        else:
+            self.light_state = np.array([light.state for light in model.traffic_lights], dtype=bool)
+
+        cells, arrived, next_cell, valid = self.propose_moves()
+        new_cell, fallback = model.move_resolver.resolve(cells, next_cell, valid, arrived, self.wait_steps, self.ids)
+        self.apply_moves(cells, arrived, new_cell, fallback)
+        self.finish_step(cells, arrived)
+
+    def propose_moves(self):
+        """
+        First phase of the synchronous step, with the lights already switched.
+        Returns (cell of every car, mask of the cars at their destination, proposed next cells, -1 where
+        there is none, whether each proposal follows the turn rules and the lights).
+        """
+        self.flush_pending()
+        cells = self.cell.copy()
+        arrived = cells == self.destination_cells[self.destination]
+        next_cell, has_next = self.next_cells(cells, ~arrived)
+
+        # Turn rules and the lights of the target cells
+        movers = np.flatnonzero(has_next)
+        origin = cells[movers]
+        target = next_cell[movers]
+        valid = np.zeros(len(cells), dtype=bool)
+        valid[movers] = self.legal[origin, np.searchsorted(self.offsets, target - origin)]
+        light = self.light_of_cell[target]
+        lit = light >= 0
+        valid[movers[lit]] &= self.light_state[light[lit]]
+        return cells, arrived, next_cell, valid
+
+    def apply_moves(self, cells, arrived, new_cell, fallback):
+        """Moves the cars to the cells granted by a MoveResolver (new_cell, -1 for the ones that stay)."""
+        moved = new_cell >= 0
+        on_route = moved & ~fallback
+        np.subtract.at(self.occupancy, cells[moved | arrived], 1)
+        np.add.at(self.occupancy, new_cell[moved], 1)
+        self.cell[moved] = new_cell[moved]
+        self.cursor[on_route] += 1
+        self.direction[on_route] = self.move_codes[np.searchsorted(self.offsets, new_cell[on_route] - cells[on_route])]
+        # Recalculate the route of the cars that fell back
+        self.route_len[fallback] = 0
@@ -0,0 +1,108 @@
+"""
+Wake-up mode of the mesa engine, enabled with CityModel(wakeups=True).
+
+Under congestion most agents do nothing in a step: a car queued at a red light checks the same light and cell
+every step, and a fixed-time light only flips every timeToChange steps. In this mode those agents sleep, and
+their step returns at once (a sleeping car only counts the step as waited) until an event wakes them:
+
+- A car whose move is not allowed into a free cell (red light or turn) sleeps until the light of that cell
+  changes or a car enters the cell, when Car.move would fall back.
+- A car whose next cell is taken and that has no free neighbor to fall back to sleeps until a car enters or
+  leaves one of its 8 neighbors.
+- Fixed-time lights are kept in a timing wheel by the step of their next flip and are only awake in that step.
+  The other controllers switch the lights in LightController.step, so their lights never wake.
+
+The events are raised by the grid and the light controller as they happen, so a car woken in the middle of
+a step moves in that same step if it is activated later, like it would have when checking every step.
+The agents stay in the scheduler, so the activation order and the runs are the same as without wake-ups.
+"""
+
+
+class Wakeups:
+    """
+    Sleeping cars and lights of a CityModel and the events that wake them.
+    """
+    def __init__(self, model):
+        """
+        Args:
+            model: CityModel run by the mesa engine
+        """
+        self.model = model
+        # Cars waiting for a cell, by (x, y), and for a light, by index in model.traffic_lights.
+        # Entries are (car, nap) and only wake the car if it is still in the same nap
+        self.cell_watchers = {}
+        self.light_watchers = {}
+        self.light_index = {light.unique_id: i for i, light in enumerate(model.traffic_lights)}
+        # Timing wheel of the fixed-time lights: step -> lights that flip in it
+        self.wheel = {}
+        self.reset()
+
+    def reset(self):
+        """Wakes every car and schedules the lights again, after the state of the model was replaced."""
+        self.cell_watchers = {}
+        self.light_watchers = {}
+        self.wheel = {}
+        model = self.model
+        for agent in model.schedule.agents:
+            agent.asleep = False
+        for light in model.traffic_lights:
+            light.asleep = True
+        if model.light_controller.flips_in_step:
+            steps = model.schedule.steps
+            for light in model.traffic_lights:
+                # Next multiple of timeToChange, the steps in which FixedTimeController flips the light
+                self.wheel.setdefault(steps - steps % -light.timeToChange, []).append(light)
+
+    def advance(self):
+        """Wakes the lights that flip in the step about to run."""
+        for light in self.wheel.pop(self.model.schedule.steps, ()):
+            light.asleep = False
+
+    def light_stepped(self, light):
+        """Puts a light back to sleep until its next flip."""
+        light.asleep = True
+        self.wheel.setdefault(self.model.schedule.steps + light.timeToChange, []).append(light)
+
+    def sleep(self, car, cells=(), light=None):
+        """Puts car to sleep until a car enters or leaves one of cells or the light changes."""
+        car.asleep = True
+        car.nap += 1
+        for cell in cells:
+            self.cell_watchers.setdefault(cell, []).append((car, car.nap))
+        if light is not None:
+            self.light_watchers.setdefault(light, []).append((car, car.nap))
+        if self.model.profiler is not None:
+            self.model.profiler.count("car_sleeps")
+
+    def sleep_at_light(self, car):
+        """Car whose move into a free cell is not allowed. In the synchronous step mode it only waits for the light."""
+        next_pos = car.next_pos
+        light = int(self.model.cell_index.light[next_pos])
+        cells = () if self.model.move_resolver is not None else (next_pos,)
+        self.sleep(car, cells, light if light >= 0 else None)
+
+    def sleep_blocked(self, car):
+        """Car whose next cell is taken and that could not fall back to a neighbor."""
+        self.sleep(car, self.model.grid.get_neighborhood(car.pos, moore=True, include_center=False))
+
+    def wake(self, watchers):
+        for car, nap in watchers:
+            if car.nap == nap:
+                car.asleep = False
+
+    def cell_changed(self, pos):
+        watchers = self.cell_watchers.pop(pos, None)
+        if watchers:
+            self.wake(watchers)
+
+    def light_changed(self, light):
+        watchers = self.light_watchers.pop(self.light_index[light.unique_id], None)
+        if watchers:
+            self.wake(watchers)
+
+    def car_moved(self, car, old_pos, pos):
+        """A car changed cell: it is awake, and so are the cars waiting for either cell."""
+        car.asleep = False
+        car.nap += 1
+        self.cell_changed(old_pos)
+        self.cell_changed(pos)
@@ -39,6 +39,17 @@ let obstacleModelData;
 // Define the agent server URI
 const agent_server_uri = "http://localhost:8585/";
 
+// Id of the simulation session created by /init
+let sessionId = null;
+
+/*
+ * URL of a server endpoint for the current session.
+ */
+function sessionUrl(path) {
+    const separator = path.includes("?") ? "&" : "?";
+    return agent_server_uri + path + separator + "session=" + sessionId;
+}
+
 // Initialize arrays to store agents and obstacles
 const agents = [];
 const obstacles = [];
@@ -54,7 +65,8 @@ let frameCount = 0;
 
 // Define the data object
 const data = {
-  NAgents: 500,
+  // Largest number of cars in the city at the same time, 0 for no limit (the server default)
+  NAgents: 0,
   width: 100,
   height: 100
 };
@@ -102,6 +114,7 @@ async function main() {
     // Get the agents and obstacles
     await getAgents();
     await getObstacles();
+    subscribeToUpdates();
 
     // Draw the scene
     await drawScene(gl, programInfo, agentsVao, agentsBufferInfo);
@@ -125,6 +138,7 @@ async function initAgentsModel() {
     if(response.ok){
       // Parse the response as JSON and log the message
       let result = await response.json()
+      sessionId = result.sessionId
       console.log(result.message)
     }
       
@@ -134,72 +148,177 @@ async function initAgentsModel() {
   }
 }
 
+// Request agent and light states as packed binary records instead of JSON
+const USE_BINARY_SNAPSHOTS = false;
+// Direction codes of the binary records (see Server/trafficBase/cell_index.py)
+const DIRECTION_NAMES = [null, "Right", "Left", "Up", "Down", "None"];
+const CAR_RECORD_SIZE = 9;
+
 /*
  * Retrieves the current positions of all agents from the agent server.
  */
 async function getAgents() {
     try {
-        let response = await fetch(agent_server_uri + "getAgents");
+        if (USE_BINARY_SNAPSHOTS) {
+            let response = await fetch(sessionUrl("getAgents?format=binary"));
+            if (response.ok) {
+                setAgents(parseBinaryAgents(await response.arrayBuffer()));
+            }
+            return;
+        }
+
+        let response = await fetch(sessionUrl("getAgents"));
 
         if (response.ok) {
             let result = await response.json();
-            
-            const currentAgentsMap = new Map(
-                result.positions.map(agent => [agent.id, agent])
-            );
-
-            // Remove agents that no longer exist
-            for (let i = agents.length - 1; i >= 0; i--) {
-                if (!currentAgentsMap.has(agents[i].id)) {
-                    agents.splice(i, 1);
-                }
-            }
-
-            // Update existing agents and add new ones
-            result.positions.forEach(agentData => {
-                const rotation = getRotationFromDirection(agentData.direction);
-                const existingAgentIndex = agents.findIndex(a => a.id === agentData.id);
-
-                if (existingAgentIndex !== -1) {
-                    // Update existing agent
-                    const agent = agents[existingAgentIndex];
-                    // Store current position as previous position
-                    agent.previousPosition = [...agent.position];
-                    // Set new target position
-                    agent.targetPosition = [agentData.x, agentData.y, agentData.z || 0];
-                    // Reset interpolation factor
-                    agent.interpolationFactor = 0;
-                    agent.rotation = [0, rotation, 0];
-                } else {
-                    // Add new agent
-                    const newAgent = new Object3D(
-                        agentData.id,
-                        [agentData.x, agentData.y, agentData.z || 0],
-                        [0, rotation, 0],
-                        [1, 1, 1]
-                    );
-                    // Initialize interpolation properties
-                    newAgent.previousPosition = [...newAgent.position];
-                    newAgent.targetPosition = [...newAgent.position];
-                    newAgent.interpolationFactor = 1.0;
-                    agents.push(newAgent);
-                }
-            });
+            setAgents(result.positions);
         }
     } catch (error) {
         console.error("Error fetching agents:", error);
     }
 }
+
 /*
- * Retrieves the current positions of all obstacles from the agent server.
+ * Decodes the fixed-width car records: uint32 id, uint16 x, uint16 y, uint8 direction (little endian).
+ */
+function parseBinaryAgents(buffer) {
+    const view = new DataView(buffer);
+    const positions = [];
+    for (let offset = 0; offset + CAR_RECORD_SIZE <= buffer.byteLength; offset += CAR_RECORD_SIZE) {
+        positions.push({
+            id: "car_" + view.getUint32(offset, true),
+            x: view.getUint16(offset + 4, true),
+            y: view.getUint16(offset + 6, true),
+            direction: DIRECTION_NAMES[view.getUint8(offset + 8)]
+        });
+    }
+    return positions;
+}
+
+/*
+ * Replaces the agents with the given list, keeping the ones that still exist.
+ */
+function setAgents(positions) {
+    const currentAgentsMap = new Map(
+        positions.map(agent => [agent.id, agent])
+    );
+
+    // Remove agents that no longer exist
+    for (let i = agents.length - 1; i >= 0; i--) {
+        if (!currentAgentsMap.has(agents[i].id)) {
+            agents.splice(i, 1);
+        }
+    }
+
+    // Update existing agents and add new ones
+    positions.forEach(updateAgent);
+}
+
+/*
+ * Moves an existing agent to its new position, or adds it if it is new.
+ */
+function updateAgent(agentData) {
+    const rotation = getRotationFromDirection(agentData.direction);
+    const existingAgentIndex = agents.findIndex(a => a.id === agentData.id);
+
+    if (existingAgentIndex !== -1) {
+        // Update existing agent
+        const agent = agents[existingAgentIndex];
+        // Store current position as previous position
+        agent.previousPosition = [...agent.position];
+        // Set new target position
+        agent.targetPosition = [agentData.x, agentData.y, agentData.z || 0];
+        // Reset interpolation factor
+        agent.interpolationFactor = 0;
+        agent.rotation = [0, rotation, 0];
+    } else {
+        // Add new agent
+        const newAgent = new Object3D(
+            agentData.id,
+            [agentData.x, agentData.y, agentData.z || 0],
+            [0, rotation, 0],
+            [1, 1, 1]
+        );
+        // Initialize interpolation properties
+        newAgent.previousPosition = [...newAgent.position];
+        newAgent.targetPosition = [...newAgent.position];
+        newAgent.interpolationFactor = 1.0;
+        agents.push(newAgent);
+    }
+}
+
+function removeAgent(id) {
+    const index = agents.findIndex(a => a.id === id);
+    if (index !== -1) {
+        agents.splice(index, 1);
+    }
+}
+
+/*
+ * Subscribes to the per-step changes pushed by the agent server.
+ * While the stream is open, update() only advances the model and nothing is polled.
+ */
+let streamConnected = false;
+const trafficLightPositions = new Map();
+
+function subscribeToUpdates() {
+    const source = new EventSource(sessionUrl("stream"));
+
+    source.addEventListener("snapshot", event => {
+        const snapshot = JSON.parse(event.data);
+        streamConnected = true;
+        setAgents(snapshot.cars);
+        snapshot.lights.forEach(light => trafficLightPositions.set(light.id, light));
+        updateTrafficLightColors(snapshot.lights);
+    });
+
+    source.addEventListener("delta", event => {
+        const delta = JSON.parse(event.data);
+        delta.spawned.forEach(updateAgent);
+        delta.moved.forEach(updateAgent);
+        delta.removed.forEach(removeAgent);
+
+        const lights = delta.lights.map(light => {
+            const position = trafficLightPositions.get(light.id);
+            return { ...position, state: light.state };
+        });
+        updateTrafficLightColors(lights);
+    });
+
+    source.onerror = () => {
+        // Fall back to polling until the browser reconnects
+        streamConnected = false;
+    };
+}
+// Static layout of the city from /map and its ETag. A new session on the same map only revalidates it
+let cityMap = null;
+let cityMapEtag = null;
+
+/*
+ * Retrieves the static layout of the city, reusing the one already loaded if the server answers 304.
+ */
+async function loadMap() {
+    const headers = cityMapEtag ? { "If-None-Match": cityMapEtag } : {};
+    let response = await fetch(sessionUrl("map"), { headers });
+
+    if (response.status === 304) {
+        return cityMap;
+    }
+    if (response.ok) {
+        cityMap = await response.json();
+        cityMapEtag = response.headers.get("ETag");
+    }
+    return cityMap;
+}
+
+/*
+ * Retrieves the positions of all obstacles from the layout of the city.
  */
 async function getObstacles() {
     try {
-        let response = await fetch(agent_server_uri + "getObstacles");
+        let result = await loadMap();
 
-        if (response.ok) {
-            let result = await response.json();
-            
+        if (result) {
             // Clear existing obstacles and buffer groups
             obstacles.length = 0;
             
@@ -221,7 +340,7 @@ async function getObstacles() {
             obstacleBufferGroups.length = 0;
 
             // Create new obstacles
-            for (const obstacle of result.positions) {
+            for (const obstacle of result.obstacles) {
                 const newObstacle = new Object3D(
                     obstacle.id, 
                     [obstacle.x, obstacle.y, obstacle.z || 0],
@@ -288,10 +407,10 @@ async function loadObstacleModel() {
 async function update() {
   try {
     // Send a request to the agent server to update the agent positions
-    let response = await fetch(agent_server_uri + "update") 
+    let response = await fetch(sessionUrl("update")) 
 
     // Check if the response was successful
-    if(response.ok){
+    if(response.ok && !streamConnected){
       // Retrieve the updated agent positions
       await getAgents()
       // Log a message indicating that the agents have been updated
@@ -335,7 +454,9 @@ async function drawScene(gl, programInfo, agentsVao, agentsBufferInfo) {
     if (currentTime - lastUpdateTime >= INTERPOLATION_INTERVAL) {
         lastUpdateTime = currentTime;
         await update();
-        await getTrafficLights();
+        if (!streamConnected) {
+            await getTrafficLights();
+        }
     }
   
     twgl.resizeCanvasToDisplaySize(gl.canvas);
@@ -1046,10 +1167,24 @@ v>>>>>>>>>>s>>>>>>>>s>>>>>>>^^
 
 async function getTrafficLights() {
     try {
-        let response = await fetch(agent_server_uri + "getTrafficLights");
+        // The bitset follows the order of the JSON list, so the positions must be known first
+        if (USE_BINARY_SNAPSHOTS && trafficLightPositions.size > 0) {
+            let response = await fetch(sessionUrl("getTrafficLights?format=binary"));
+            if (response.ok) {
+                const bits = new Uint8Array(await response.arrayBuffer());
+                const lights = [...trafficLightPositions.values()].map((light, i) => (
+                    { ...light, state: (bits[i >> 3] >> (i & 7) & 1) === 1 }
+                ));
+                updateTrafficLightColors(lights);
+            }
+            return;
+        }
+
+        let response = await fetch(sessionUrl("getTrafficLights"));
         if(response.ok) {
             let result = await response.json();
             console.log("Traffic Lights Status:", result.positions);
+            result.positions.forEach(light => trafficLightPositions.set(light.id, light));
             updateTrafficLightColors(result.positions);
         }
     } catch (error) {